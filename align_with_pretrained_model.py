@@ -1,10 +1,13 @@
+import json
 import sys
 
 from amr_utils.amr_readers import AMR_Reader
+from amr_cache import load_amrs
+from models.pipeline import Alignment_Pipeline
 from models.reentrancy_model import Reentrancy_Model
 from models.relation_model import Relation_Model
 from models.subgraph_model import Subgraph_Model
-from nlp_data import add_nlp_data
+from nlp_annotations import attach_nlp_data, stream_nlp_data
 
 
 import argparse
@@ -18,22 +21,113 @@ parser.add_argument('--reentrancy-model', type=str, required=True,
                     help='model parameters file for reentrancy aligner')
 parser.add_argument('-t','--test', type=str, required=True,
                     help='test AMR file (must have nlp data)')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes to align AMRs in parallel')
+parser.add_argument('--stream', action='store_true',
+                    help='read AMRs lazily, run all three aligners on each batch and append alignments to JSON Lines files')
+parser.add_argument('--batch-size', type=int, default=100,
+                    help='number of AMRs to align at a time with --stream')
 args = parser.parse_args()
 
 
+def read_amr_blocks(amr_file):
+    # Yield the text of each AMR in a file, without parsing it.
+    # Comment-only blocks (e.g. a file header) are kept with the AMR that follows them.
+    block = []
+    has_graph = False
+    with open(amr_file, 'r', encoding='utf8') as f:
+        for line in f:
+            if not line.strip():
+                if has_graph:
+                    yield ''.join(block)
+                    block = []
+                    has_graph = False
+                continue
+            block.append(line)
+            if not line.lstrip().startswith('#'):
+                has_graph = True
+    if has_graph:
+        yield ''.join(block)
+
+
+def read_amr_batches(reader, amr_file, batch_size, nlp_data):
+    # Parse AMRs batch_size at a time, so only a few batches are ever held in memory.
+    seen_ids = set()
+    batch = []
+    for block in read_amr_blocks(amr_file):
+        batch.append(block)
+        if len(batch) >= batch_size:
+            yield load_amr_batch(reader, batch, seen_ids, nlp_data)
+            batch = []
+    if batch:
+        yield load_amr_batch(reader, batch, seen_ids, nlp_data)
+
+
+def load_amr_batch(reader, blocks, seen_ids, nlp_data):
+    amrs = reader.loads('\n\n'.join(blocks), remove_wiki=True)
+    for amr in amrs:
+        # repeated ids are renamed the same way when the whole file is loaded at once
+        if amr.id in seen_ids:
+            amr.id += '#2'
+        seen_ids.add(amr.id)
+    attach_nlp_data(amrs, nlp_data)
+    return amrs
+
+
+def append_alignments_jsonl(fw, amrs, alignments):
+    for amr in amrs:
+        record = {'id': amr.id, 'alignments': [align.to_json() for align in alignments[amr.id]]}
+        fw.write(json.dumps(record) + '\n')
+    fw.flush()
+
+
+def stream_main():
+    unaligned_amr_file = args.test
+
+    reader = AMR_Reader()
+    # annotations are read for each batch as it is loaded
+    nlp_data = stream_nlp_data(unaligned_amr_file)
+
+    print(f'Loading model: {args.subgraph_model}')
+    subgraph_model = Subgraph_Model.load_model(args.subgraph_model)
+    print(f'Loading model: {args.relation_model}')
+    rel_model = Relation_Model.load_model(args.relation_model)
+    print(f'Loading model: {args.reentrancy_model}')
+    reent_model = Reentrancy_Model.load_model(args.reentrancy_model)
+
+    prefix = unaligned_amr_file.replace('.txt', '')
+    align_files = [prefix + f'.{layer}_alignments.jsonl' for layer in ['subgraph', 'relation', 'reentrancy']]
+    print('Writing alignments to:', ', '.join(align_files))
+    outputs = [open(align_file, 'w', encoding='utf8') for align_file in align_files]
+    try:
+        sub_out, rel_out, reent_out = outputs
+        done = 0
+        pipeline = Alignment_Pipeline(subgraph_model, rel_model, reent_model)
+        batches = read_amr_batches(reader, unaligned_amr_file, args.batch_size, nlp_data)
+        for amrs, (sub_alignments, rel_alignments, reent_alignments) in pipeline.align_batches(batches, args.workers):
+            append_alignments_jsonl(sub_out, amrs, sub_alignments)
+            append_alignments_jsonl(rel_out, amrs, rel_alignments)
+            append_alignments_jsonl(reent_out, amrs, reent_alignments)
+            done += len(amrs)
+            print(f'\r{done} AMRs aligned', end='')
+        print()
+    finally:
+        for fw in outputs:
+            fw.close()
+
+
 def main():
     unaligned_amr_file = args.test
 
     reader = AMR_Reader()
 
-    eval_amrs = reader.load(unaligned_amr_file, remove_wiki=True)
-    add_nlp_data(eval_amrs, unaligned_amr_file)
+    eval_amrs = load_amrs(unaligned_amr_file, remove_wiki=True, nlp_data=True)
 
     # subgraphs
     print(f'Loading model: {args.subgraph_model}')
     subgraph_model = Subgraph_Model.load_model(args.subgraph_model)
 
-    sub_alignments = subgraph_model.align_all(eval_amrs)
+    sub_alignments = subgraph_model.align_all(eval_amrs, workers=args.workers)
     align_file = unaligned_amr_file.replace('.txt', '') + f'.subgraph_alignments.json'
     print(f'Writing subgraph alignments to: {align_file}')
     reader.save_alignments_to_json(align_file, sub_alignments)
@@ -43,7 +137,7 @@ def main():
     rel_model = Relation_Model.load_model(args.relation_model)
     rel_model.subgraph_alignments = sub_alignments
 
-    rel_alignments = rel_model.align_all(eval_amrs)
+    rel_alignments = rel_model.align_all(eval_amrs, workers=args.workers)
     align_file = unaligned_amr_file.replace('.txt', '') + f'.relation_alignments.json'
     print(f'Writing relation alignments to: {align_file}')
     reader.save_alignments_to_json(align_file, rel_alignments)
@@ -54,11 +148,14 @@ def main():
     reent_model.subgraph_alignments = sub_alignments
     reent_model.relation_alignments = rel_alignments
 
-    reent_alignments = reent_model.align_all(eval_amrs)
+    reent_alignments = reent_model.align_all(eval_amrs, workers=args.workers)
     align_file = unaligned_amr_file.replace('.txt', '') + f'.reentrancy_alignments.json'
     print(f'Writing reentrancy alignments to: {align_file}')
     reader.save_alignments_to_json(align_file, reent_alignments)
 
 
 if __name__=='__main__':
-    main()
\ No newline at end of file
+    if args.stream:
+        stream_main()
+    else:
+        main()
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import pickle
+
+from amr_utils.amr_readers import AMR_Reader
+
+from models.amr_graph import amr_graph
+from nlp_annotations import add_nlp_data, nlp_json_files, nlp_store_file
+
+# Parsed AMRs are saved in a snapshot next to the AMR file (or directory), so the PENMAN files
+# are only parsed again when they change. A snapshot is reused when the size and mtime of its
+# source files are unchanged, or else when their contents hash to the same value.
+# The header of a snapshot also lists the ids of its AMRs, so they can be counted without loading them.
+SNAPSHOT_VERSION = 3
+
+
+def snapshot_file(path, remove_wiki=False, nlp_data=False):
+    name = path.rstrip('/\\')
+    if name.endswith('.txt'):
+        name = name[:-len('.txt')]
+    return name + '.amrs' + ('-nowiki' if remove_wiki else '') + ('-nlp' if nlp_data else '') + '.pkl'
+
+
+def load_amrs(path, remove_wiki=False, nlp_data=False):
+    # Load the AMRs of an AMR file or directory, and add their NLP data if nlp_data.
+    file, header, files = _snapshot(path, remove_wiki, nlp_data)
+    amrs = _load_snapshot(file, header, files)
+    if amrs is not None:
+        return amrs
+
+    reader = AMR_Reader()
+    if os.path.isdir(path):
+        amrs = reader.load_from_dir(path, remove_wiki=remove_wiki)
+    else:
+        amrs = reader.load(path, remove_wiki=remove_wiki)
+    if nlp_data:
+        add_nlp_data(amrs, path)
+    # snapshots include the graph view of each AMR
+    for amr in amrs:
+        amr_graph(amr)
+    header['hash'] = _hash(files)
+    header['ids'] = [amr.id for amr in amrs]
+    _save_snapshot(file, header, amrs)
+    return amrs
+
+
+def snapshot_ids(path, remove_wiki=False, nlp_data=False):
+    # ids of the AMRs of path, from the header of its snapshot, or None if there is no up to date snapshot
+    file, header, files = _snapshot(path, remove_wiki, nlp_data)
+    if not os.path.isfile(file):
+        return None
+    try:
+        with open(file, 'rb') as f:
+            snapshot_header = _read_header(f, header, files)
+    except Exception:
+        return None
+    return snapshot_header['ids'] if snapshot_header is not None else None
+
+
+def _snapshot(path, remove_wiki, nlp_data):
+    # snapshot file, expected header and source files of path
+    files = _source_files(path)
+    if nlp_data:
+        files += [f for f in [nlp_store_file(path)] + nlp_json_files(path) if os.path.isfile(f)]
+    header = {'version': SNAPSHOT_VERSION, 'remove_wiki': remove_wiki, 'nlp_data': nlp_data, 'sources': _stats(files)}
+    return snapshot_file(path, remove_wiki, nlp_data), header, files
+
+
+def _source_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)))
+    return [path]
+
+
+def _stats(files):
+    return [[f, os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+
+def _hash(files):
+    h = hashlib.sha1()
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _load_snapshot(file, header, files):
+    if not os.path.isfile(file):
+        return None
+    try:
+        with open(file, 'rb') as f:
+            snapshot_header = _read_header(f, header, files)
+            if snapshot_header is None:
+                return None
+            amrs = pickle.load(f)
+    except Exception:
+        return None
+    if snapshot_header['sources'] != header['sources']:
+        _save_snapshot(file, dict(snapshot_header, sources=header['sources']), amrs)
+    return amrs
+
+
+def _read_header(f, header, files):
+    # the header of a snapshot, or None if it is out of date
+    snapshot_header = pickle.load(f)
+    if any(snapshot_header.get(k) != header[k] for k in ['version', 'remove_wiki', 'nlp_data']):
+        return None
+    sources = header['sources']
+    snapshot_sources = snapshot_header['sources']
+    if [s[:2] for s in snapshot_sources] != [s[:2] for s in sources]:
+        return None
+    # files that were touched but not changed
+    if snapshot_sources != sources and snapshot_header['hash'] != _hash(files):
+        return None
+    return snapshot_header
+
+
+def _save_snapshot(file, header, amrs):
+    try:
+        with open(file + '.tmp', 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(amrs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file + '.tmp', file)
+    except OSError:
+        # e.g. a read-only data directory
+        pass
@@ -0,0 +1,67 @@
+import os
+
+from amr_utils.amr_readers import AMR_Reader
+
+from amr_cache import load_amrs, snapshot_ids
+
+# A corpus too large to keep in memory is a directory of AMR files (shards), each with its own
+# NLP annotation side files, and is loaded one shard at a time. Alignments are written next to
+# each shard (e.g. train/shard1.subgraph_alignments.json for train/shard1.txt).
+
+
+def shard_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.txt'))
+    return [path]
+
+
+def alignment_file(amr_file, name, epoch=None):
+    epoch = '' if epoch is None else f'.epoch{epoch}'
+    return amr_file.replace('.txt', '') + f'.{name}_alignments{epoch}.json'
+
+
+class AMR_Shards:
+    # Iterating over the corpus yields its AMRs, loading one shard at a time, so that models can be
+    # initialized from it like from a list of AMRs. Alignments of earlier training stages (e.g. 'subgraph'
+    # for the relation aligner) are read from the files next to each shard into self.alignments[name],
+    # which always holds the alignments of the shard being read.
+
+    def __init__(self, path, remove_wiki=False, nlp_data=False, alignments=(), exclude_ids=()):
+        self.files = shard_files(path)
+        self.remove_wiki = remove_wiki
+        self.nlp_data = nlp_data
+        self.exclude_ids = set(exclude_ids)
+        self.alignments = {name: {} for name in alignments}
+        self._ids = {}
+
+    def load(self, file):
+        amrs = load_amrs(file, remove_wiki=self.remove_wiki, nlp_data=self.nlp_data)
+        if self.exclude_ids:
+            amrs = [amr for amr in amrs if amr.id not in self.exclude_ids]
+        return amrs
+
+    def shards(self):
+        # (file, AMRs) of each shard
+        reader = AMR_Reader()
+        for file in self.files:
+            amrs = self.load(file)
+            for name, alignments in self.alignments.items():
+                alignments.clear()
+                alignments.update(reader.load_alignments_from_json(alignment_file(file, name), amrs))
+            yield file, amrs
+
+    def __iter__(self):
+        for file, amrs in self.shards():
+            yield from amrs
+
+    def size(self, file):
+        # number of AMRs in a shard, counted from the header of its snapshot if it has one
+        if file not in self._ids:
+            ids = snapshot_ids(file, remove_wiki=self.remove_wiki, nlp_data=self.nlp_data)
+            if ids is None:
+                ids = [amr.id for amr in load_amrs(file, remove_wiki=self.remove_wiki, nlp_data=self.nlp_data)]
+            self._ids[file] = ids
+        return sum(1 for id in self._ids[file] if id not in self.exclude_ids)
+
+    def __len__(self):
+        return sum(self.size(file) for file in self.files)
@@ -4,6 +4,8 @@ import sys
 
 from amr_utils.amr_readers import AMR_Reader
 
+from amr_cache import load_amrs
+
 
 def main():
     ldc_amrs_dir = sys.argv[1]
@@ -22,11 +24,11 @@ def main():
     ldc_amrs_dir_test = os.path.join(ldc_amrs_dir, 'data/alignments/split', 'test')
 
     reader = AMR_Reader()
-    ldc_amrs_train = reader.load_from_dir(ldc_amrs_dir_train)
-    ldc_amrs_dev = reader.load_from_dir(ldc_amrs_dir_dev)
-    ldc_amrs_test = reader.load_from_dir(ldc_amrs_dir_test)
-    lpp_amrs = reader.load(lpp_amrs_file)
-    add_amrs = reader.load(additional_amrs_file)
+    ldc_amrs_train = load_amrs(ldc_amrs_dir_train)
+    ldc_amrs_dev = load_amrs(ldc_amrs_dir_dev)
+    ldc_amrs_test = load_amrs(ldc_amrs_dir_test)
+    lpp_amrs = load_amrs(lpp_amrs_file)
+    add_amrs = load_amrs(additional_amrs_file)
 
     all_amrs = ldc_amrs_train + ldc_amrs_dev + ldc_amrs_test + lpp_amrs+add_amrs
     all_amrs = {amr.id:amr for amr in all_amrs}
@@ -3,7 +3,8 @@ from collections import Counter, defaultdict
 
 from amr_utils.amr_readers import AMR_Reader
 
-from nlp_data import add_nlp_data
+from models.amr_graph import amr_graph
+from nlp_annotations import add_nlp_data
 
 from evaluate.utils import table_to_latex, table_to_excel
 from load_ccg import load_dependencies, load_ccgbank, align_dependencies_to_sentences, align_ccgbank_to_sentences, \
@@ -659,18 +660,7 @@ def amr_largest_constituent_with_head(amr, head, subgraph_alignments, rel_alignm
         nodes = align.edges[0][2]
     desc.update(nodes)
     root = min(nodes)
-    while True:
-        found = False
-        for s,r,t in amr.edges:
-            if (s,r,t) in reentrancies: continue
-            if s in desc:
-                # if t==root:
-                #     raise Exception('Found Cycle')
-                if t not in desc:
-                    found = True
-                    desc.add(t)
-        if not found:
-            break
+    desc = amr_graph(amr).descendants(desc, ignore_edges=set(reentrancies))
     # check on the left
     index = [i for i,span in enumerate(amr.spans) if align.tokens[0] in span][0]
     left_spans = amr.spans[:index]
@@ -1,6 +1,6 @@
 from amr_utils.amr_readers import AMR_Reader
 
-from nlp_data import add_nlp_data
+from nlp_annotations import add_nlp_data
 
 
 def main():
@@ -3,7 +3,7 @@ import sys
 from amr_utils.amr_readers import AMR_Reader
 
 from evaluate.utils import evaluate, evaluate_relations, evaluate_reentrancies, evaluate_duplicates
-from nlp_data import add_nlp_data
+from nlp_annotations import add_nlp_data
 
 
 def main():
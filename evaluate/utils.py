@@ -3,6 +3,8 @@ import sys
 
 from amr_utils.alignments import AMR_Alignment
 
+from models.alignment_index import Alignment_List, get_alignment
+
 
 def table_to_latex(table, row_labels, column_labels):
     sep = ' & '
@@ -25,9 +27,10 @@ def coverage(amrs, alignments, mode='nodes'):
     coverage_count = 0
     total = 0
     for amr in amrs:
+        aligns = Alignment_List(alignments[amr.id] if amr.id in alignments else [])
         for n in getattr(amr, mode):
-            align = amr.get_alignment(alignments, node_id=n) \
-                if mode=='nodes' else amr.get_alignment(alignments, edge=n)
+            align = aligns.get_alignment(node_id=n) \
+                if mode=='nodes' else aligns.get_alignment(edge=n)
             if align:
                 coverage_count+=1
             total+=1
@@ -60,7 +63,7 @@ def evaluate(amrs, pred_alignments, gold_alignments, mode='nodes'):
 
         for gold_align in gold_alignments[amr.id]:
             if gold_align.type.startswith('dupl'): continue
-            pred_align = amr.get_alignment(pred_alignments, token_id=gold_align.tokens[0])
+            pred_align = get_alignment(amr, pred_alignments, token_id=gold_align.tokens[0])
 
             if gold_align or pred_align:
                 span_recall_total += 1
@@ -101,7 +104,7 @@ def evaluate(amrs, pred_alignments, gold_alignments, mode='nodes'):
 
         for pred_align in pred_alignments[amr.id]:
             if pred_align.type.startswith('dupl'): continue
-            gold_align = amr.get_alignment(gold_alignments, token_id=pred_align.tokens[0])
+            gold_align = get_alignment(amr, gold_alignments, token_id=pred_align.tokens[0])
             if gold_align or pred_align:
                 span_prec_total += 1
 
@@ -141,7 +144,7 @@ def evaluate_relations(amrs, pred_rel_alignments, gold_rel_alignments, pred_sub_
         pred_single_alignments[amr.id] = []
         pred_argstruct_alignments[amr.id] = []
         for align in pred_rel_alignments[amr.id]:
-            sub_align = amr.get_alignment(gold_sub_alignments, token_id=align.tokens[0])
+            sub_align = get_alignment(amr, gold_sub_alignments, token_id=align.tokens[0])
             if sub_align.nodes:
                 align.edges = [e for e in align.edges if not (e[0] in sub_align.nodes and e[-1] in sub_align.nodes)]
                 pred_argstruct_alignments[amr.id].append(align)
@@ -150,7 +153,7 @@ def evaluate_relations(amrs, pred_rel_alignments, gold_rel_alignments, pred_sub_
         gold_single_alignments[amr.id] = []
         gold_argstruct_alignments[amr.id] = []
         for align in gold_rel_alignments[amr.id]:
-            sub_align = amr.get_alignment(gold_sub_alignments, token_id=align.tokens[0])
+            sub_align = get_alignment(amr, gold_sub_alignments, token_id=align.tokens[0])
             if sub_align.nodes:
                 align.edges = [e for e in align.edges if not (e[0] in sub_align.nodes and e[-1] in sub_align.nodes)]
                 gold_argstruct_alignments[amr.id].append(align)
@@ -223,6 +226,11 @@ def evaluate_duplicates(amrs, pred_alignments, gold_alignments):
 
 
 def perplexity(align_model, eval_amrs, eval_alignments):
+    print_perplexity([perplexity_sum(align_model, eval_amrs, eval_alignments)])
+
+
+def perplexity_sum(align_model, eval_amrs, eval_alignments):
+    # (sum of the perplexities of the AMRs, number of AMRs), which add up over the shards of a corpus
     perplexity = 0.0
     N = 0
     for amr in eval_amrs:
@@ -235,7 +243,11 @@ def perplexity(align_model, eval_amrs, eval_alignments):
             tally -= logp / math.log(2.0)
         perplexity += math.pow(2.0, tally / len(eval_alignments[amr.id]))
         N += 1
-    perplexity /= N
+    return perplexity, N
+
+
+def print_perplexity(sums):
+    perplexity = sum(p for p, N in sums) / sum(N for p, N in sums)
     print(f'Avg Perplexity: {perplexity}')
 
 
@@ -270,7 +282,7 @@ def log_alignment_changes(file, amrs, all_alignments):
             compare = []
             aligns = []
             for alignments in all_alignments:
-                align = amr.get_alignment(alignments, token_id=span[0])
+                align = get_alignment(amr, alignments, token_id=span[0])
                 aligns.append(align)
                 compare.append(tuple(sorted(align.nodes)))
             if not all(compare[i] == compare[0] for i in range(len(compare))):
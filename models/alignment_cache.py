@@ -0,0 +1,90 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+from amr_utils.alignments import AMR_Alignment
+
+from models.alignment_index import index_alignments
+
+# Version of the rules (in rule_based/) that make the initial alignments.
+# Change it when the rules change, so that alignments cached with older rules are not used.
+RULES_VERSION = 1
+
+
+class Initial_Alignment_Cache:
+    # Rule-based initial alignments only depend on the AMRs (with their NLP data), on the alignments
+    # of earlier stages and on the rules, so they are kept in memory (for the next epoch) and on disk
+    # (for the next run), keyed by a hash of all of these. Each lookup returns new alignment objects.
+    # Only the max_memory most recently used corpora (e.g. train and eval, or the last few shards)
+    # are kept in memory.
+
+    def __init__(self, cache_dir=None, max_memory=8):
+        self.cache_dir = cache_dir
+        self.max_memory = max_memory
+        self.memory = OrderedDict()
+
+    def key(self, name, amrs, inputs=None):
+        # inputs(amr): anything besides the AMR that its alignments depend on
+        h = hashlib.sha1(repr((name, RULES_VERSION)).encode('utf8'))
+        for amr in amrs:
+            h.update(repr(amr_fingerprint(amr)).encode('utf8'))
+            if inputs is not None:
+                h.update(repr(inputs(amr)).encode('utf8'))
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _remember(self, key, alignments):
+        self.memory[key] = alignments
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def get(self, key, amrs):
+        alignments = self.memory.get(key)
+        if alignments is None and self.cache_dir and os.path.isfile(self._file(key)):
+            try:
+                with open(self._file(key), 'rb') as f:
+                    alignments = pickle.load(f)
+            except Exception:
+                alignments = None
+        if alignments is None:
+            return None
+        self._remember(key, alignments)
+        return index_alignments(amrs, {amr.id: [_alignment(align, amr) for align in alignments[amr.id]]
+                                       for amr in amrs})
+
+    def put(self, key, amrs, alignments):
+        compact = {amr.id: compact_alignments(alignments[amr.id]) for amr in amrs}
+        self._remember(key, compact)
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._file(key) + '.tmp', 'wb') as f:
+                pickle.dump(compact, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self._file(key) + '.tmp', self._file(key))
+        except OSError:
+            pass
+
+
+def amr_fingerprint(amr):
+    # everything about an AMR that the rules read
+    return (amr.id, amr.tokens, getattr(amr, 'lemmas', None), getattr(amr, 'pos', None),
+            getattr(amr, 'spans', None), getattr(amr, 'coref', None), amr.root, list(amr.nodes.items()), amr.edges)
+
+
+def compact_alignments(aligns):
+    return [(align.type, tuple(align.tokens), tuple(align.nodes), tuple(tuple(e) for e in align.edges),
+             align.amr is not None) for align in aligns]
+
+
+def _alignment(align, amr):
+    type, tokens, nodes, edges, has_amr = align
+    return AMR_Alignment(type=type, tokens=list(tokens), nodes=list(nodes), edges=list(edges),
+                         amr=amr if has_amr else None)
+
+
+INITIAL_ALIGNMENTS = Initial_Alignment_Cache(os.path.join(os.path.expanduser('~'), '.cache', 'leamr', 'initial_alignments'))
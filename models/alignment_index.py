@@ -0,0 +1,93 @@
+from amr_utils.alignments import AMR_Alignment
+
+
+class Alignment_List(list):
+    # An AMR's alignments, with lookup tables from token ids, node ids and edges to alignments.
+    # Lookups return the same alignment as amr.get_alignment(), i.e. the first one in list order.
+    # The tables are rebuilt lazily whenever the list itself changes. Code that changes the tokens, nodes
+    # or edges of an alignment in the list in place must call reindex() (or reindex_alignments()).
+    # A hit that is no longer in its alignment also rebuilds the tables, but a miss is not checked.
+    # The cache holds values that models derive from the alignments, and is cleared along with the tables.
+
+    def __init__(self, aligns=()):
+        super().__init__(aligns)
+        self._index = None
+        self.cache = {}
+
+    def __reduce__(self):
+        return Alignment_List, (list(self),)
+
+    def reindex(self):
+        self._index = None
+        self.cache = {}
+
+    def _build_index(self):
+        tokens, nodes, edges = {}, {}, {}
+        for i, align in enumerate(self):
+            for t in align.tokens:
+                tokens.setdefault(t, i)
+            for n in align.nodes:
+                nodes.setdefault(n, i)
+            for e in align.edges:
+                edges.setdefault(tuple(e), i)
+        self._index = tokens, nodes, edges
+
+    def get_alignment(self, token_id=None, node_id=None, edge=None):
+        if edge is not None:
+            edge = tuple(edge)
+        for _ in range(2):
+            if self._index is None:
+                self._build_index()
+            tokens, nodes, edges = self._index
+            idx = [table[key] for key, table in [(token_id, tokens), (node_id, nodes), (edge, edges)]
+                   if key is not None and key in table]
+            if not idx:
+                return AMR_Alignment()
+            align = self[min(idx)]
+            if (token_id is not None and token_id in align.tokens) \
+                    or (node_id is not None and node_id in align.nodes) \
+                    or (edge is not None and edge in align.edges):
+                return align
+            # the alignment was changed in place
+            self.reindex()
+        return AMR_Alignment()
+
+    def _changed(f):
+        def wrapper(self, *args, **kwargs):
+            self.reindex()
+            return f(self, *args, **kwargs)
+        return wrapper
+
+    append = _changed(list.append)
+    extend = _changed(list.extend)
+    insert = _changed(list.insert)
+    remove = _changed(list.remove)
+    pop = _changed(list.pop)
+    clear = _changed(list.clear)
+    sort = _changed(list.sort)
+    reverse = _changed(list.reverse)
+    __setitem__ = _changed(list.__setitem__)
+    __delitem__ = _changed(list.__delitem__)
+    __iadd__ = _changed(list.__iadd__)
+    __imul__ = _changed(list.__imul__)
+    del _changed
+
+
+def get_alignment(amr, alignments, token_id=None, node_id=None, edge=None):
+    # Same as amr.get_alignment(), but uses the lookup tables of indexed alignments.
+    aligns = alignments.get(amr.id) if isinstance(alignments, dict) else None
+    if isinstance(aligns, Alignment_List):
+        return aligns.get_alignment(token_id=token_id, node_id=node_id, edge=edge)
+    return amr.get_alignment(alignments, token_id=token_id, node_id=node_id, edge=edge)
+
+
+def index_alignments(amrs, alignments):
+    for amr in amrs:
+        if amr.id in alignments and not isinstance(alignments[amr.id], Alignment_List):
+            alignments[amr.id] = Alignment_List(alignments[amr.id])
+    return alignments
+
+
+def reindex_alignments(amr, alignments):
+    if isinstance(alignments.get(amr.id), Alignment_List):
+        alignments[amr.id].reindex()
@@ -0,0 +1,179 @@
+from array import array
+
+
+class AMR_Graph:
+    # Integer view of an AMR graph, so that the parents and children of a node can be found
+    # without scanning amr.edges. Nodes are numbered in the order of amr.nodes and edges in the
+    # order of amr.edges. The edges out of and into each node are kept in CSR arrays
+    # (edge ids grouped by node id, in edge order), and concepts and roles are interned as label ids.
+    # Queries take and return node names and edge tuples, in the same order as a scan of amr.edges.
+
+    def __init__(self, amr):
+        # the node and edge containers of the AMR and their sizes, to tell when they are replaced or resized
+        self.amr_nodes = amr.nodes
+        self.amr_edges = amr.edges
+        self.amr_size = (len(amr.nodes), len(amr.edges))
+        self.nodes = list(amr.nodes)
+        self.node_ids = {n: i for i, n in enumerate(self.nodes)}
+        self.edges = [tuple(e) for e in amr.edges]
+        for s, r, t in self.edges:
+            for n in [s, t]:
+                if n not in self.node_ids:
+                    self.node_ids[n] = len(self.nodes)
+                    self.nodes.append(n)
+        n_nodes = len(self.nodes)
+
+        label_ids = {}
+        self.labels = []
+        def label_id(label):
+            if label not in label_ids:
+                label_ids[label] = len(self.labels)
+                self.labels.append(label)
+            return label_ids[label]
+        self.node_labels = array('i', [label_id(amr.nodes.get(n)) for n in self.nodes])
+        self.edge_labels = array('i', [label_id(r) for s, r, t in self.edges])
+
+        self.sources = array('i', [self.node_ids[s] for s, r, t in self.edges])
+        self.targets = array('i', [self.node_ids[t] for s, r, t in self.edges])
+        self.child_ptr, self.child_edges = _csr(self.sources, n_nodes)
+        self.parent_ptr, self.parent_edges = _csr(self.targets, n_nodes)
+        self.in_degree = array('i', [self.parent_ptr[i+1]-self.parent_ptr[i] for i in range(n_nodes)])
+        # edge ids into or out of each node
+        self.incident_ids = [tuple(sorted(set(self.child_edges[self.child_ptr[i]:self.child_ptr[i+1]])
+                                          | set(self.parent_edges[self.parent_ptr[i]:self.parent_ptr[i+1]])))
+                             for i in range(n_nodes)]
+
+        self.label_nodes = {}
+        for i, label in enumerate(self.node_labels):
+            self.label_nodes.setdefault(label, []).append(self.nodes[i])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _out(self, n):
+        i = self.node_ids.get(n)
+        if i is None:
+            return ()
+        return self.child_edges[self.child_ptr[i]:self.child_ptr[i+1]]
+
+    def _in(self, n):
+        i = self.node_ids.get(n)
+        if i is None:
+            return ()
+        return self.parent_edges[self.parent_ptr[i]:self.parent_ptr[i+1]]
+
+    def children(self, n):
+        # edges (n, r, t)
+        return [self.edges[j] for j in self._out(n)]
+
+    def parents(self, n):
+        # edges (s, r, n)
+        return [self.edges[j] for j in self._in(n)]
+
+    def child_nodes(self, n):
+        return [self.edges[j][2] for j in self._out(n)]
+
+    def parent_nodes(self, n):
+        return [self.edges[j][0] for j in self._in(n)]
+
+    def num_parents(self, n):
+        i = self.node_ids.get(n)
+        return self.in_degree[i] if i is not None else 0
+
+    def num_children(self, n):
+        i = self.node_ids.get(n)
+        return self.child_ptr[i+1]-self.child_ptr[i] if i is not None else 0
+
+    def in_edges(self, nodes):
+        # edges (s, r, t) with t in nodes
+        return [self.edges[j] for j in sorted({j for n in nodes for j in self._in(n)})]
+
+    def out_edges(self, nodes):
+        # edges (s, r, t) with s in nodes
+        return [self.edges[j] for j in sorted({j for n in nodes for j in self._out(n)})]
+
+    def _incident(self, n):
+        i = self.node_ids.get(n)
+        if i is None:
+            return ()
+        return self.incident_ids[i]
+
+    def incident_edges(self, nodes):
+        # edges (s, r, t) with s or t in nodes
+        if len(nodes) == 1:
+            for n in nodes:
+                return [self.edges[j] for j in self._incident(n)]
+        return [self.edges[j] for j in sorted({j for n in nodes for j in self._incident(n)})]
+
+    def subgraph_edges(self, nodes):
+        # edges (s, r, t) with s and t in nodes
+        nodes = set(nodes)
+        return [self.edges[j] for j in sorted(j for n in nodes for j in self._out(n) if self.edges[j][2] in nodes)]
+
+    def scan_incident_edges(self, nodes):
+        # Same as incident_edges(), for a list of nodes that grows while iterating:
+        # the edges of nodes appended to the list are visited as well, unless they come before
+        # the current edge, just like in a scan of amr.edges.
+        ids = sorted({j for n in nodes for j in self._incident(n)})
+        done = len(nodes)
+        i = 0
+        while i < len(ids):
+            j = ids[i]
+            yield self.edges[j]
+            i += 1
+            if len(nodes) > done:
+                ids = sorted({k for n in nodes[done:] for k in self._incident(n) if k > j}.union(ids[i:]))
+                done = len(nodes)
+                i = 0
+
+    def same_concept(self, n):
+        # nodes with the same concept as n (including n)
+        i = self.node_ids.get(n)
+        if i is None:
+            return []
+        return self.label_nodes[self.node_labels[i]]
+
+    def descendants(self, nodes, ignore_edges=()):
+        # nodes reachable from nodes (including nodes)
+        desc = set(nodes)
+        stack = list(desc)
+        while stack:
+            n = stack.pop()
+            for j in self._out(n):
+                e = self.edges[j]
+                if e in ignore_edges or e[2] in desc: continue
+                desc.add(e[2])
+                stack.append(e[2])
+        return desc
+
+
+def _csr(keys, n):
+    # edge ids grouped by key, as (pointer array, edge id array)
+    ptr = array('i', [0]) * (n+1)
+    for k in keys:
+        ptr[k+1] += 1
+    for i in range(n):
+        ptr[i+1] += ptr[i]
+    pos = array('i', ptr)
+    ids = array('i', [0]) * len(keys)
+    for j, k in enumerate(keys):
+        ids[pos[k]] = j
+        pos[k] += 1
+    return ptr, ids
+
+
+def amr_graph(amr):
+    # The graph view of an AMR, built once and kept on the AMR. It is built again if amr.nodes or
+    # amr.edges has been replaced or has changed size; code that changes nodes or edges in place
+    # must call invalidate_graph(amr).
+    graph = getattr(amr, 'graph', None)
+    if graph is None or getattr(graph, 'amr_edges', None) is not amr.edges or graph.amr_nodes is not amr.nodes \
+            or graph.amr_size != (len(amr.nodes), len(amr.edges)):
+        graph = AMR_Graph(amr)
+        amr.graph = graph
+    return graph
+
+
+def invalidate_graph(amr):
+    # to be called after changing the nodes or edges of an AMR in place
+    amr.graph = None
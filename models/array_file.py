@@ -0,0 +1,62 @@
+import json
+import struct
+
+import numpy as np
+
+# File layout: MAGIC, header length (uint64), JSON header, then raw arrays.
+# Each array starts at a multiple of ALIGNMENT bytes, so it can be memory-mapped in place.
+MAGIC = b'LEAMRARR'
+ALIGNMENT = 64
+
+
+def is_array_file(file):
+    with open(file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_arrays(file, header, arrays):
+    # header: any JSON serializable dict; arrays: dict of name -> numpy array
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    table = {}
+    offset = 0
+    for name, a in arrays.items():
+        offset = _aligned(offset)
+        table[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset += a.nbytes
+    header = dict(header, arrays=table)
+    header_bytes = json.dumps(header).encode('utf8')
+    start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+    with open(file, 'wb') as fw:
+        fw.write(MAGIC)
+        fw.write(struct.pack('<Q', len(header_bytes)))
+        fw.write(header_bytes)
+        fw.write(b'\0' * (start - fw.tell()))
+        for name, a in arrays.items():
+            fw.write(b'\0' * (start + table[name]['offset'] - fw.tell()))
+            fw.write(a.tobytes())
+
+
+def load_arrays(file, mmap=True):
+    # Returns (header, arrays). With mmap=True arrays are read-only views of the file,
+    # so only the parts that are actually used are read from disk.
+    with open(file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('Not an array file:', file)
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf8'))
+    start = _aligned(len(MAGIC) + 8 + header_size)
+    if mmap:
+        buffer = np.memmap(file, dtype=np.uint8, mode='r')
+    else:
+        buffer = np.fromfile(file, dtype=np.uint8)
+    arrays = {}
+    for name, info in header.pop('arrays').items():
+        dtype = np.dtype(info['dtype'])
+        size = int(np.prod(info['shape'], dtype=np.int64)) * dtype.itemsize
+        begin = start + info['offset']
+        arrays[name] = buffer[begin:begin + size].view(dtype).reshape(info['shape'])
+    return header, arrays
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
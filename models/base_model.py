@@ -1,21 +1,38 @@
 
-import pickle, dill
+import heapq
+import pickle
 import sys
 from collections import Counter
 
 from amr_utils.alignments import AMR_Alignment
 from tqdm import tqdm
 
+from models.alignment_cache import INITIAL_ALIGNMENTS
+from models.alignment_index import index_alignments
+from models.array_file import is_array_file
+from models.count_table import merge_counts, nested_size, nested_total
+from models.param_file import save_params, load_params
+from models.parallel import can_fork, chunk_by_cost, fork_map, collect_counts
+from models.vocab import Vocab, intern_table, intern_nested_table
+
 
 class Serializable:
     def save_model(self, file):
-        with open(file, 'wb+') as fw:
-            pickle.dump(self, fw)
+        save_params(file, self)
 
     @staticmethod
     def load_model(file):
-        with open(file, 'rb') as fr:
-            model = pickle.load(fr)
+        # older models were pickled
+        if is_array_file(file):
+            model = load_params(file)
+        else:
+            print(f'Note: {file} is a pickled model, which loads slowly. '
+                  f'Convert it once with: python -m scripts.convert_model {file}', file=sys.stderr)
+            with open(file, 'rb') as fr:
+                model = pickle.load(fr)
+        # models saved before labels were interned have count tables keyed by label strings
+        if isinstance(model, Alignment_Model) and not hasattr(model, 'vocab'):
+            model.intern_labels(Vocab())
         return model
 
 
@@ -24,27 +41,46 @@ class Alignment_Model(Serializable):
     def __init__(self, amrs, alpha=0.01, smooth_translation=False):
 
         self.alpha = alpha
+        # label ids shared by the model and its submodels
+        self.vocab = Vocab()
         self.smooth_translation = smooth_translation
         self.translation_count = {}
         self.translation_total = 0
 
         self.tokens_count = Counter()
         self.tokens_total = 0
+        if amrs is not None:
+            self.read_corpus(amrs)
+
+        self._trans_logp_memo = {}
+
+    def read_corpus(self, amrs, submodels=()):
+        # Initial parameters of the model and its submodels, from a single pass over the corpus
+        # (a corpus that is loaded one shard at a time, such as an AMR_Shards, is read shard by shard)
+        models = [self] + list(submodels)
+        shards = (shard for file, shard in amrs.shards()) if hasattr(amrs, 'shards') else [amrs]
+        for shard in shards:
+            for model in models:
+                model.read_amrs(shard)
+        for model in models:
+            model.init_params()
+
+    def read_amrs(self, amrs):
         for amr in amrs:
             for span in amr.spans:
-                token_label = ' '.join(amr.lemmas[t] for t in span)
+                token_label = self.vocab.tokens_id(amr, span)
                 self.tokens_count[token_label] += 1
+
+    def init_params(self):
         self.tokens_total = sum(self.tokens_count[t] for t in self.tokens_count)
         self.tokens_total += self.alpha*(len(self.tokens_count)+1)
 
-        self._trans_logp_memo = {}
-
     def logp(self, amr, alignments, align):
         return 0
 
     def readable_logp(self, amr, alignments, align):
         token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
-        tokens_count = self.tokens_count[token_label]
+        tokens_count = self.tokens_count[self.vocab.tokens_id(amr, align.tokens)]
         score = self.logp(amr, alignments, align)
         return {'tokens':token_label,
                 'score':score,
@@ -52,31 +88,63 @@ class Alignment_Model(Serializable):
                 }
 
     def get_alignment_label(self, amr, ns):
-        return str(ns)
+        return self.vocab.id(str(ns))
 
-    def get_initial_alignments(self, amrs, preprocess=True):
+    def intern_labels(self, vocab):
+        # convert the count tables of an older model from label strings to label ids
+        self.vocab = vocab
+        self.translation_count = intern_nested_table(self.translation_count, vocab)
+        self.tokens_count = intern_table(self.tokens_count, vocab)
+        self._trans_logp_memo = {}
+
+    def get_initial_alignments(self, amrs, preprocess=True, verbose=True):
         return {amr.id:[] for amr in amrs}
 
-    def update_parameters(self, amrs, alignments):
-        self.translation_count = {}
-        self.translation_total = 0
-        self._trans_logp_memo = {}
+    def initial_alignment_inputs(self, amr):
+        # anything besides the AMR that its initial alignments depend on
+        return None
+
+    def cached_initial_alignments(self, amrs, preprocess=True, verbose=True):
+        # get_initial_alignments(), computed once for a corpus (see Initial_Alignment_Cache)
+        key = INITIAL_ALIGNMENTS.key((type(self).__name__, preprocess), amrs, self.initial_alignment_inputs)
+        alignments = INITIAL_ALIGNMENTS.get(key, amrs)
+        if alignments is not None:
+            if verbose:
+                print('Using cached initial alignments')
+            return alignments
+        alignments = self.get_initial_alignments(amrs, preprocess, verbose)
+        INITIAL_ALIGNMENTS.put(key, amrs, alignments)
+        return alignments
+
+    def update_parameters(self, amrs, alignments, workers=1):
+        self.set_parameters(self.add_earlier_epochs(collect_counts(self, amrs, alignments, workers)))
 
+    def add_earlier_epochs(self, counts):
+        # the counts of an epoch (batch EM), with any counts that carry over from earlier epochs
+        return counts
+
+    def count_parameters(self, amrs, alignments):
+        # M-step counts for a shard of the corpus, which can be added up with merge_counts()
+        translation_count = {}
         for amr in amrs:
             if amr.id not in alignments:
                 continue
             for align in alignments[amr.id]:
-                tokens = ' '.join(amr.lemmas[t] for t in align.tokens)
-                if tokens not in self.translation_count:
-                    self.translation_count[tokens] = Counter()
+                tokens = self.vocab.tokens_id(amr, align.tokens)
+                if tokens not in translation_count:
+                    translation_count[tokens] = Counter()
                 align_label = self.get_alignment_label(amr, align)
                 if align_label is None:
                     continue
-                self.translation_count[tokens][align_label] += 1
+                translation_count[tokens][align_label] += 1
+        return {'translation_count': translation_count}
 
-        self.translation_total = sum(self.translation_count[t][s] for t in self.translation_count for s in self.translation_count[t])
+    def set_parameters(self, counts):
+        self._trans_logp_memo = {}
+        self.translation_count = counts['translation_count']
+        self.translation_total = nested_total(self.translation_count)
         if self.smooth_translation:
-            self.translation_total += self.alpha*sum(len(self.translation_count[t])+1 for t in self.translation_count)
+            self.translation_total += self.alpha*(nested_size(self.translation_count)+len(self.translation_count))
 
     def align(self, amr, alignments, n, unaligned=None, return_all=False):
         pass
@@ -87,66 +155,22 @@ class Alignment_Model(Serializable):
     def postprocess_alignments(self, amr, alignments):
         pass
 
-    def align_all(self, amrs, alignments=None, preprocess=True, debug=False):
-        if alignments is None:
-            alignments = self.get_initial_alignments(amrs, preprocess)
+    def get_dependencies(self, amr, alignments, n, aligns):
+        # Spans and nodes whose alignments the candidate scores for n were computed from.
+        # After an alignment is committed, n is only rescored if the committed span or nodes overlap these.
+        # None means n must be rescored after every step.
+        return None
 
-        for amr in tqdm(amrs, file=sys.stdout):
-            unaligned = self.get_unaligned(amr, alignments)
+    def align_all(self, amrs, alignments=None, preprocess=True, debug=False, workers=1, verbose=True):
+        if alignments is None:
+            alignments = self.cached_initial_alignments(amrs, preprocess, verbose)
 
-            while unaligned:
-                all_scores = {}
-                candidate_aligns = {}
-
-                for n in unaligned:
-                    aligns, scores = self.align(amr, alignments, n, unaligned, return_all=True)
-                    if aligns is None: continue
-                    # span = tuple(best_align.tokens)
-                    for span in aligns:
-                        all_scores[(n, span)] = scores[span]
-                        candidate_aligns[(n, span)] = aligns[span]
-                if not all_scores:
-                    break
+        if workers > 1 and can_fork():
+            self._align_all_parallel(amrs, alignments, workers, verbose)
+            return alignments
 
-                best = max(all_scores.keys(), key=lambda x: all_scores[x])
-                n, span = best
-                span = list(span)
-                new_align = candidate_aligns[best]
-
-                if debug:
-                    old_alignments = {tuple(align.tokens): align for align in alignments[amr.id]}
-                    readable = [(all_scores[(n,span)],
-                                 list(span), n,
-                                 ' '.join(amr.lemmas[t] for t in span),
-                                 self.get_alignment_label(amr, candidate_aligns[(n,span)]),
-                                 self.readable_logp(amr, alignments, candidate_aligns[(n,span)]),
-                                 self.readable_logp(amr, alignments, old_alignments[span]) if span in old_alignments else None,
-                                 ) for n,span in all_scores.keys()]
-                    readable = [x for x in sorted(readable, key=lambda y :y[0], reverse=True)]
-                    # dist1 = self.distance_logp(amr, alignments, AMR_Alignment(tokens=[6], nodes=['1.2.1.2.1']))
-                    # dist2 = self.distance_logp(amr, alignments, AMR_Alignment(tokens=[31], nodes=['1.2.1.2.1']))
-                    print(end='')
-
-
-                # add node to alignment
-                found = False
-                for i, align in enumerate(alignments[amr.id]):
-                    if align.type.startswith('dupl') or align.type.startswith('reentrancy'): continue
-                    if align.tokens == span and align.type == new_align.type:
-                        alignments[amr.id][i] = new_align
-                        found = True
-                        break
-                if not found:
-                    alignments[amr.id].append(new_align)
-
-                l1 = len(unaligned)
-                unaligned = self.get_unaligned(amr, alignments)
-                l2 = len(unaligned)
-                if l2 >= l1:
-                    raise Exception('Infinite Loop:', amr.id)
-
-            amr.alignments = alignments[amr.id]
-            self.postprocess_alignments(amr, alignments)
+        for amr in tqdm(amrs, file=sys.stdout, disable=not verbose):
+            self.align_amr(amr, alignments, debug)
 
             # tally = 0
             # for align in alignments[amr.id]:
@@ -159,6 +183,155 @@ class Alignment_Model(Serializable):
             #                  self.readable_logp(amr, alignments, align)) for align in alignments[amr.id]]
             #     print('\rhigh perplexity:',amr.id, perplexity, ' '.join(amr.tokens), file=sys.stderr)
 
+        return alignments
 
+    def _align_all_parallel(self, amrs, alignments, workers, verbose=True):
+        # Each AMR is aligned independently, so AMRs are sharded across forked workers
+        # and the results are written back by index, which keeps the output independent of scheduling.
+        cost = lambda i: (len(amrs[i].nodes) + len(amrs[i].edges) + 1) * (len(amrs[i].spans) + 1)
+        chunks = chunk_by_cost(range(len(amrs)), cost, workers * 8)
+        with tqdm(total=len(amrs), file=sys.stdout, disable=not verbose) as progress:
+            for results in fork_map(_align_chunk, chunks, (self, amrs, alignments), workers):
+                for i, aligns in results:
+                    amr = amrs[i]
+                    for align in aligns:
+                        align.amr = amr
+                    alignments[amr.id] = aligns
+                    amr.alignments = aligns
+                progress.update(len(results))
+
+    def align_all_stepwise(self, amrs, stepwise, batch_size, workers=1, verbose=True, corpus_size=None):
+        # Stepwise EM: align a mini-batch, interpolate its counts into the running counts
+        # (a Stepwise_Counts) and update the parameters before aligning the next mini-batch
+        if corpus_size is None:
+            corpus_size = len(amrs)
+        alignments = {}
+        batches = range(0, len(amrs), batch_size)
+        for b in tqdm(batches, file=sys.stdout, disable=not verbose):
+            batch = amrs[b:b+batch_size]
+            batch_alignments = self.align_all(batch, workers=workers, verbose=False)
+            alignments.update(batch_alignments)
+            stepwise.update(collect_counts(self, batch, batch_alignments, workers), corpus_size/len(batch))
+            self.set_parameters(stepwise.counts())
         return alignments
 
+    def align_shards(self, shards, save_alignments=None, stepwise=None, batch_size=None, workers=1):
+        # One epoch over a corpus that does not fit in memory (an AMR_Shards): each shard is aligned,
+        # its alignments are handed to save_alignments(file, amrs, alignments) and only the counts are kept.
+        # The parameters are updated after the last shard, or after each mini-batch with stepwise EM.
+        counts = {}
+        for file, amrs in shards.shards():
+            if stepwise is not None:
+                alignments = self.align_all_stepwise(amrs, stepwise, batch_size, workers, corpus_size=len(shards))
+            else:
+                alignments = self.align_all(amrs, workers=workers)
+                counts = merge_counts(counts, collect_counts(self, amrs, alignments, workers))
+            if save_alignments is not None:
+                save_alignments(file, amrs, alignments)
+        if stepwise is None:
+            self.set_parameters(self.add_earlier_epochs(counts))
+
+    def align_amr(self, amr, alignments, debug=False):
+        # Greedy search: repeatedly commit the best scoring candidate alignment.
+        # Candidate scores are kept in a max-heap and only candidates whose dependencies
+        # were touched by the last committed alignment are rescored.
+        index_alignments([amr], alignments)
+        unaligned = self.get_unaligned(amr, alignments)
+        rank = {n: i for i, n in enumerate(unaligned)}
+        candidates = {}
+        dependencies = {}
+        version = Counter()
+        heap = []
+        dirty = set(unaligned)
+
+        while unaligned:
+            for n in unaligned:
+                if n not in rank:
+                    rank[n] = len(rank)
+                if n not in dirty and n in candidates:
+                    continue
+                version[n] += 1
+                aligns, scores = self.align(amr, alignments, n, unaligned, return_all=True)
+                if aligns is None:
+                    aligns, scores = {}, {}
+                candidates[n] = (aligns, scores)
+                dependencies[n] = self.get_dependencies(amr, alignments, n, aligns)
+                for i, span in enumerate(aligns):
+                    heapq.heappush(heap, (-scores[span], rank[n], i, version[n], n, span))
+            dirty.clear()
+
+            # pop stale entries
+            unaligned_set = set(unaligned)
+            best = None
+            while heap:
+                _, _, _, v, n, span = heapq.heappop(heap)
+                if n in unaligned_set and v == version[n]:
+                    best = n, span
+                    break
+            if best is None:
+                break
+
+            n, span = best
+            new_align = candidates[n][0][span]
+            span = list(span)
+
+            if debug:
+                all_scores = {(n2, span2): candidates[n2][1][span2] for n2 in unaligned for span2 in candidates[n2][1]}
+                candidate_aligns = {(n2, span2): candidates[n2][0][span2] for n2 in unaligned for span2 in candidates[n2][0]}
+                old_alignments = {tuple(align.tokens): align for align in alignments[amr.id]}
+                readable = [(all_scores[(n2,span2)],
+                             list(span2), n2,
+                             ' '.join(amr.lemmas[t] for t in span2),
+                             self.get_alignment_label(amr, candidate_aligns[(n2,span2)]),
+                             self.readable_logp(amr, alignments, candidate_aligns[(n2,span2)]),
+                             self.readable_logp(amr, alignments, old_alignments[span2]) if span2 in old_alignments else None,
+                             ) for n2,span2 in all_scores.keys()]
+                readable = [x for x in sorted(readable, key=lambda y :y[0], reverse=True)]
+                print(end='')
+
+            # add node to alignment
+            touched_nodes = set(new_align.nodes)
+            found = False
+            for i, align in enumerate(alignments[amr.id]):
+                if align.type.startswith('dupl') or align.type.startswith('reentrancy'): continue
+                if align.tokens == span and align.type == new_align.type:
+                    touched_nodes.update(align.nodes)
+                    alignments[amr.id][i] = new_align
+                    found = True
+                    break
+            if not found:
+                alignments[amr.id].append(new_align)
+
+            l1 = len(unaligned)
+            unaligned = self.get_unaligned(amr, alignments)
+            l2 = len(unaligned)
+            if l2 >= l1:
+                raise Exception('Infinite Loop:', amr.id)
+
+            # only rescore candidates that depend on the committed span or nodes
+            touched_span = tuple(span)
+            for n2 in unaligned:
+                deps = dependencies.get(n2)
+                if deps is None:
+                    dirty.add(n2)
+                    continue
+                spans, nodes = deps
+                if touched_span in spans or not touched_nodes.isdisjoint(nodes):
+                    dirty.add(n2)
+
+        amr.alignments = alignments[amr.id]
+        self.postprocess_alignments(amr, alignments)
+
+
+def _align_chunk(state, indices):
+    model, amrs, alignments = state
+    results = []
+    for i in indices:
+        amr = amrs[i]
+        model.align_amr(amr, alignments)
+        aligns = alignments[amr.id]
+        # do not send a copy of the AMR back with each alignment
+        for align in aligns:
+            align.amr = None
+        results.append((i, aligns))
+    return results
@@ -0,0 +1,354 @@
+from collections import Counter
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+
+class Labels:
+    # Interned labels, stored as one '\0' separated utf8 string and decoded on first use.
+
+    def __init__(self, data):
+        self._data = data
+        self._labels = None
+
+    def __getitem__(self, i):
+        if self._labels is None:
+            data = bytes(self._data).decode('utf8')
+            self._labels = data.split('\0') if data else []
+        return self._labels[i]
+
+
+class Count_Table(MutableMapping):
+    # A count table (Counter, defaultdict or dict from labels to numbers) backed by arrays of
+    # label ids and values. The table is only built when it is first used, and missing labels
+    # return default (as in a Counter), or raise a KeyError if default is None.
+    # Tables with an int default are Counters: update() and + add up counts, and most_common() works.
+    # With labels=None, the keys are the label ids themselves.
+
+    def __init__(self, labels, keys, values, default=None):
+        self.labels = labels
+        self.keys_ = keys
+        self.values_ = values
+        self.default = default
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            keys = self.keys_.tolist()
+            if self.labels is not None:
+                keys = [self.labels[k] for k in keys]
+            data = dict(zip(keys, self.values_.tolist()))
+            self._data = Counter(data) if isinstance(self.default, int) else data
+            self.keys_ = self.values_ = None
+        return self._data
+
+    def __getitem__(self, key):
+        data = self._load()
+        if key in data:
+            return data[key]
+        if self.default is None:
+            raise KeyError(key)
+        return self.default
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __delitem__(self, key):
+        del self._load()[key]
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        if self._data is None:
+            return len(self.keys_)
+        return len(self._data)
+
+    def update(self, *args, **kwargs):
+        # as the table's type does it: a Counter adds to its counts, a dict replaces values
+        self._load().update(*args, **kwargs)
+
+    def most_common(self, n=None):
+        return self._load().most_common(n)
+
+    def __add__(self, other):
+        return self._load() + other
+
+    def __radd__(self, other):
+        return other + self._load()
+
+    def __repr__(self):
+        return f'Count_Table({self._load()!r})'
+
+
+class Nested_Count_Table(MutableMapping):
+    # A dict from labels to count tables, stored as one CSR style table:
+    # row i has inner labels inner_keys[offsets[i]:offsets[i+1]] with the matching values.
+    # Rows are only turned into Count_Tables when they are looked up.
+
+    def __init__(self, labels, keys, offsets, inner_keys, values, inner_default=None, inner_labels=None):
+        self.labels = labels
+        self.inner_labels = inner_labels
+        self.keys_ = keys
+        self.offsets = offsets
+        self.inner_keys = inner_keys
+        self.values_ = values
+        self.inner_default = inner_default
+        self._rows = None
+        self._data = {}
+
+    def _load_rows(self):
+        if self._rows is None:
+            keys = self.keys_.tolist()
+            if self.labels is not None:
+                keys = [self.labels[k] for k in keys]
+            self._rows = {k: i for i, k in enumerate(keys)}
+        return self._rows
+
+    def __getitem__(self, key):
+        if key in self._data:
+            return self._data[key]
+        i = self._load_rows()[key]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        table = Count_Table(self.inner_labels, self.inner_keys[start:end], self.values_[start:end], self.inner_default)
+        self._data[key] = table
+        return table
+
+    def __setitem__(self, key, value):
+        self._load_rows()
+        if key not in self._rows:
+            self._rows[key] = None
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._load_rows()[key]
+        self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._load_rows()
+
+    def __iter__(self):
+        return iter(self._load_rows())
+
+    def __len__(self):
+        return len(self._load_rows())
+
+    def __repr__(self):
+        return f'Nested_Count_Table({dict(self.items())!r})'
+
+
+def incidence_matrix(label_lists):
+    # Sparse binary (rows x labels) matrix with an entry for each label in label_lists[i], and the label
+    # id of each column. Repeated labels are kept as separate entries, so sums over them add up
+    # in the same order as a loop over label_lists would.
+    from scipy.sparse import csr_matrix
+
+    offsets = np.zeros(len(label_lists)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(labels) for labels in label_lists])
+    labels = np.fromiter((label for labels in label_lists for label in labels), dtype=np.int64, count=int(offsets[-1]))
+    label_ids, columns = np.unique(labels, return_inverse=True)
+    matrix = csr_matrix((np.ones(len(columns), dtype=np.int64), columns.ravel(), offsets),
+                        shape=(len(label_lists), len(label_ids)))
+    return matrix, label_ids
+
+
+def weighted(matrix, row_weights):
+    # the matrix with row i scaled by row_weights[i]
+    matrix = matrix.astype(np.float64)
+    matrix.data = np.repeat(np.asarray(row_weights, dtype=np.float64), np.diff(matrix.indptr))
+    return matrix
+
+
+def column_sums(matrix, label_ids):
+    # {label id: sum of the column}, added up row by row
+    sums = np.bincount(matrix.indices, weights=matrix.data, minlength=len(label_ids))
+    if matrix.dtype.kind == 'i':
+        sums = sums.astype(np.int64)
+    return dict(zip(label_ids.tolist(), sums.tolist()))
+
+
+def nested_table_from_matrix(matrix, row_ids, column_ids, inner_default=0):
+    # sparse (rows x columns) matrix as a Nested_Count_Table keyed by row and column label ids
+    matrix = matrix.tocsr()
+    matrix.sum_duplicates()
+    return Nested_Count_Table(None, row_ids.astype(np.int32), matrix.indptr.astype(np.int64),
+                              column_ids[matrix.indices].astype(np.int32), matrix.data, inner_default=inner_default)
+
+
+def merge_counts(counts, other):
+    # Add up partial counts: dicts of named tables, where a table is a Counter, a dict of
+    # Counters keyed by label id, a count, or a sufficient statistic with a merge() method
+    if isinstance(counts, dict):
+        for k, v in other.items():
+            counts[k] = merge_counts(counts[k], v) if k in counts else v
+        return counts
+    if hasattr(counts, 'merge'):
+        return counts.merge(other)
+    return counts + other
+
+
+def scale_counts(counts, weight):
+    # partial counts multiplied by weight
+    if isinstance(counts, dict):
+        table = type(counts)()
+        for k, v in counts.items():
+            table[k] = scale_counts(v, weight)
+        return table
+    if hasattr(counts, 'scale'):
+        return counts.scale(weight)
+    return counts * weight
+
+
+def table_total(table):
+    # sum of the counts of a table
+    if isinstance(table, Stepwise_Table):
+        return table.total()
+    return sum(table[k] for k in table)
+
+
+def nested_total(table):
+    # sum of the counts of a dict of tables
+    if isinstance(table, Stepwise_Table):
+        return table.inner_total()
+    return sum(table[k1][k2] for k1 in table for k2 in table[k1])
+
+
+def nested_size(table):
+    # number of counts in a dict of tables
+    if isinstance(table, Stepwise_Table):
+        return table.inner_size
+    return sum(len(table[k]) for k in table)
+
+
+class Stepwise_Counts:
+    # Running counts for stepwise EM (Liang and Klein, 2009): after each mini-batch,
+    # counts = (1-rate)*counts + rate*batch_counts, with rate = (step+1)**-decay (0.5 < decay <= 1).
+    # The counts are kept in Stepwise_Tables divided by a common scale, so that a step only adds to the
+    # entries of the batch. counts() returns the running tables themselves, which the model's
+    # set_parameters() takes as its parameter tables, so a step costs as much as the batch.
+
+    def __init__(self, decay=0.7):
+        self.decay = decay
+        self.step = 0
+        self.scale = [1.]
+        self._counts = Stepwise_Table(self.scale)
+
+    def update(self, counts, weight=1.):
+        # weight scales the counts of a batch to the size of the corpus
+        rate = (self.step+1) ** -self.decay
+        self.step += 1
+        if rate >= 1:
+            self.scale = [1.]
+            self._counts = Stepwise_Table(self.scale)
+        else:
+            self.scale[0] *= 1-rate
+        if self.scale[0] < 1e-100:
+            self._counts.rescale(self.scale[0])
+            self.scale[0] = 1.
+        self._counts.add_scaled(counts, rate*weight/self.scale[0])
+
+    def counts(self):
+        return self._counts
+
+
+class Stepwise_Table(MutableMapping):
+    # Running counts of stepwise EM: a dict of counts, of Stepwise_Tables (the rows of a nested table,
+    # or the named tables of a model) or of statistics with scale() and merge() methods. Everything is
+    # stored divided by scale[0], which all tables of a Stepwise_Counts share, and is multiplied by it
+    # when read. The sum of the counts, and the sum and number of the counts in its rows are kept up
+    # to date, so that totals are found without a pass over the table.
+    # Missing keys return default (as in a Counter), or raise a KeyError if default is None.
+
+    def __init__(self, scale, default=None, parent=None):
+        self.scale = scale
+        self.default = default
+        self.parent = parent
+        self.data = {}
+        self.sum = 0.
+        self.inner_sum = 0.
+        self.inner_size = 0
+
+    def __getitem__(self, key):
+        if key not in self.data:
+            if self.default is None:
+                raise KeyError(key)
+            return self.default
+        value = self.data[key]
+        if isinstance(value, Stepwise_Table):
+            return value
+        if hasattr(value, 'scale'):
+            return value.scale(self.scale[0])
+        return value*self.scale[0]
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            del self[key]
+        self._add(key, value/self.scale[0])
+
+    def __delitem__(self, key):
+        value = self.data.pop(key)
+        if isinstance(value, Stepwise_Table):
+            self.inner_sum -= value.sum
+            self.inner_size -= len(value.data)
+        elif not hasattr(value, 'scale'):
+            self.sum -= value
+            if self.parent is not None:
+                self.parent.inner_sum -= value
+                self.parent.inner_size -= 1
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def total(self):
+        return self.sum*self.scale[0]
+
+    def inner_total(self):
+        return self.inner_sum*self.scale[0]
+
+    def _add(self, key, value):
+        if key in self.data:
+            self.data[key] += value
+        else:
+            self.data[key] = value
+            if self.parent is not None:
+                self.parent.inner_size += 1
+        self.sum += value
+        if self.parent is not None:
+            self.parent.inner_sum += value
+
+    def add_scaled(self, counts, weight):
+        # add counts (as in merge_counts()) multiplied by weight
+        for k, v in counts.items():
+            if isinstance(v, Mapping):
+                if k not in self.data:
+                    default = 0 if isinstance(v, Counter) else None
+                    self.data[k] = Stepwise_Table(self.scale, default, parent=self)
+                self.data[k].add_scaled(v, weight)
+            elif hasattr(v, 'scale'):
+                self.data[k] = self.data[k].merge(v.scale(weight)) if k in self.data else v.scale(weight)
+            else:
+                self._add(k, v*weight)
+
+    def rescale(self, weight):
+        # multiply everything that is stored by weight
+        for k, v in self.data.items():
+            if isinstance(v, Stepwise_Table):
+                v.rescale(weight)
+            elif hasattr(v, 'scale'):
+                self.data[k] = v.scale(weight)
+            else:
+                self.data[k] = v*weight
+        self.sum *= weight
+        self.inner_sum *= weight
+
+    def __repr__(self):
+        return f'Stepwise_Table({dict(self.items())!r})'
@@ -1,6 +1,76 @@
 import math
+from statistics import StatisticsError
 
-from scipy.stats import skellam, norm
+import numpy as np
+
+# distances are clamped to [-MAX_DIST, MAX_DIST] and probabilities to at least MIN_P
+MAX_DIST = 100
+MIN_P = 1e-6
+
+
+def span_position(amr, tokens):
+    # index in amr.spans of the span starting with tokens, or None if there are no tokens
+    if not tokens:
+        return None
+    positions = getattr(amr, 'span_positions', None)
+    if positions is None:
+        positions = {}
+        for i, span in enumerate(amr.spans):
+            for t in span:
+                positions.setdefault(t, i)
+        amr.span_positions = positions
+    if tokens[0] not in positions:
+        raise Exception('Token not in any span:', amr.id, tokens)
+    return positions[tokens[0]]
+
+
+class Distance_Stats:
+    # Count, mean and sum of squared deviations from the mean (M2) of a sample of distances, updated one
+    # distance at a time (Welford) and merged across shards with the pairwise update of Chan et al.,
+    # which unlike raw sums of squares does not cancel when the variance is small next to the mean.
+    # Distances need not be integers (Gaussian_Distance_Model's are percentages of the sentence).
+
+    def __init__(self):
+        self.n = 0.
+        self.average = 0.
+        self.m2 = 0.
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.average
+        self.average += delta / self.n
+        self.m2 += delta * (x - self.average)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.average, self.m2 = other.n, other.average, other.m2
+            return self
+        n = self.n + other.n
+        delta = other.average - self.average
+        self.average += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        return self
+
+    def scale(self, weight):
+        # the statistics of a sample in which each distance has the given weight
+        stats = Distance_Stats()
+        stats.n = self.n*weight
+        stats.average = self.average
+        stats.m2 = self.m2*weight
+        return stats
+
+    def mean(self):
+        if self.n < 1:
+            raise StatisticsError('mean requires at least one data point')
+        return self.average
+
+    def stdev(self):
+        if self.n < 2:
+            raise StatisticsError('stdev requires at least two data points')
+        return math.sqrt(max(self.m2 / (self.n-1), 0.))
 
 
 class Gaussian_Distance_Model:
@@ -9,93 +79,83 @@ class Gaussian_Distance_Model:
 
         self.distance_mean = 0
         self.distance_stdev = 50
-        self._distribution_memo = {}
 
     def update_parameters(self, mean, stdev):
-        self._distribution_memo = {}
         self.distance_mean = mean
         self.distance_stdev = stdev
         if self.distance_stdev <= 0:
             self.distance_stdev = 1
 
     def distance(self, amr, tokens1, tokens2):
-        if not tokens1 or not tokens2:
+        return self.position_distance(amr, span_position(amr, tokens1), span_position(amr, tokens2))
+
+    def position_distance(self, amr, idx1, idx2):
+        if idx1 is None or idx2 is None:
             return self.distance_stdev
-        idx1 = None
-        idx2 = None
-        for i,span in enumerate(amr.spans):
-            if tokens1[0] in span:
-                idx1 = i
-            if tokens2[0] in span:
-                idx2 = i
-            if idx1 is not None and idx2 is not None:
-                break
         return 100*(idx2 - idx1)/len(amr.spans)
 
     def logp(self, dist):
+        # Gaussian log density, computed directly (distances are fractions of the sentence length,
+        # so there is no fixed grid of values to tabulate)
         dist = round(dist, 4)
-        # max_dist = 100
-        # min_dist = -100
-        # if dist>max_dist: dist = max_dist
-        # if dist<min_dist: dist=min_dist
-        if dist in self._distribution_memo:
-            logp = self._distribution_memo[dist]
-        else:
-            p = norm.pdf(dist, loc=self.distance_mean, scale=self.distance_stdev)
-            if p <= 1e-6:
-                p = 1e-6
-            logp = math.log(p)
-            self._distribution_memo[dist] = logp
-        return logp
+        z = (dist - self.distance_mean) / self.distance_stdev
+        logp = -0.5*z*z - math.log(self.distance_stdev*math.sqrt(2*math.pi))
+        return max(logp, math.log(MIN_P))
+
+    def batch_logp(self, dists):
+        # logp() of each distance in an array
+        z = (np.round(np.asarray(dists, dtype=float), 4) - self.distance_mean) / self.distance_stdev
+        logp = -0.5*z*z - math.log(self.distance_stdev*math.sqrt(2*math.pi))
+        return np.maximum(logp, math.log(MIN_P))
 
 
 class Skellam_Distance_Model:
+    # log pmf of each distance in [-MAX_DIST, MAX_DIST], computed whenever the parameters change
+    _logp_table = None
+    _logp_array = None
 
     def __init__(self, mean=0, stdev=10):
 
         self.distance_mean = mean
         self.distance_stdev = stdev
-        self._distribution_memo = {}
         self.mu2 = (self.distance_stdev ** 2 - self.distance_mean) / 2
         self.mu1 = self.distance_mean + self.mu2
 
     def update_parameters(self, mean, stdev):
-        self._distribution_memo = {}
         self.distance_mean = mean
         self.distance_stdev = stdev
         if self.distance_stdev <= 0:
             self.distance_stdev = 1
         self.mu2 = (self.distance_stdev ** 2 - self.distance_mean) / 2
         self.mu1 = self.distance_mean + self.mu2
+        self._build_table()
+
+    def _build_table(self):
+        from scipy.stats import skellam
+
+        p = skellam.pmf(np.arange(-MAX_DIST, MAX_DIST+1), mu1=self.mu1, mu2=self.mu2)
+        self._logp_table = [math.log(max(x, MIN_P)) for x in p.tolist()]
+        self._logp_array = np.array(self._logp_table)
 
     def distance(self, amr, tokens1, tokens2):
-        if not tokens1 or not tokens2:
-            return self.distance_stdev
-        idx1 = None
-        idx2 = None
-        for i,span in enumerate(amr.spans):
-            if tokens1[0] in span:
-                idx1 = i
-            if tokens2[0] in span:
-                idx2 = i
-            if idx1 is not None and idx2 is not None:
-                break
+        return self.position_distance(amr, span_position(amr, tokens1), span_position(amr, tokens2))
+
+    def position_distance(self, amr, idx1, idx2):
         if idx1 is None or idx2 is None:
-            raise Exception()
+            return self.distance_stdev
         return idx2 - idx1
 
     def logp(self, dist):
+        if self._logp_table is None:
+            self._build_table()
         dist = int(dist)
-        max_dist = 100
-        min_dist = -100
-        if dist>max_dist: dist = max_dist
-        if dist<min_dist: dist=min_dist
-        if dist in self._distribution_memo:
-            logp = self._distribution_memo[dist]
-        else:
-            p = skellam.pmf(dist, mu1=self.mu1, mu2=self.mu2)
-            if p <= 1e-6:
-                p = 1e-6
-            logp = math.log(p)
-            self._distribution_memo[dist] = logp
-        return logp
+        if dist>MAX_DIST: dist = MAX_DIST
+        if dist<-MAX_DIST: dist = -MAX_DIST
+        return self._logp_table[dist+MAX_DIST]
+
+    def batch_logp(self, dists):
+        # logp() of each distance in an array
+        if self._logp_array is None:
+            self._build_table()
+        dists = np.clip(np.trunc(np.asarray(dists, dtype=float)), -MAX_DIST, MAX_DIST).astype(int)
+        return self._logp_array[dists+MAX_DIST]
@@ -1,15 +1,18 @@
 import math
 from collections import Counter
 
+from models.count_table import incidence_matrix, column_sums, nested_table_from_matrix
+from models.vocab import Vocab, intern_table, intern_nested_table
 from rule_based.relation_rules import normalize_relation
 
 
 class Concept_Edge_Model:
 
-    def __init__(self, mode='subgraph'):
+    def __init__(self, mode='subgraph', vocab=None):
 
         self.alpha = 0.01
         self.mode = mode
+        self.vocab = vocab if vocab is not None else Vocab()
         if mode not in ['subgraph','relation']:
             raise Exception('Unknown Mode:', mode)
 
@@ -27,48 +30,79 @@ class Concept_Edge_Model:
         self.amrs_total = 0
 
         self._inductive_bias = {}
+        self._init_labels = [], [], []
 
 
     def concept_label(self, amr, n):
-        return amr.nodes[n].replace(' ', '_')
+        labels = self.vocab.amr_labels(amr)
+        key = ('concept', n)
+        if key not in labels:
+            labels[key] = self.vocab.id(amr.nodes[n].replace(' ', '_'))
+        return labels[key]
+
+    def source_label(self, amr, n):
+        labels = self.vocab.amr_labels(amr)
+        key = ('source', n)
+        if key not in labels:
+            labels[key] = self.vocab.id(amr.nodes[n].replace(' ', '_').replace('"',''))
+        return labels[key]
 
     def edge_label(self, amr, e):
-        s,r,t = e
-        if self.mode == 'subgraph':
-             return f'({amr.nodes[s]},{r},{amr.nodes[t]})'.replace(' ', '_')
-        else:
-            s,r,t = normalize_relation(e)
-            return r
-
-    def update_parameters(self, amrs):
+        labels = self.vocab.amr_labels(amr)
+        key = ('edge', e) if self.mode == 'subgraph' else ('relation', e)
+        if key not in labels:
+            s,r,t = e
+            if self.mode == 'subgraph':
+                labels[key] = self.vocab.id(f'({amr.nodes[s]},{r},{amr.nodes[t]})'.replace(' ', '_'))
+            else:
+                s,r,t = normalize_relation(e)
+                labels[key] = self.vocab.id(r)
+        return labels[key]
+
+    def intern_labels(self, vocab):
+        # convert the count tables of an older model from label strings to label ids
+        self.vocab = vocab
+        self.concept_translation_count = intern_nested_table(self.concept_translation_count, vocab)
+        self.concept_count = intern_table(self.concept_count, vocab)
+        self.edge_translation_count = intern_nested_table(self.edge_translation_count, vocab)
+        self.edge_count = intern_table(self.edge_count, vocab)
+        self.tokens_count = intern_table(self.tokens_count, vocab)
+        self._inductive_bias = {}
 
+    def read_amrs(self, amrs):
+        # label sets of each AMR for init_params(), which can be read one shard of the corpus at a time
+        token_sets, concept_sets, edge_sets = self._init_labels
         for amr in amrs:
-            # concept stats
-            concepts = [self.concept_label(amr, n) for n in amr.nodes]
-            edges = [self.edge_label(amr, e) for e in amr.edges]
-            all_tokens = [' '.join(amr.lemmas[t] for t in span) for span in amr.spans]
-            for token_label in set(all_tokens):
-                self.tokens_count[token_label]+=1
-                if token_label not in self.concept_translation_count:
-                    self.concept_translation_count[token_label] = Counter()
-                    self.edge_translation_count[token_label] = Counter()
-                for label in set(concepts):
-                    self.concept_translation_count[token_label][label] += 1
-                for label in set(edges):
-                    self.edge_translation_count[token_label][label] += 1
-            for label in set(concepts):
-                self.concept_count[label]+=1
-            for label in set(edges):
-                self.edge_count[label]+=1
-
-        self.amrs_total = len(amrs)
+            token_sets.append({self.vocab.tokens_id(amr, span) for span in amr.spans})
+            concept_sets.append({self.concept_label(amr, n) for n in amr.nodes})
+            edge_sets.append({self.edge_label(amr, e) for e in amr.edges})
+
+    def init_params(self):
+        # Document co-occurrence counts as sparse matrix products:
+        # (token labels x AMRs) * (AMRs x concept labels), and the same for edge labels
+        token_sets, concept_sets, edge_sets = self._init_labels
+        self._init_labels = None
+        tokens, token_ids = incidence_matrix(token_sets)
+        concepts, concept_ids = incidence_matrix(concept_sets)
+        edges, edge_ids = incidence_matrix(edge_sets)
+        tokens_t = tokens.T.tocsr()
+
+        self.concept_translation_count = _add_nested(self.concept_translation_count,
+                                                     nested_table_from_matrix(tokens_t @ concepts, token_ids, concept_ids))
+        self.edge_translation_count = _add_nested(self.edge_translation_count,
+                                                  nested_table_from_matrix(tokens_t @ edges, token_ids, edge_ids))
+        self.tokens_count.update(column_sums(tokens, token_ids))
+        self.concept_count.update(column_sums(concepts, concept_ids))
+        self.edge_count.update(column_sums(edges, edge_ids))
+
+        self.amrs_total = len(token_sets)
 
     def inductive_bias(self, amr, align, align_label):
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         if (token_label, align_label) in self._inductive_bias:
             return self._inductive_bias[(token_label, align_label)]
 
-        pmis = self.inductive_bias_readable(amr, align)
+        pmis = self.pmis(amr, align)
         inductive_bias = sum(pmis.values())
         inductive_bias /= len(pmis)
 
@@ -77,13 +111,17 @@ class Concept_Edge_Model:
 
     def inductive_bias_readable(self, amr, align):
         token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        return {f'{token_label}:{self.vocab.label(label)}': pmi for label, pmi in self.pmis(amr, align).items()}
+
+    def pmis(self, amr, align):
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         if token_label not in self.concept_translation_count:
             self.concept_translation_count[token_label] = Counter()
         amrs_total = self.amrs_total + self.alpha*(self.amrs_total + 1)
 
         token_logp = math.log(self.tokens_count[token_label]+self.alpha) - math.log(amrs_total)
 
-        readable = {}
+        pmis = {}
         if self.mode=='subgraph':
             labels, edge_labels, _, _ = self.get_subgraph_labels(amr, align.nodes)
         else:
@@ -92,7 +130,7 @@ class Concept_Edge_Model:
             label_logp = math.log(self.concept_count[label] + self.alpha) - math.log(amrs_total)
             joint_logp = math.log(self.concept_translation_count[token_label][label] + self.alpha) \
                          - math.log(amrs_total)
-            readable[f'{token_label}:{label}'] = joint_logp - label_logp - token_logp
+            pmis[label] = joint_logp - label_logp - token_logp
         # for edge, source in zip(edge_labels, source_labels):
         #     edge_logp = math.log(self.edge_count[edge] + self.alpha) - math.log(self.edge_total)
         #
@@ -100,7 +138,7 @@ class Concept_Edge_Model:
         #                  - math.log(self.edge_translation_total)
         #     readable[f'{token_label}:{edge}'] = joint_logp - edge_logp - token_logp
         # logp /= len(concept_labels+edge_labels)
-        return readable
+        return pmis
 
     def concept_logp(self, token_label, concept_label):
         if token_label not in self.concept_translation_count:
@@ -128,14 +166,13 @@ class Concept_Edge_Model:
         if not nodes:
             return [], [], [], []
         if len(nodes)==1:
-            concept = amr.nodes[nodes[0]]
-            concept = concept.replace(' ','_')
+            concept = self.concept_label(amr, nodes[0])
             return [concept], [concept], [], []
         edges = [(s, r, t) for s, r, t in amr.edges if s in nodes and t in nodes]
         concept_labels = [self.concept_label(amr, n) for n in nodes]
         edge_labels = [self.edge_label(amr, e) for e in edges]
-        source_labels = [self.concept_label(amr, s).replace('"','') for s, r, t in edges]
-        target_labels = [self.concept_label(amr, t).replace('"','') for s, r, t in edges]
+        source_labels = [self.source_label(amr, s) for s, r, t in edges]
+        target_labels = [self.source_label(amr, t) for s, r, t in edges]
         return concept_labels, edge_labels, source_labels, target_labels
 
     def factorized_logp(self, amr, align):
@@ -147,36 +184,47 @@ class Concept_Edge_Model:
     def factorized_logp_readable(self, amr, align):
         # joint probability of subgraph parts ln( P(n1)*P(edge=(n1,r1,n2))*P(edge=(n1,r2,n3))... )
         if not align: return {}
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         parts = {}
         if self.mode=='relation':
             edge_labels = self.get_relation_labels(amr, align.edges)
             for edge in edge_labels:
-                p = edge
+                p = self.vocab.label(edge)
                 i = 0
                 while p in parts:
                     i += 1
-                    p = f'{edge}:{i}'
+                    p = f'{self.vocab.label(edge)}:{i}'
                 edge_logp = self.edge_conditional_logp(token_label, edge)
                 parts[p] = edge_logp
             return parts
         concept_labels, edge_labels, source_labels, target_labels = self.get_subgraph_labels(amr, align.nodes)
         for label in concept_labels:
             if label in target_labels: continue
-            p = label
+            p = self.vocab.label(label)
             i = 0
             while p in parts:
                 i += 1
-                p = f'{label}:{i}'
+                p = f'{self.vocab.label(label)}:{i}'
             parts[p] = self.concept_logp(token_label, label)
         if not parts:
-            parts[concept_labels[0]] = self.concept_logp(token_label, concept_labels[0])
+            parts[self.vocab.label(concept_labels[0])] = self.concept_logp(token_label, concept_labels[0])
         for edge, source, target in zip(edge_labels, source_labels, target_labels):
-            p = edge
+            p = self.vocab.label(edge)
             i = 0
             while p in parts:
                 i += 1
-                p = f'{edge}:{i}'
+                p = f'{self.vocab.label(edge)}:{i}'
             edge_logp = self.edge_conditional_logp(token_label, edge, source)
             parts[p] = edge_logp
-        return parts
\ No newline at end of file
+        return parts
+
+
+def _add_nested(table, counts):
+    if not table:
+        return counts
+    for k, row in counts.items():
+        if k not in table:
+            table[k] = Counter()
+        for k2, v in row.items():
+            table[k][k2] += v
+    return table
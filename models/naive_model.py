@@ -3,6 +3,10 @@ from collections import Counter, defaultdict
 
 from numpy import random
 
+from models.amr_graph import amr_graph
+from models.count_table import incidence_matrix, weighted, column_sums, nested_table_from_matrix, nested_size, nested_total
+from models.parallel import collect_counts
+from models.vocab import Vocab, intern_table, intern_nested_table
 from rule_based.relation_rules import normalize_relation
 
 
@@ -13,9 +17,10 @@ def sample_random_noise():
 
 class Node_Model:
 
-    def __init__(self, amrs, alpha=0.01):
+    def __init__(self, amrs, alpha=0.01, vocab=None):
 
         self.alpha = alpha
+        self.vocab = vocab if vocab is not None else Vocab()
         self.translation_count = {}
         self.translation_total = 0
         self.concept_count = Counter()
@@ -24,58 +29,85 @@ class Node_Model:
         self.tokens_total = 0
         self.add_noise = False
         self.first_iter = True
-        self.init_params(amrs)
-
-    def init_params(self, amrs):
-        self.tokens_count = defaultdict(lambda: 0.)
-        self.concept_count = defaultdict(lambda: 0.)
+        self._init_labels = [], [], []
+        if amrs is not None:
+            self.read_amrs(amrs)
+            self.init_params()
+
+    def read_amrs(self, amrs):
+        # label sets of each AMR for init_params(), which can be read one shard of the corpus at a time
+        token_sets, concept_sets, weights = self._init_labels
         for amr in amrs:
             tokens = {self.tokens_label(amr, span) for span in amr.spans}
-            nodes = {self.concept_label(amr, n) for n in amr.nodes}
-            for tok in tokens:
-                self.tokens_count[tok] += 1/len(tokens)
-                if tok not in self.translation_count:
-                    self.translation_count[tok] = defaultdict(lambda: 0.)
-                for node in nodes:
-                    self.translation_count[tok][node] += 1/len(tokens)
-            for node in nodes:
-                self.concept_count[node] += 1/len(tokens)
-        self.translation_total = len(amrs)
-        self.concept_total = len(amrs)
-        self.tokens_total = len(amrs)
+            token_sets.append(tokens)
+            concept_sets.append({self.concept_label(amr, n) for n in amr.nodes})
+            weights.append(1/len(tokens) if tokens else 0.)
+
+    def init_params(self):
+        # Each AMR spreads a count of 1 evenly over its token labels, and each token label co-occurs
+        # with every concept of the AMR: (token labels x AMRs) * (AMRs x concepts), as sparse matrices
+        token_sets, concept_sets, weights = self._init_labels
+        self._init_labels = None
+        tokens, token_ids = incidence_matrix(token_sets)
+        concepts, concept_ids = incidence_matrix(concept_sets)
+        tokens = weighted(tokens, weights)
+        self.translation_count = nested_table_from_matrix(tokens.T.tocsr() @ concepts, token_ids, concept_ids,
+                                                          inner_default=0.)
+        self.tokens_count = defaultdict(float, column_sums(tokens, token_ids))
+        self.concept_count = defaultdict(float, column_sums(weighted(concepts, weights), concept_ids))
+        self.translation_total = len(token_sets)
+        self.concept_total = len(token_sets)
+        self.tokens_total = len(token_sets)
 
     def concept_label(self, amr, n):
-        return amr.nodes[n].replace(' ', '_')
+        labels = self.vocab.amr_labels(amr)
+        key = ('concept', n)
+        if key not in labels:
+            labels[key] = self.vocab.id(amr.nodes[n].replace(' ', '_'))
+        return labels[key]
 
     def tokens_label(self, amr, span):
-        return ' '.join(amr.lemmas[t] for t in span)
+        return self.vocab.tokens_id(amr, span)
 
-    def update_parameters(self, amrs, alignments):
+    def intern_labels(self, vocab):
+        # convert the count tables of an older model from label strings to label ids
+        self.vocab = vocab
+        self.translation_count = intern_nested_table(self.translation_count, vocab)
+        self.concept_count = intern_table(self.concept_count, vocab)
+        self.tokens_count = intern_table(self.tokens_count, vocab)
 
-        self.translation_count = {}
-        self.translation_total = 0
-        self.concept_count = Counter()
-        self.concept_total = 0
-        self.tokens_count = Counter()
-        self.tokens_total = 0
+    def update_parameters(self, amrs, alignments, workers=1):
+        self.set_parameters(collect_counts(self, amrs, alignments, workers))
+
+    def count_parameters(self, amrs, alignments):
+        # M-step counts for a shard of the corpus, which can be added up with merge_counts()
+        translation_count = {}
+        concept_count = Counter()
+        tokens_count = Counter()
 
         for amr in amrs:
             for span in amr.spans:
                 token_label = self.tokens_label(amr, span)
-                self.tokens_count[token_label] += 1
+                tokens_count[token_label] += 1
             if amr.id not in alignments:
                 continue
             for align in alignments[amr.id]:
                 if align.type.startswith('dupl'): continue
                 tokens = self.tokens_label(amr, align.tokens)
-                if tokens not in self.translation_count:
-                    self.translation_count[tokens] = Counter()
+                if tokens not in translation_count:
+                    translation_count[tokens] = Counter()
                 nodes = {self.concept_label(amr, n) for n in align.nodes}
                 for n_label in nodes:
-                    self.translation_count[tokens][n_label] += 1
-                    self.concept_count[n_label] += 1
-        self.translation_total = sum(self.translation_count[t][s] for t in self.translation_count for s in self.translation_count[t])
-        self.translation_total += self.alpha * sum(len(self.translation_count[t]) + 1 for t in self.translation_count)
+                    translation_count[tokens][n_label] += 1
+                    concept_count[n_label] += 1
+        return {'translation_count': translation_count, 'concept_count': concept_count, 'tokens_count': tokens_count}
+
+    def set_parameters(self, counts):
+        self.translation_count = counts['translation_count']
+        self.concept_count = counts['concept_count']
+        self.tokens_count = counts['tokens_count']
+        self.translation_total = nested_total(self.translation_count)
+        self.translation_total += self.alpha * (nested_size(self.translation_count) + len(self.translation_count))
         self.concept_total = self.translation_total
         self.tokens_total = self.translation_total
         self.add_noise = False
@@ -105,24 +137,45 @@ class Node_Model:
             n_label = self.concept_label(amr, n)
             joint_logp = self.concept_token_logp(n_label, token_label)
             node_logp = joint_logp - token_logp
-            l = n_label
+            l = self.vocab.label(n_label)
             i = 1
             while l in node_logps:
                 i += 1
-                l = f'{n_label}#{i}'
-            l = f'{token_label} : {l}'
+                l = f'{self.vocab.label(n_label)}#{i}'
+            l = f'{self.vocab.label(token_label)} : {l}'
             node_logps[l] = node_logp
             if node_logps[l]>0:
                 raise Exception('Improper Probability', token_label, l,
                                 f'{self.translation_count[token_label][n_label]}/{self.tokens_count[token_label]}', node_logps[l])
         return node_logps
 
+    def factorized_logps(self, amr, aligns):
+        # the values of factorized_logp() for many alignments, without building their labels
+        alpha = 0.0 if self.first_iter else self.alpha
+        token_logps = {}
+        all_logps = []
+        for align in aligns:
+            if not align:
+                all_logps.append([])
+                continue
+            token_label = self.tokens_label(amr, align.tokens)
+            if token_label not in token_logps:
+                token_logps[token_label] = math.log(self.tokens_count[token_label] + alpha) - math.log(self.tokens_total)
+            token_logp = token_logps[token_label]
+            node_logps = [self.concept_token_logp(self.concept_label(amr, n), token_label) - token_logp
+                          for n in align.nodes]
+            if any(logp>0 for logp in node_logps):
+                raise Exception('Improper Probability', token_label, max(node_logps))
+            all_logps.append(node_logps)
+        return all_logps
+
 
 class Internal_Edge_Model:
 
-    def __init__(self, amrs, alpha=0.01, token_label_f=None):
+    def __init__(self, amrs, alpha=0.01, token_label_f=None, vocab=None):
 
         self.alpha = alpha
+        self.vocab = vocab if vocab is not None else Vocab()
         self.translation_count = {}
         self.translation_total = 0
         self.node_translation_count = {}
@@ -133,80 +186,115 @@ class Internal_Edge_Model:
         self.add_noise = False
         self.first_iter = True
         self.token_label_f = token_label_f
-
-        # init params
-        self.tokens_count = {}
+        self._init_labels = [], [], [], []
+        if amrs is not None:
+            self.read_amrs(amrs)
+            self.init_params()
+
+    def read_amrs(self, amrs):
+        # label sets of each AMR for init_params(), which can be read one shard of the corpus at a time
+        token_sets, edge_lists, node_pair_lists, weights = self._init_labels
         for amr in amrs:
             tokens = {self.tokens_label(amr, span) for span in amr.spans}
             edges = {(self.edge_label(amr, e), self.node_pair_label(amr, e)) for e in amr.edges}
-            for tok in tokens:
-                if tok not in self.tokens_count:
-                    self.tokens_count[tok] = 0
-                self.tokens_count[tok] += 1 / len(tokens)
-                if tok not in self.translation_count:
-                    self.translation_count[tok] = defaultdict(lambda: 0.)
-                    self.node_translation_count[tok] = defaultdict(lambda: 0.)
-                for edge, node_pair in edges:
-                    self.translation_count[tok][edge] += 1 / len(tokens)
-                    self.node_translation_count[tok][node_pair] += 1 / len(tokens)
-            for edge, node_pair in edges:
-                self.edge_count[edge] += 1 / len(tokens)
-        self.translation_total = len(amrs)
-        self.node_translation_total = len(amrs)
-        self.edge_total = len(amrs)
-        self.tokens_total = len(amrs)
+            token_sets.append(tokens)
+            edge_lists.append([edge for edge, node_pair in edges])
+            node_pair_lists.append([node_pair for edge, node_pair in edges])
+            weights.append(1/len(tokens) if tokens else 0.)
+
+    def init_params(self):
+        # as in Node_Model.init_params
+        token_sets, edge_lists, node_pair_lists, weights = self._init_labels
+        self._init_labels = None
+        tokens, token_ids = incidence_matrix(token_sets)
+        edges, edge_ids = incidence_matrix(edge_lists)
+        node_pairs, node_pair_ids = incidence_matrix(node_pair_lists)
+        tokens = weighted(tokens, weights)
+        tokens_t = tokens.T.tocsr()
+        self.translation_count = nested_table_from_matrix(tokens_t @ edges, token_ids, edge_ids, inner_default=0.)
+        self.node_translation_count = nested_table_from_matrix(tokens_t @ node_pairs, token_ids, node_pair_ids,
+                                                               inner_default=0.)
+        self.tokens_count = column_sums(tokens, token_ids)
+        self.edge_count = Counter(column_sums(weighted(edges, weights), edge_ids))
+        self.translation_total = len(token_sets)
+        self.node_translation_total = len(token_sets)
+        self.edge_total = len(token_sets)
+        self.tokens_total = len(token_sets)
 
 
 
     def edge_label(self, amr, e):
-        s,r,t = e
-        return f'({amr.nodes[s]},{r},{amr.nodes[t]})'.replace(' ', '_')
+        labels = self.vocab.amr_labels(amr)
+        key = ('edge', e)
+        if key not in labels:
+            s,r,t = e
+            labels[key] = self.vocab.id(f'({amr.nodes[s]},{r},{amr.nodes[t]})'.replace(' ', '_'))
+        return labels[key]
 
     def tokens_label(self, amr, span):
         if self.token_label_f is not None:
-            return self.token_label_f(amr, span)
-        return ' '.join(amr.lemmas[t] for t in span)
+            return self.vocab.id(self.token_label_f(amr, span))
+        return self.vocab.tokens_id(amr, span)
 
     def node_pair_label(self, amr, e):
-        s,r,t = e
-        return f'({amr.nodes[s]},{amr.nodes[t]})'.replace(' ', '_')
-
-    def update_parameters(self, amrs, alignments):
-
-        self.translation_count = {}
-        self.translation_total = 0
-        self.node_translation_count = {}
-        self.node_translation_total = 0
-        self.edge_count = Counter()
-        self.edge_total = 0
-        self.tokens_count = {}
-        self.tokens_total = 0
+        labels = self.vocab.amr_labels(amr)
+        key = ('node_pair', e)
+        if key not in labels:
+            s,r,t = e
+            labels[key] = self.vocab.id(f'({amr.nodes[s]},{amr.nodes[t]})'.replace(' ', '_'))
+        return labels[key]
+
+    def intern_labels(self, vocab):
+        # convert the count tables of an older model from label strings to label ids
+        self.vocab = vocab
+        self.translation_count = intern_nested_table(self.translation_count, vocab)
+        self.node_translation_count = intern_nested_table(self.node_translation_count, vocab)
+        self.edge_count = intern_table(self.edge_count, vocab)
+        self.tokens_count = intern_table(self.tokens_count, vocab)
+
+    def update_parameters(self, amrs, alignments, workers=1):
+        self.set_parameters(collect_counts(self, amrs, alignments, workers))
+
+    def count_parameters(self, amrs, alignments):
+        # M-step counts for a shard of the corpus, which can be added up with merge_counts()
+        translation_count = {}
+        node_translation_count = {}
+        edge_count = Counter()
+        tokens_count = {}
 
         for amr in amrs:
             for span in amr.spans:
                 token_label = self.tokens_label(amr, span)
-                if token_label not in self.tokens_count:
-                    self.tokens_count[token_label] = 0
-                self.tokens_count[token_label] += 1
+                if token_label not in tokens_count:
+                    tokens_count[token_label] = 0
+                tokens_count[token_label] += 1
             if amr.id not in alignments:
                 continue
             for align in alignments[amr.id]:
                 if align.type.startswith('dupl'): continue
                 tokens = self.tokens_label(amr, align.tokens)
-                if tokens not in self.translation_count:
-                    self.translation_count[tokens] = Counter()
-                    self.node_translation_count[tokens] = Counter()
+                if tokens not in translation_count:
+                    translation_count[tokens] = Counter()
+                    node_translation_count[tokens] = Counter()
                 if len(align.nodes)<=1: continue
                 for e in amr.edges:
                     s,r,t = e
                     if s in align.nodes and t in align.nodes:
                         edge_label = self.edge_label(amr, e)
                         node_pair = self.node_pair_label(amr, e)
-                        self.translation_count[tokens][edge_label] += 1
-                        self.node_translation_count[tokens][node_pair] += 1
-                        self.edge_count[edge_label] += 1
-        self.translation_total = sum(self.translation_count[t][s] for t in self.translation_count for s in self.translation_count[t])
-        self.translation_total += self.alpha * sum(len(self.translation_count[t]) + 1 for t in self.translation_count)
+                        translation_count[tokens][edge_label] += 1
+                        node_translation_count[tokens][node_pair] += 1
+                        edge_count[edge_label] += 1
+        return {'translation_count': translation_count, 'node_translation_count': node_translation_count,
+                'edge_count': edge_count, 'tokens_count': tokens_count}
+
+    def set_parameters(self, counts):
+        self.translation_count = counts['translation_count']
+        self.node_translation_count = counts['node_translation_count']
+        self.edge_count = counts['edge_count']
+        self.tokens_count = counts['tokens_count']
+        self.translation_total = nested_total(self.translation_count)
+        self.translation_total += self.alpha * (nested_size(self.translation_count) + len(self.translation_count))
 
         self.node_translation_total = self.translation_total
         self.edge_total = self.translation_total
@@ -251,27 +339,57 @@ class Internal_Edge_Model:
             s_t_label = self.node_pair_label(amr, e)
             s_t_logp = self.node_pair_logp(s_t_label, token_label) - token_logp
             edge_logp = self.edge_token_logp(e_label, token_label) - token_logp
-            l = e_label
+            l = self.vocab.label(e_label)
             i = 1
             while l in edge_logps:
                 i += 1
-                l = f'{e_label}#{i}'
-            l = f'{token_label} : {l}'
+                l = f'{self.vocab.label(e_label)}#{i}'
+            l = f'{self.vocab.label(token_label)} : {l}'
             edge_logps[l] = edge_logp - s_t_logp
             if edge_logps[l]>0:
                 raise Exception('Improper Probability', token_label, l,
                                 f'{self.translation_count[token_label][e_label]}/{self.tokens_count[token_label]}', edge_logps[l])
         return edge_logps
 
+    def factorized_logps(self, amr, aligns):
+        # the values of factorized_logp() for many alignments, without building their labels
+        alpha = 0.0 if self.first_iter else self.alpha
+        graph = amr_graph(amr)
+        token_logps = {}
+        all_logps = []
+        for align in aligns:
+            if len(align.nodes)<=1:
+                all_logps.append([])
+                continue
+            token_label = self.tokens_label(amr, align.tokens)
+            if token_label not in token_logps:
+                if token_label not in self.tokens_count:
+                    self.tokens_count[token_label] = 0
+                token_logps[token_label] = math.log(self.tokens_count[token_label] + alpha) - math.log(self.tokens_total)
+            token_logp = token_logps[token_label]
+            edge_logps = []
+            for e in graph.subgraph_edges(align.nodes):
+                s_t_logp = self.node_pair_logp(self.node_pair_label(amr, e), token_label) - token_logp
+                edge_logp = self.edge_token_logp(self.edge_label(amr, e), token_label) - token_logp
+                edge_logps.append(edge_logp - s_t_logp)
+            if any(logp>0 for logp in edge_logps):
+                raise Exception('Improper Probability', token_label, max(edge_logps))
+            all_logps.append(edge_logps)
+        return all_logps
+
 
 class External_Edge_Model(Internal_Edge_Model):
 
-    def __init__(self, amrs, alpha=0.01):
-        super().__init__(amrs, alpha)
+    def __init__(self, amrs, alpha=0.01, vocab=None):
+        super().__init__(amrs, alpha, vocab=vocab)
 
     def edge_label(self, amr, e):
-        s,r,t = normalize_relation(e)
-        return r
+        labels = self.vocab.amr_labels(amr)
+        key = ('relation', e)
+        if key not in labels:
+            s,r,t = normalize_relation(e)
+            labels[key] = self.vocab.id(r)
+        return labels[key]
 
     def factorized_logp(self, amr, align):
         token_label = self.tokens_label(amr, align.tokens)
@@ -283,14 +401,27 @@ class External_Edge_Model(Internal_Edge_Model):
         for s, r, t in edges:
             e_label = self.edge_label(amr, (s, r, t))
             edge_logp = self.edge_token_logp(e_label, token_label) - token_logp
-            l = e_label
+            l = self.vocab.label(e_label)
             i = 0
             while l in edge_logps:
                 i += 1
-                l = f'{e_label}#{i}'
-            l = f'{token_label} : {l}'
+                l = f'{self.vocab.label(e_label)}#{i}'
+            l = f'{self.vocab.label(token_label)} : {l}'
             edge_logps[l] = edge_logp
         return edge_logps
 
+    def factorized_logps(self, amr, aligns):
+        # the values of factorized_logp() for many alignments, without building their labels
+        graph = amr_graph(amr)
+        all_logps = []
+        for align in aligns:
+            token_label = self.tokens_label(amr, align.tokens)
+            if token_label not in self.tokens_count:
+                self.tokens_count[token_label] = 0
+            token_logp = math.log(self.tokens_count[token_label] + self.alpha) - math.log(self.tokens_total)
+            all_logps.append([self.edge_token_logp(self.edge_label(amr, e), token_label) - token_logp
+                              for e in graph.subgraph_edges(align.nodes)])
+        return all_logps
+
 
 
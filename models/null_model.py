@@ -3,12 +3,14 @@ import math
 
 class Null_Model:
 
-    def __init__(self, tokens_count, tokens_total, alpha):
+    def __init__(self, tokens_count, tokens_total, alpha, vocab):
 
         self.alpha = alpha
+        self.vocab = vocab
         self.tokens_count = tokens_count
         self.tokens_total = tokens_total
         self.tokens_rank = {t: i + 1 for i, t in enumerate(sorted(self.tokens_count, key=lambda x: self.tokens_count[x], reverse=True))}
+        self._smoothing = None
 
         self.null_logp = 0
         for token_label in self.tokens_count:
@@ -31,7 +33,8 @@ class Null_Model:
         logp = max(self.rank_logp(token_label), math.log(0.01))
 
         # punctuation
-        if not token_label[0].isalpha() and not token_label[0].isdigit():
+        first_char = self.vocab.label(token_label)[0]
+        if not first_char.isalpha() and not first_char.isdigit():
             return math.log(0.5)
         # coreference
         for spans in amr.coref:
@@ -47,14 +50,24 @@ class Null_Model:
 
         # repetition
         for span in amr.spans:
-            if span[0] < token_idx and ' '.join(amr.lemmas[t] for t in span) == token_label:
+            if span[0] < token_idx and self.vocab.tokens_id(amr, span) == token_label:
                 if math.log(0.1)>logp:
                     return math.log(0.1)
         return logp
 
+    def intern_labels(self, tokens_count, vocab):
+        # convert the tables of an older model from label strings to label ids
+        self.vocab = vocab
+        self.tokens_count = tokens_count
+        self.tokens_rank = {vocab.id(t): rank for t, rank in self.tokens_rank.items()}
+        self._smoothing = None
+
     def smoothing(self):
-        total = 0
-        for tok, rank in self.tokens_rank.items():
-            p = 1 / math.sqrt(rank)
-            total += p*self.tokens_count[tok]
-        return total
+        # only depends on the token counts of the corpus, so it is computed once
+        if getattr(self, '_smoothing', None) is None:
+            total = 0
+            for tok, rank in self.tokens_rank.items():
+                p = 1 / math.sqrt(rank)
+                total += p*self.tokens_count[tok]
+            self._smoothing = total
+        return self._smoothing
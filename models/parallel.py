@@ -0,0 +1,104 @@
+import multiprocessing
+from collections import deque
+
+from models.count_table import merge_counts
+from models.vocab import remap_labels
+
+# state shared with forked worker processes (copy-on-write)
+_shared_state = None
+
+
+def can_fork():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def chunk_by_cost(items, cost, num_chunks):
+    # Split items into chunks of roughly equal total cost.
+    # The most expensive items come first so that long AMRs do not end up in the last chunk.
+    items = sorted(items, key=cost, reverse=True)
+    if not items:
+        return []
+    target = sum(cost(x) for x in items) / max(num_chunks, 1)
+    chunks = [[]]
+    chunk_cost = 0
+    for x in items:
+        if chunks[-1] and chunk_cost + cost(x) > target:
+            chunks.append([])
+            chunk_cost = 0
+        chunks[-1].append(x)
+        chunk_cost += cost(x)
+    return chunks
+
+
+def _call(args):
+    f, chunk = args
+    return f(_shared_state, chunk)
+
+
+def fork_map(f, chunks, state, workers):
+    # Yield f(state, chunk) for each chunk, in completion order.
+    # Workers are forked after state is set, so large read-only objects (models, AMRs) are not pickled.
+    global _shared_state
+    if workers <= 1 or not can_fork():
+        for chunk in chunks:
+            yield f(state, chunk)
+        return
+    _shared_state = state
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(workers) as pool:
+            for result in pool.imap_unordered(_call, [(f, chunk) for chunk in chunks]):
+                yield result
+    finally:
+        _shared_state = None
+
+
+def fork_imap(f, items, state, workers, max_pending=None):
+    # Yield f(state, item) for each item, in order.
+    # Items are only read from the iterable as results are consumed, at most max_pending at a time,
+    # so items can be produced lazily (e.g. batches read from a large file).
+    global _shared_state
+    if workers <= 1 or not can_fork():
+        for item in items:
+            yield f(state, item)
+        return
+    if max_pending is None:
+        max_pending = 2 * workers
+    _shared_state = state
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(workers) as pool:
+            pending = deque()
+            for item in items:
+                pending.append(pool.apply_async(_call, ((f, item),)))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+    finally:
+        _shared_state = None
+
+
+def _count_chunk(state, chunk):
+    model, amrs, alignments, first_id = state
+    k, indices = chunk
+    counts = model.count_parameters([amrs[i] for i in indices], alignments)
+    # labels added to this worker's copy of the vocab (by this or earlier shards)
+    labels = [model.vocab.label(i) for i in range(first_id, len(model.vocab.ids))]
+    return k, first_id, labels, counts
+
+
+def collect_counts(model, amrs, alignments, workers=1):
+    # Map-reduce for the M-step: model.count_parameters() is run on shards of the corpus in forked
+    # workers and the partial counts are added up. Labels first seen in a worker get new ids in the
+    # worker's copy of the vocab, so they are looked up again in model.vocab, in shard order.
+    if workers <= 1 or not can_fork():
+        return model.count_parameters(amrs, alignments)
+    cost = lambda i: len(amrs[i].nodes) + len(amrs[i].edges) + len(amrs[i].spans) + 1
+    chunks = list(enumerate(chunk_by_cost(range(len(amrs)), cost, workers * 4)))
+    state = (model, amrs, alignments, len(model.vocab.ids))
+    counts = {}
+    for k, first_id, labels, partial in sorted(fork_map(_count_chunk, chunks, state, workers), key=lambda x: x[0]):
+        ids = {first_id+i: model.vocab.id(label) for i, label in enumerate(labels)}
+        counts = merge_counts(counts, remap_labels(partial, ids))
+    return counts
@@ -0,0 +1,207 @@
+import importlib
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+
+import numpy as np
+
+from models.array_file import save_arrays, load_arrays
+from models.count_table import Labels, Count_Table, Nested_Count_Table, Stepwise_Table
+from models.vocab import Vocab, Label_Index, label_index_arrays
+
+# Compact model file: only model parameters are saved. Count tables are stored as arrays of
+# interned label ids and values, which are memory-mapped when the model is loaded.
+# Count tables keyed by the model's own label ids (see models/vocab.py) are stored with those ids,
+# and the vocab itself as a Label_Index, which looks labels up without building a dict.
+FORMAT = 'leamr-params'
+VERSION = 3
+
+# attributes that are not parameters: memos and the alignments of the training corpus
+TRANSIENT_ATTRS = {'subgraph_alignments', 'relation_alignments'}
+
+
+def is_transient(name):
+    return name in TRANSIENT_ATTRS or name.startswith('_') or name.endswith('_')
+
+
+def save_params(file, model):
+    encoder = _Encoder()
+    root = encoder.encode(model, 'model')
+    arrays = encoder.arrays
+    arrays['labels'] = np.frombuffer('\0'.join(encoder.labels).encode('utf8'), dtype=np.uint8)
+    save_arrays(file, {'format': FORMAT, 'version': VERSION, 'model': root}, arrays)
+
+
+def load_params(file, mmap=True):
+    header, arrays = load_arrays(file, mmap=mmap)
+    if header.get('format') != FORMAT:
+        raise Exception('Unknown model file format:', header.get('format'))
+    if header['version'] > VERSION:
+        raise Exception(f'Model file version {header["version"]} is newer than supported version {VERSION}')
+    decoder = _Decoder(Labels(arrays['labels']), arrays)
+    return decoder.decode(header['model'])
+
+
+def _table_type(table):
+    if isinstance(table, Counter):
+        return 'Counter'
+    if isinstance(table, defaultdict):
+        return 'defaultdict'
+    if isinstance(table, (Count_Table, Stepwise_Table)) and table.default is not None:
+        return 'Counter' if isinstance(table.default, int) else 'defaultdict'
+    return 'dict'
+
+
+def _is_number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def _key_type(keys):
+    # 'str' or 'int' if all keys are label strings or all are label ids
+    types = {type(k) for k in keys}
+    if types <= {str}:
+        return 'str'
+    if types == {int}:
+        return 'int'
+    return None
+
+
+def _is_count_table(x):
+    return isinstance(x, Mapping) and _key_type(x.keys()) is not None and all(_is_number(v) for v in x.values())
+
+
+def _is_nested_count_table(x):
+    if not isinstance(x, Mapping) or not x or _key_type(x.keys()) is None \
+            or not all(_is_count_table(v) for v in x.values()):
+        return False
+    return len({_table_type(v) for v in x.values()}) == 1 and _key_type([k for v in x.values() for k in v]) is not None
+
+
+class _Encoder:
+
+    def __init__(self):
+        self.labels = []
+        self.label_ids = {}
+        self.arrays = {}
+        self.shared = {}
+
+    def keys_array(self, labels):
+        if _key_type(labels) == 'int':
+            return np.array(labels, dtype=np.int32)
+        return self.intern(labels)
+
+    def intern(self, labels):
+        ids = []
+        for label in labels:
+            if label not in self.label_ids:
+                self.label_ids[label] = len(self.labels)
+                self.labels.append(label)
+            ids.append(self.label_ids[label])
+        return np.array(ids, dtype=np.int32)
+
+    def values_array(self, values):
+        if all(isinstance(v, int) for v in values):
+            if all(-2**31 <= v < 2**31 for v in values):
+                return np.array(values, dtype=np.int32)
+            return np.array(values, dtype=np.int64)
+        return np.array(values, dtype=np.float64)
+
+    def encode(self, x, path):
+        if x is None or isinstance(x, (bool, int, float, str)):
+            return x
+        # objects and tables referenced from more than one place are saved once
+        if id(x) in self.shared:
+            return {'ref': self.shared[id(x)]}
+        self.shared[id(x)] = path
+        if isinstance(x, Vocab):
+            data, offsets, order = label_index_arrays([x.label(i) for i in range(len(x.ids))])
+            self.arrays[path + '.labels'] = data
+            self.arrays[path + '.offsets'] = offsets
+            self.arrays[path + '.order'] = order
+            return {'id': path, 'vocab': len(x.ids)}
+        if isinstance(x, Nested_Count_Table) or (not isinstance(x, Count_Table) and _is_nested_count_table(x)):
+            return self.encode_nested_table(x, path)
+        if _is_count_table(x):
+            self.arrays[path + '.keys'] = self.keys_array(list(x.keys()))
+            self.arrays[path + '.values'] = self.values_array(list(x.values()))
+            return {'id': path, 'table': _table_type(x), 'keys': _key_type(x.keys())}
+        if isinstance(x, (list, tuple)):
+            return {'id': path, type(x).__name__: [self.encode(v, f'{path}[{i}]') for i, v in enumerate(x)]}
+        if isinstance(x, dict) and all(isinstance(k, str) for k in x):
+            return {'id': path, 'dict': {k: self.encode(v, f'{path}[{k}]') for k, v in x.items()}}
+        if hasattr(x, '__dict__') and not callable(x):
+            attrs = {}
+            transient = {}
+            for name, v in vars(x).items():
+                if is_transient(name):
+                    transient[name] = type(v).__name__ if isinstance(v, dict) else None
+                else:
+                    attrs[name] = self.encode(v, f'{path}.{name}')
+            return {'id': path, 'object': f'{type(x).__module__}.{type(x).__name__}',
+                    'attrs': attrs, 'transient': transient}
+        raise Exception(f'Cannot save model parameter {path} of type {type(x).__name__}')
+
+    def encode_nested_table(self, x, path):
+        keys = list(x.keys())
+        rows = [x[k] for k in keys]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(row) for row in rows])
+        inner_keys = [k for row in rows for k in row.keys()]
+        self.arrays[path + '.keys'] = self.keys_array(keys)
+        self.arrays[path + '.offsets'] = offsets
+        self.arrays[path + '.inner_keys'] = self.keys_array(inner_keys)
+        self.arrays[path + '.values'] = self.values_array([v for row in rows for v in row.values()])
+        return {'id': path, 'nested_table': _table_type(rows[0]) if rows else 'Counter',
+                'keys': _key_type(keys), 'inner_keys': _key_type(inner_keys)}
+
+
+class _Decoder:
+
+    def __init__(self, labels, arrays):
+        self.labels = labels
+        self.arrays = arrays
+        self.shared = {}
+
+    def key_labels(self, key_type):
+        # label ids are stored as they are
+        return None if key_type == 'int' else self.labels
+
+    def decode(self, x):
+        if not isinstance(x, dict):
+            return x
+        if 'ref' in x:
+            return self.shared[x['ref']]
+        path = x['id']
+        arrays = self.arrays
+        defaults = {'Counter': 0, 'defaultdict': 0., 'dict': None}
+        if 'table' in x:
+            value = Count_Table(self.key_labels(x.get('keys')), arrays[path + '.keys'], arrays[path + '.values'],
+                                defaults[x['table']])
+        elif 'nested_table' in x:
+            value = Nested_Count_Table(self.key_labels(x.get('keys')), arrays[path + '.keys'], arrays[path + '.offsets'],
+                                       arrays[path + '.inner_keys'], arrays[path + '.values'],
+                                       defaults[x['nested_table']], self.key_labels(x.get('inner_keys')))
+        elif 'vocab' in x:
+            value = Vocab()
+            value.ids = Label_Index(arrays[path + '.labels'], arrays[path + '.offsets'], arrays[path + '.order'])
+            value._labels = None
+        elif 'list' in x:
+            value = []
+            self.shared[path] = value
+            value.extend(self.decode(v) for v in x['list'])
+        elif 'tuple' in x:
+            value = tuple(self.decode(v) for v in x['tuple'])
+        elif 'dict' in x:
+            value = {}
+            self.shared[path] = value
+            value.update((k, self.decode(v)) for k, v in x['dict'].items())
+        else:
+            module, name = x['object'].rsplit('.', 1)
+            cls = getattr(importlib.import_module(module), name)
+            value = cls.__new__(cls)
+            self.shared[path] = value
+            for name, v in x['attrs'].items():
+                setattr(value, name, self.decode(v))
+            for name, kind in x['transient'].items():
+                setattr(value, name, {'Counter': Counter, 'defaultdict': dict}.get(kind, dict)() if kind else None)
+        self.shared[path] = value
+        return value
@@ -0,0 +1,76 @@
+from collections import deque
+
+from models.parallel import fork_imap
+
+STAGES = ['subgraph', 'relation', 'reentrancy']
+
+
+class Alignment_Pipeline:
+    # Runs the subgraph, relation and reentrancy aligners on each batch of AMRs.
+    # The relation and reentrancy models only ever see the upstream alignments of the current batch.
+    # With workers > 1, batches are aligned in a pool of forked worker processes, each of which runs a
+    # batch through all three stages, so that a few batches are aligned at a time.
+
+    def __init__(self, subgraph_model, relation_model, reentrancy_model):
+        self.subgraph_model = subgraph_model
+        self.relation_model = relation_model
+        self.reentrancy_model = reentrancy_model
+
+    def align_stage(self, stage, amrs, upstream):
+        # upstream: alignments of the earlier stages, i.e. (sub_alignments, rel_alignments)[:stage]
+        # each batch is only aligned once, so its initial alignments are not cached
+        if stage == 0:
+            model = self.subgraph_model
+        elif stage == 1:
+            model = self.relation_model
+            model.subgraph_alignments = upstream[0]
+        else:
+            model = self.reentrancy_model
+            model.subgraph_alignments, model.relation_alignments = upstream
+        alignments = model.get_initial_alignments(amrs, verbose=False)
+        alignments = model.align_all(amrs, alignments, verbose=False)
+        if stage > 0:
+            model.subgraph_alignments = None
+        if stage > 1:
+            model.relation_alignments = None
+        return alignments
+
+    def align_batch(self, amrs):
+        alignments = ()
+        for stage in range(len(STAGES)):
+            alignments += (self.align_stage(stage, amrs, alignments),)
+        return alignments
+
+    def align_batches(self, batches, workers=1):
+        # Yield (amrs, (sub_alignments, rel_alignments, reent_alignments)) for each batch, in order.
+        # batches may be a generator; only a few batches are read ahead of the results.
+        if workers <= 1:
+            for amrs in batches:
+                yield amrs, self.align_batch(amrs)
+            return
+        read = deque()
+
+        def read_batches():
+            for amrs in batches:
+                read.append(amrs)
+                yield amrs
+
+        for alignments in fork_imap(_align_batch, read_batches(), self, workers):
+            amrs = read.popleft()
+            for aligns in alignments:
+                _link_alignments(amrs, aligns)
+            yield amrs, alignments
+
+
+def _link_alignments(amrs, alignments, linked=True):
+    for amr in amrs:
+        for align in alignments[amr.id]:
+            align.amr = amr if linked else None
+
+
+def _align_batch(pipeline, amrs):
+    alignments = pipeline.align_batch(amrs)
+    # alignments point back to their AMR, which the parent process has its own copy of
+    for aligns in alignments:
+        _link_alignments(amrs, aligns, linked=False)
+    return alignments
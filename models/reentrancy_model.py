@@ -1,12 +1,17 @@
 import math
 from collections import Counter
-from statistics import mean, stdev
 
 from amr_utils.alignments import AMR_Alignment
 
 from evaluate.utils import coverage
+from models.alignment_cache import compact_alignments
+from models.alignment_index import get_alignment, index_alignments
+from models.amr_graph import amr_graph
 from models.base_model import Alignment_Model
-from models.distance_model import Skellam_Distance_Model
+from models.count_table import table_total
+from models.distance_model import Skellam_Distance_Model, Distance_Stats
+from models.parallel import collect_counts
+from models.vocab import intern_table
 
 ENGLISH = True
 
@@ -15,7 +20,7 @@ PRAGMATIC_RATE = 0.01
 class Reentrancy_Model(Alignment_Model):
 
     def __init__(self, amrs, subgraph_alignments, relation_alignments, alpha=1):
-        super().__init__(amrs, alpha)
+        super().__init__(None, alpha)
 
         self.distance_model_parent = Skellam_Distance_Model()
         self.distance_model_child = Skellam_Distance_Model()
@@ -27,25 +32,24 @@ class Reentrancy_Model(Alignment_Model):
         self.edges_total = 0
 
         self.allowed_types_memo_ = None
+        self.read_corpus(amrs)
 
+    def read_amrs(self, amrs):
+        super().read_amrs(amrs)
         edge_labels = set()
         for amr in amrs:
-            parents = {s:[] for s in amr.nodes}
-            children = {t:[] for t in amr.nodes}
+            graph = amr_graph(amr)
             taken_tokens = set()
-            for s,r,t in amr.edges:
-                parents[s].append((s,r,t))
-                children[t].append((s,r,t))
-            for align in subgraph_alignments[amr.id]:
-                token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+            for align in self.subgraph_alignments[amr.id]:
+                token_label = self.vocab.tokens_id(amr, align.tokens)
                 for n in align.nodes:
-                    for e in parents[n]:
+                    for e in graph.children(n):
                         s,r,t = e
                         if t in align.nodes: continue
                         partial_align = AMR_Alignment(type='relation', tokens=align.tokens, edges=[e])
                         edge_label = self.get_alignment_label(amr, partial_align)
                         edge_labels.add(edge_label)
-                    for e in children[n]:
+                    for e in graph.parents(n):
                         s, r, t = e
                         if s in align.nodes: continue
                         partial_align = AMR_Alignment(type='relation', tokens=align.tokens, edges=[e])
@@ -59,9 +63,13 @@ class Reentrancy_Model(Alignment_Model):
                         edges.add(edge_label)
                     taken_tokens.add(token_label)
 
+    def intern_labels(self, vocab):
+        super().intern_labels(vocab)
+        self.edges_count = intern_table(self.edges_count, vocab)
+
     def trans_logp(self, amr, alignments, align):
 
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         align_label = self.get_alignment_label(amr, align)
 
         if not align.edges:
@@ -94,7 +102,7 @@ class Reentrancy_Model(Alignment_Model):
             # lemma = ' '.join(amr.lemmas[t] for t in align.tokens)
             rel = align.edges[0][1]
             label = f'{type}:{rel}'
-        return label
+        return self.vocab.id(label)
 
 
     def distance_logp(self, amr, alignments, align):
@@ -102,8 +110,8 @@ class Reentrancy_Model(Alignment_Model):
         parent_dist = 0
         child_dist = 0
         for s, r, t in align.edges:
-            salign = amr.get_alignment(self.subgraph_alignments, node_id=s)
-            talign = amr.get_alignment(self.subgraph_alignments, node_id=t)
+            salign = get_alignment(amr, self.subgraph_alignments, node_id=s)
+            talign = get_alignment(amr, self.subgraph_alignments, node_id=t)
             if salign:
                 parent_dist = self.distance_model_parent.distance(amr, salign.tokens, align.tokens)
             if talign:
@@ -115,7 +123,8 @@ class Reentrancy_Model(Alignment_Model):
 
     def get_unaligned(self, amr, alignments):
         if not hasattr(amr, 'reentrancies'):
-            amr.reentrancies = [e for e in amr.edges if len([e2 for e2 in amr.edges if e2[-1]==e[-1]])>1]
+            graph = amr_graph(amr)
+            amr.reentrancies = [e for e in amr.edges if graph.num_parents(e[-1])>1]
         unaligned = {e for e in amr.reentrancies}
         for align in alignments[amr.id]:
             # if align.type!='relation': continue
@@ -124,97 +133,123 @@ class Reentrancy_Model(Alignment_Model):
                     unaligned.remove(e)
         return list(unaligned)
 
-    def update_parameters(self, amrs, relation_alignments):
-        super().update_parameters(amrs, relation_alignments)
+    def get_dependencies(self, amr, alignments, e, aligns):
+        # scores only depend on subgraph and relation alignments, which are fixed
+        return set(), set()
 
-        for amr in amrs:
-            if amr.id not in relation_alignments:
-                continue
-            for align in relation_alignments[amr.id]:
-                align_label = self.get_alignment_label(amr, align)
-                self.edges_count[align_label] += 1
+    def update_parameters(self, amrs, relation_alignments, workers=1):
+        index_alignments(amrs, self.subgraph_alignments)
+        self.set_parameters(self.add_earlier_epochs(collect_counts(self, amrs, relation_alignments, workers)))
 
-        self.edges_total = sum(self.edges_count[e] for e in self.edges_count)
-        self.edges_total += self.alpha * len(self.edges_count)
+    def add_earlier_epochs(self, counts):
+        # edges_count adds up over the epochs of batch EM
+        edges_count = Counter(self.edges_count)
+        for align_label, count in counts['edges_count'].items():
+            edges_count[align_label] += count
+        counts['edges_count'] = edges_count
+        return counts
 
-        distances1 = []
-        distances2 = []
+    def count_parameters(self, amrs, relation_alignments):
+        counts = super().count_parameters(amrs, relation_alignments)
 
+        edges_count = Counter()
+        distances1 = Distance_Stats()
+        distances2 = Distance_Stats()
         for amr in amrs:
             if amr.id not in relation_alignments:
                 continue
+            for align in relation_alignments[amr.id]:
+                align_label = self.get_alignment_label(amr, align)
+                edges_count[align_label] += 1
             # distance stats
             for align in relation_alignments[amr.id]:
                 for s, r, t in align.edges:
-                    sa = amr.get_alignment(self.subgraph_alignments, node_id=s)
-                    ta = amr.get_alignment(self.subgraph_alignments, node_id=t)
+                    sa = get_alignment(amr, self.subgraph_alignments, node_id=s)
+                    ta = get_alignment(amr, self.subgraph_alignments, node_id=t)
                     if sa:
                         dist = self.distance_model_parent.distance(amr, sa.tokens, align.tokens)
                         if dist!=0:
-                            distances1.append(dist)
+                            distances1.add(dist)
                     if ta:
                         dist = self.distance_model_parent.distance(amr, ta.tokens, align.tokens)
                         if dist != 0:
-                            distances2.append(dist)
+                            distances2.add(dist)
+        counts['edges_count'] = edges_count
+        counts['distances1'] = distances1
+        counts['distances2'] = distances2
+        return counts
+
+    def set_parameters(self, counts):
+        super().set_parameters(counts)
 
-        distance_mean1 = mean(distances1)
-        distance_stdev1 = stdev(distances1)
-        self.distance_model_parent.update_parameters(distance_mean1, distance_stdev1)
-        distance_mean2 = mean(distances2)
-        distance_stdev2 = stdev(distances2)
-        self.distance_model_child.update_parameters(distance_mean2, distance_stdev2)
+        self.edges_count = counts['edges_count']
+        self.edges_total = table_total(self.edges_count)
+        self.edges_total += self.alpha * len(self.edges_count)
+
+        distances1 = counts['distances1']
+        self.distance_model_parent.update_parameters(distances1.mean(), distances1.stdev())
+        distances2 = counts['distances2']
+        self.distance_model_child.update_parameters(distances2.mean(), distances2.stdev())
 
     def align_primary_edges(self, amr, alignments):
         if not hasattr(amr, 'reentrancies'):
-            amr.reentrancies = [e for e in amr.edges if len([e2 for e2 in amr.edges if e2[-1]==e[-1]])>1]
+            graph = amr_graph(amr)
+            amr.reentrancies = [e for e in amr.edges if graph.num_parents(e[-1])>1]
         ts = {t for s,r,t in amr.reentrancies}
         for t in ts:
             candidates = [e for e in amr.reentrancies if e[-1]==t]
-            talign = amr.get_alignment(self.subgraph_alignments, node_id=t)
-            rel_align = amr.get_alignment(self.relation_alignments, token_id=talign.tokens[0])
+            talign = get_alignment(amr, self.subgraph_alignments, node_id=t)
+            rel_align = get_alignment(amr, self.relation_alignments, token_id=talign.tokens[0])
             if rel_align and any(e in rel_align.edges for e in candidates):
                 span = talign.tokens
                 e = [e for e in candidates if e in rel_align.edges][0]
             else:
                 dists = {}
                 for s,r,t in candidates:
-                    if not amr.get_alignment(self.relation_alignments, edge=(s,r,t)) \
-                            and any(amr.get_alignment(self.relation_alignments, edge=e2)for e2 in candidates):
+                    if not get_alignment(amr, self.relation_alignments, edge=(s,r,t)) \
+                            and any(get_alignment(amr, self.relation_alignments, edge=e2)for e2 in candidates):
                         continue
-                    salign = amr.get_alignment(self.subgraph_alignments, node_id=s)
-                    talign = amr.get_alignment(self.subgraph_alignments, node_id=t)
+                    salign = get_alignment(amr, self.subgraph_alignments, node_id=s)
+                    talign = get_alignment(amr, self.subgraph_alignments, node_id=t)
                     dist = self.distance_model_parent.distance(amr, salign.tokens, talign.tokens)
                     dists[(s,r,t)] = (abs(dist), salign.tokens[0])
                 e = min(dists, key=lambda x:dists[x])
-                ealign = amr.get_alignment(self.relation_alignments, edge=e)
+                ealign = get_alignment(amr, self.relation_alignments, edge=e)
                 span = ealign.tokens
             if not span:
                 continue
             alignments[amr.id].append(AMR_Alignment(type='reentrancy:primary', tokens=span, edges=[e]))
 
-    def get_initial_alignments(self, amrs, preprocess=True):
+    def initial_alignment_inputs(self, amr):
+        return compact_alignments(self.subgraph_alignments[amr.id]), compact_alignments(self.relation_alignments[amr.id])
+
+    def get_initial_alignments(self, amrs, preprocess=True, verbose=True):
 
+        index_alignments(amrs, self.subgraph_alignments)
+        index_alignments(amrs, self.relation_alignments)
         reentrancy_alignments = {}
         for j, amr in enumerate(amrs):
-            print(f'\r{j} / {len(amrs)} preprocessed', end='')
+            if verbose:
+                print(f'\r{j} / {len(amrs)} preprocessed', end='')
             reentrancy_alignments[amr.id] = []
             self.align_primary_edges(amr, reentrancy_alignments)
-        print('\r', end='')
-        print('Preprocessing coverage:', coverage(amrs, reentrancy_alignments, mode='edges'))
+        if verbose:
+            print('\r', end='')
+            print('Preprocessing coverage:', coverage(amrs, reentrancy_alignments, mode='edges'))
         return reentrancy_alignments
 
 
     def readable_logp(self, amr, alignments, align):
         readable = super().readable_logp(amr, alignments, align)
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         tokens_logp = math.log(self.tokens_count[token_label]+self.alpha) - math.log(self.tokens_total)
         dist_logp = self.distance_logp(amr, alignments, align)
 
         trans_logp = self.trans_logp(amr, alignments, align)
         e = align.edges[0]
-        subgraph_align = amr.get_alignment(self.subgraph_alignments, token_id=align.tokens[0])
+        subgraph_align = get_alignment(amr, self.subgraph_alignments, token_id=align.tokens[0])
         readable.update(
-            {'relations':self.get_alignment_label(amr, align),
+            {'relations':self.vocab.label(self.get_alignment_label(amr, align)),
              'source': amr.nodes[e[0]],
              'target': amr.nodes[e[-1]],
              'logP(rels|tokens)':trans_logp,
@@ -227,11 +262,12 @@ class Reentrancy_Model(Alignment_Model):
         if self.allowed_types_memo_ is not None and amr.id==self.allowed_types_memo_[0]:
             return self.allowed_types_memo_[1]
         allowed_types = {}
+        graph = amr_graph(amr)
         for e in amr.reentrancies:
             allowed_types[e] = {}
-            rel_align = amr.get_alignment(self.relation_alignments, edge=e)
-            s_align = amr.get_alignment(self.subgraph_alignments, node_id=e[0])
-            t_align = amr.get_alignment(self.subgraph_alignments, node_id=e[-1])
+            rel_align = get_alignment(amr, self.relation_alignments, edge=e)
+            s_align = get_alignment(amr, self.subgraph_alignments, node_id=e[0])
+            t_align = get_alignment(amr, self.subgraph_alignments, node_id=e[-1])
             neighbors = [(s, r, t) for s, r, t in amr.reentrancies if t == e[-1] and (s, r, t) != e]
 
             for i,span in enumerate(amr.spans):
@@ -241,7 +277,7 @@ class Reentrancy_Model(Alignment_Model):
 
                 span_types = []
                 # coref style alignments
-                sub_align = amr.get_alignment(self.subgraph_alignments, token_id=span[0])
+                sub_align = get_alignment(amr, self.subgraph_alignments, token_id=span[0])
                 if not sub_align:
                     # coref
                     if pos in ['PRP', 'PRP$', 'WP']:
@@ -258,20 +294,20 @@ class Reentrancy_Model(Alignment_Model):
                 # control style alignemnts
                 elif span!=rel_align.tokens:
                     # coordination
-                    grandparents = {s for s, r, t in amr.edges if t == e[0]}
+                    grandparents = set(graph.parent_nodes(e[0]))
                     for e2 in neighbors:
-                        e2_grandparents = {s for s, r, t in amr.edges if t == e2[0]}
+                        e2_grandparents = set(graph.parent_nodes(e2[0]))
                         coord = [n for n in grandparents if amr.nodes[n] in ['and', 'or'] and n in e2_grandparents]
                         for c in coord:
-                            if span == amr.get_alignment(self.subgraph_alignments, node_id=c).tokens:
+                            if span == get_alignment(amr, self.subgraph_alignments, node_id=c).tokens:
                                 span_types.append('coordination')
                     # control
                     content_words = ['VB', 'VBD', 'VBZ', 'VBG', 'VBP', 'VBN', 'NN', 'NNS', 'JJ', 'JJR', 'JJS']
                     if pos in content_words and amr.pos[s_align.tokens[0]] in content_words and span[0] < \
                             s_align.tokens[0]:
                         for e2 in neighbors:
-                            e2_align = amr.get_alignment(self.relation_alignments, edge=e2)
-                            s2_align = amr.get_alignment(self.subgraph_alignments, node_id=e2[0])
+                            e2_align = get_alignment(amr, self.relation_alignments, edge=e2)
+                            s2_align = get_alignment(amr, self.subgraph_alignments, node_id=e2[0])
                             if span == e2_align.tokens and any(s in s2_align.nodes and t in s_align.nodes for s, r, t in e2_align.edges):
                                 span_types.append('control')
                     # adjunct1
@@ -289,11 +325,11 @@ class Reentrancy_Model(Alignment_Model):
                         span_types.append('comparative control')
                     # adjunct2
                     if pos=='VBG':
-                        rel_align = amr.get_alignment(self.relation_alignments, edge=e)
+                        rel_align = get_alignment(amr, self.relation_alignments, edge=e)
                         if span == rel_align.tokens:
                             span_types.append('unmarked adjunct control')
                     # pragmatic
-                    rel_align = amr.get_alignment(self.relation_alignments, edge=e)
+                    rel_align = get_alignment(amr, self.relation_alignments, edge=e)
                     if span==rel_align.tokens:
                         span_types.append('pragmatic')
                 allowed_types[e][tuple(span)] = span_types
@@ -304,9 +340,9 @@ class Reentrancy_Model(Alignment_Model):
         # get candidates
         allowed_types = self.get_allowed_types(amr)
         candidate_spans = [span for span in amr.spans if allowed_types[e][tuple(span)]]
-        # candidate_spans = [span for span in candidate_spans if not amr.get_alignment(reentrancy_alignments, token_id=span[0])]
+        # candidate_spans = [span for span in candidate_spans if not get_alignment(amr, reentrancy_alignments, token_id=span[0])]
         candidate_neighbors = [] #[e]
-        neighbor_aligns = [amr.get_alignment(reentrancy_alignments, edge=(s,r,t)) for s,r,t in amr.reentrancies if t==e[-1] and e!=(s,r,t)]
+        neighbor_aligns = [get_alignment(amr, reentrancy_alignments, edge=(s,r,t)) for s,r,t in amr.reentrancies if t==e[-1] and e!=(s,r,t)]
         # if all(a.type!='reentrancy:primary' for a in neighbor_aligns):
         #     candidate_spans = []
 
@@ -326,7 +362,7 @@ class Reentrancy_Model(Alignment_Model):
         scores2 = {}
         aligns2 = {}
         for i, neighbor in enumerate(candidate_neighbors):
-            rel_align = amr.get_alignment(self.relation_alignments, edge=neighbor)
+            rel_align = get_alignment(amr, self.relation_alignments, edge=neighbor)
             span = rel_align.tokens
             if not span: continue
             if span not in amr.spans:
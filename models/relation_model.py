@@ -1,13 +1,18 @@
 import math
 from collections import Counter
-from statistics import mean, stdev
 
 from amr_utils.alignments import AMR_Alignment
 
+from models.alignment_cache import compact_alignments
+from models.alignment_index import get_alignment, index_alignments, reindex_alignments, Alignment_List
+from models.amr_graph import amr_graph
 from models.base_model import Alignment_Model
-from models.distance_model import Gaussian_Distance_Model, Skellam_Distance_Model
+from models.count_table import table_total
+from models.distance_model import Gaussian_Distance_Model, Skellam_Distance_Model, Distance_Stats
 from models.naive_model import External_Edge_Model
 from models.null_model import Null_Model
+from models.parallel import collect_counts
+from models.vocab import intern_table
 from rule_based.relation_rules import rule_based_anchor_relation, rule_based_align_relations, exact_match_relations, \
     normalize_relation, english_ignore_tokens
 
@@ -17,24 +22,31 @@ PARTIAL_CREDIT_RATE = 0.1
 class Relation_Model(Alignment_Model):
 
     def __init__(self, amrs, subgraph_alignments, alpha=1):
-        super().__init__(amrs, alpha)
+        super().__init__(None, alpha)
 
         self.distance_model_parent = Skellam_Distance_Model(mean=-1, stdev=2.)
         self.distance_model_child = Skellam_Distance_Model(mean=+1, stdev=2.)
-        self.null_model = Null_Model(self.tokens_count, self.tokens_total, self.alpha)
 
         self.subgraph_alignments = subgraph_alignments
 
         self.arg_struct_count = Counter()
         self.arg_struct_total = 0
 
-        self.edge_model = External_Edge_Model(amrs, self.alpha)
+        self.edge_model = External_Edge_Model(None, self.alpha, vocab=self.vocab)
+        self.read_corpus(amrs, [self.edge_model])
+        self.null_model = Null_Model(self.tokens_count, self.tokens_total, self.alpha, self.vocab)
+
+    def intern_labels(self, vocab):
+        super().intern_labels(vocab)
+        self.null_model.intern_labels(self.tokens_count, vocab)
+        self.edge_model.intern_labels(vocab)
+        self.arg_struct_count = intern_table(self.arg_struct_count, vocab)
 
     def trans_logp(self, amr, alignments, align):
 
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         align_label = self.get_alignment_label(amr, align)
-        sub_align = amr.get_alignment(self.subgraph_alignments, token_id=align.tokens[0])
+        sub_align = get_alignment(amr, self.subgraph_alignments, token_id=align.tokens[0])
 
         if not align.edges and not sub_align.nodes:
             return self.null_model.logp(amr, token_label, align.tokens[0])
@@ -53,12 +65,12 @@ class Relation_Model(Alignment_Model):
         return trans_logp + dist_logp
 
     def get_alignment_label(self, amr, align):
-        sub_align = amr.get_alignment(self.subgraph_alignments, token_id=align.tokens[0])
+        sub_align = get_alignment(amr, self.subgraph_alignments, token_id=align.tokens[0])
         if not align.edges:
             if sub_align.nodes:
-                return '<no_args>'
+                return self.vocab.id('<no_args>')
             else:
-                return '<null>'
+                return self.vocab.id('<null>')
         internal_nodes = [n for n in sorted(sub_align.nodes)]
         internal_nodes = {n:f'n{i}' for i,n in enumerate(internal_nodes)}
         new_edges = []
@@ -70,7 +82,7 @@ class Relation_Model(Alignment_Model):
             new_edges.append(f'{s}_{r}_{t}')
         label = [e for e in sorted(new_edges)]
         label = ' '.join(label)
-        return label
+        return self.vocab.id(label)
 
     def distance_logp(self, amr, alignments, align):
 
@@ -78,7 +90,7 @@ class Relation_Model(Alignment_Model):
                     + self.distance_model_child.logp(self.distance_model_child.distance_stdev))/2
 
         external_nodes = []
-        sub_align = amr.get_alignment(self.subgraph_alignments, token_id=align.tokens[0])
+        sub_align = get_alignment(amr, self.subgraph_alignments, token_id=align.tokens[0])
         for s,r,t in align.edges:
             if s not in sub_align.nodes:
                 external_nodes.append(s)
@@ -88,11 +100,12 @@ class Relation_Model(Alignment_Model):
         if not external_nodes:
             return default
 
+        graph = amr_graph(amr)
         parent_dists = []
         child_dists = []
         for s, r, t in align.edges:
-            salign = amr.get_alignment(self.subgraph_alignments, node_id=s)
-            talign = amr.get_alignment(self.subgraph_alignments, node_id=t)
+            salign = get_alignment(amr, self.subgraph_alignments, node_id=s)
+            talign = get_alignment(amr, self.subgraph_alignments, node_id=t)
             if salign:
                 dist = self.distance_model_parent.distance(amr, salign.tokens, align.tokens)
                 if dist!=0:
@@ -100,13 +113,12 @@ class Relation_Model(Alignment_Model):
             if talign:
                 dist = self.distance_model_child.distance(amr, talign.tokens, align.tokens)
                 if dist!=0:
-                    t_parents = [s2 for s2, r2, t2 in amr.edges if t2 == t]
                     # ignore reentrancies
-                    if len(t_parents) > 1:
+                    if graph.num_parents(t) > 1:
                         reentrancy = False
-                        for s2 in t_parents:
+                        for s2 in graph.parent_nodes(t):
                             if s == s2: continue
-                            s2_align = amr.get_alignment(self.subgraph_alignments, node_id=s2)
+                            s2_align = get_alignment(amr, self.subgraph_alignments, node_id=s2)
                             other_dist = self.distance_model_child.distance(amr, talign.tokens, s2_align.tokens)
                             if other_dist <= dist:
                                 reentrancy = True
@@ -145,69 +157,96 @@ class Relation_Model(Alignment_Model):
                     unaligned.remove(e)
         return list(unaligned)
 
-    def update_parameters(self, amrs, relation_alignments):
-        super().update_parameters(amrs, relation_alignments)
-        self.edge_model.update_parameters(amrs, relation_alignments)
-
+    def get_dependencies(self, amr, alignments, e, aligns):
+        # scores only depend on the relation alignments of the candidate spans
+        return {span for span in aligns}, set()
+
+    def update_parameters(self, amrs, relation_alignments, workers=1):
+        index_alignments(amrs, self.subgraph_alignments)
+        self.set_parameters(self.add_earlier_epochs(collect_counts(self, amrs, relation_alignments, workers)))
+
+    def add_earlier_epochs(self, counts):
+        # arg_struct_count adds up over the epochs of batch EM
+        arg_struct_count = Counter(self.arg_struct_count)
+        for align_label, count in counts['arg_struct_count'].items():
+            arg_struct_count[align_label] += count
+        counts['arg_struct_count'] = arg_struct_count
+        return counts
+
+    def count_parameters(self, amrs, relation_alignments):
+        counts = super().count_parameters(amrs, relation_alignments)
+        counts['edge_model'] = self.edge_model.count_parameters(amrs, relation_alignments)
+
+        arg_struct_count = Counter()
+        distances1 = Distance_Stats()
+        distances2 = Distance_Stats()
         for amr in amrs:
             if amr.id not in relation_alignments:
                 continue
             for align in relation_alignments[amr.id]:
                 align_label = self.get_alignment_label(amr, align)
-                self.arg_struct_count[align_label] += 1
-
-        self.arg_struct_total = sum(self.arg_struct_count[e] for e in self.arg_struct_count)
-        self.arg_struct_total += self.alpha * len(self.arg_struct_count)
-
-        distances1 = []
-        distances2 = []
-
-        for amr in amrs:
-            if amr.id not in relation_alignments:
-                continue
+                arg_struct_count[align_label] += 1
             # distance stats
             for align in relation_alignments[amr.id]:
                 for s, r, t in align.edges:
-                    sa = amr.get_alignment(self.subgraph_alignments, node_id=s)
-                    ta = amr.get_alignment(self.subgraph_alignments, node_id=t)
+                    sa = get_alignment(amr, self.subgraph_alignments, node_id=s)
+                    ta = get_alignment(amr, self.subgraph_alignments, node_id=t)
                     if sa:
                         dist = self.distance_model_parent.distance(amr, sa.tokens, align.tokens)
                         if dist!=0:
-                            distances1.append(dist)
+                            distances1.add(dist)
                     if ta:
                         dist = self.distance_model_parent.distance(amr, ta.tokens, align.tokens)
                         if dist != 0:
-                            distances2.append(dist)
+                            distances2.add(dist)
+        counts['arg_struct_count'] = arg_struct_count
+        counts['distances1'] = distances1
+        counts['distances2'] = distances2
+        return counts
+
+    def set_parameters(self, counts):
+        super().set_parameters(counts)
+        self.edge_model.set_parameters(counts['edge_model'])
+
+        self.arg_struct_count = counts['arg_struct_count']
+        self.arg_struct_total = table_total(self.arg_struct_count)
+        self.arg_struct_total += self.alpha * len(self.arg_struct_count)
+
+        distances1 = counts['distances1']
+        self.distance_model_parent.update_parameters(distances1.mean(), distances1.stdev())
+        distances2 = counts['distances2']
+        self.distance_model_child.update_parameters(distances2.mean(), distances2.stdev())
 
-        distance_mean1 = mean(distances1)
-        distance_stdev1 = stdev(distances1)
-        self.distance_model_parent.update_parameters(distance_mean1, distance_stdev1)
-        distance_mean2 = mean(distances2)
-        distance_stdev2 = stdev(distances2)
-        self.distance_model_child.update_parameters(distance_mean2, distance_stdev2)
+    def initial_alignment_inputs(self, amr):
+        return ENGLISH, compact_alignments(self.subgraph_alignments[amr.id])
 
-    def get_initial_alignments(self, amrs, preprocess=True):
+    def get_initial_alignments(self, amrs, preprocess=True, verbose=True):
 
+        index_alignments(amrs, self.subgraph_alignments)
         relation_alignments = {}
         for j, amr in enumerate(amrs):
-            print(f'\r{j} / {len(amrs)} preprocessed', end='')
+            if verbose:
+                print(f'\r{j} / {len(amrs)} preprocessed', end='')
             relation_alignments[amr.id] = []
             for span in amr.spans:
                 relation_alignments[amr.id].append(AMR_Alignment(type='relation', tokens=span, amr=amr))
             rule_based_align_relations(amr, self.subgraph_alignments, relation_alignments)
             exact_match_relations(amr, self.subgraph_alignments, relation_alignments)
-        print('\r', end='')
-        print('Preprocessing coverage:', self.coverage(amrs, relation_alignments))
+        index_alignments(amrs, relation_alignments)
+        if verbose:
+            print('\r', end='')
+            print('Preprocessing coverage:', self.coverage(amrs, relation_alignments))
         return relation_alignments
 
     def coverage(self, amrs, alignments):
         coverage_count = 0
         total = 0
         for amr in amrs:
+            aligns = Alignment_List(alignments[amr.id] if amr.id in alignments else [])
             for e in amr.edges:
-                if amr.get_alignment(self.subgraph_alignments, edge=e):
+                if get_alignment(amr, self.subgraph_alignments, edge=e):
                     continue
-                align = amr.get_alignment(alignments, edge=e)
+                align = aligns.get_alignment(edge=e)
                 if align:
                     coverage_count += 1
                 total += 1
@@ -215,19 +254,19 @@ class Relation_Model(Alignment_Model):
 
     def readable_logp(self, amr, alignments, align):
         readable = super().readable_logp(amr, alignments, align)
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         tokens_logp = math.log(self.tokens_count[token_label]+self.alpha) - math.log(self.tokens_total)
         dist_logp = self.distance_logp(amr, alignments, align)
 
         trans_logp = self.trans_logp(amr, alignments, align)
 
-        subgraph_align = amr.get_alignment(self.subgraph_alignments, token_id=align.tokens[0])
+        subgraph_align = get_alignment(amr, self.subgraph_alignments, token_id=align.tokens[0])
         rel_type = 'source' if any(s in subgraph_align.nodes for s,r,t in align.edges) \
             else 'target' if any(t in subgraph_align.nodes for s,r,t in align.edges) \
             else 'null' if not align.edges \
             else 'function_word'
         readable.update(
-            {'relations':self.get_alignment_label(amr, align),
+            {'relations':self.vocab.label(self.get_alignment_label(amr, align)),
              'logP(rels|tokens)':trans_logp,
              'logP(distance)':dist_logp,
              'rel_type':rel_type,
@@ -238,23 +277,22 @@ class Relation_Model(Alignment_Model):
     def align(self, amr, relation_alignments, e, unaligned=None, return_all=False):
         # get candidates
         candidate_spans = [align.tokens for align in self.subgraph_alignments[amr.id] if not align.nodes]
-        candidate_spans = [span for span in candidate_spans if not amr.get_alignment(relation_alignments, token_id=span[0])]
+        candidate_spans = [span for span in candidate_spans if not get_alignment(amr, relation_alignments, token_id=span[0])]
         candidate_spans = [span for span in candidate_spans if not english_ignore_tokens(amr, span)]
         candidate_neighbors = rule_based_anchor_relation(e)
 
         # only align to prepositions between parent and child
-        parent = amr.get_alignment(self.subgraph_alignments, node_id=e[0])
-        child = amr.get_alignment(self.subgraph_alignments, node_id=e[2])
+        parent = get_alignment(amr, self.subgraph_alignments, node_id=e[0])
+        child = get_alignment(amr, self.subgraph_alignments, node_id=e[2])
         candidate_spans = [span for span in candidate_spans if (parent.tokens[0]<span[0]<child.tokens[0])
                                                             or (child.tokens[0]<span[0]<parent.tokens[0])
                                                             or ' '.join(amr.lemmas[t] for t in span)=='ago']
         # make sure rel alignment does not interfere with child and any of its descendents
         child_descendents = set()
         child_descendents.update(child.tokens)
-        for s,r,t in amr.edges:
-            if s == e[2]:
-                talign = amr.get_alignment(self.subgraph_alignments, node_id=t)
-                child_descendents.update(talign.tokens)
+        for t in amr_graph(amr).child_nodes(e[2]):
+            talign = get_alignment(amr, self.subgraph_alignments, node_id=t)
+            child_descendents.update(talign.tokens)
         if child_descendents:
             start, end = min(child_descendents), max(child_descendents)
             if not (start<=parent.tokens[0]<=end):
@@ -270,12 +308,12 @@ class Relation_Model(Alignment_Model):
         scores2 = {}
         aligns2 = {}
         for i, neighbor in enumerate(candidate_neighbors):
-            sub_align = amr.get_alignment(self.subgraph_alignments, node_id=neighbor)
+            sub_align = get_alignment(amr, self.subgraph_alignments, node_id=neighbor)
             span = sub_align.tokens
             if not span: continue
             if span not in amr.spans:
                 raise Exception('Subgraph Alignment has Faulty Span:', span)
-            replaced_align = amr.get_alignment(relation_alignments, token_id=span[0])
+            replaced_align = get_alignment(amr, relation_alignments, token_id=span[0])
             new_align = AMR_Alignment(type='relation', tokens=replaced_align.tokens, edges=replaced_align.edges+[e], amr=amr)
             scores2[i] = self.logp(amr, relation_alignments, new_align) - self.logp(amr, relation_alignments, replaced_align)
             aligns2[i] = new_align
@@ -305,11 +343,12 @@ class Relation_Model(Alignment_Model):
         return best_align, best_score
 
 
-    def align_all(self, amrs, alignments=None, preprocess=True, debug=False):
-        alignments = super().align_all(amrs, alignments, preprocess, debug)
+    def align_all(self, amrs, alignments=None, preprocess=True, debug=False, workers=1, verbose=True):
+        alignments = super().align_all(amrs, alignments, preprocess, debug, workers, verbose)
 
         for amr in amrs:
+            sub_edges = {e for sub_align in self.subgraph_alignments[amr.id] for e in sub_align.edges}
             for align in alignments[amr.id]:
-                sub_edges = {e for sub_align in self.subgraph_alignments[amr.id] for e in sub_align.edges}
                 align.edges = [e for e in align.edges if e not in sub_edges]
+            reindex_alignments(amr, alignments)
         return alignments
\ No newline at end of file
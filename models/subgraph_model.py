@@ -1,16 +1,18 @@
 import math
 import sys
 
-from statistics import stdev, mean
-
 from amr_utils.alignments import AMR_Alignment
 
 from evaluate.utils import coverage
+from models.alignment_index import get_alignment, reindex_alignments, Alignment_List
+from models.amr_graph import amr_graph
 from models.base_model import Alignment_Model
-from models.distance_model import Gaussian_Distance_Model, Skellam_Distance_Model
+from models.count_table import Stepwise_Table
+from models.distance_model import Gaussian_Distance_Model, Skellam_Distance_Model, Distance_Stats, span_position
 from models.inductive_bias import Concept_Edge_Model
 from models.naive_model import Node_Model, Internal_Edge_Model
 from models.null_model import Null_Model
+from models.parallel import collect_counts
 from rule_based.subgraph_rules import fuzzy_align_subgraphs, postprocess_subgraph, clean_subgraph, clean_alignments, \
     english_is_alignment_forbidden
 
@@ -25,22 +27,28 @@ class Subgraph_Model(Alignment_Model):
     def __init__(self, amrs, alpha=0.1, align_duplicates=True):
         # Do not smooth over subgraphs (since the vocabulary is not finite or fixed)
         # The model uses backoff to a partial credit model instead
-        super().__init__(amrs, alpha=alpha, smooth_translation=True)
+        super().__init__(None, alpha=alpha, smooth_translation=True)
         self.align_duplicates = align_duplicates
 
         self.distance_model = Skellam_Distance_Model()
-        self.null_model = Null_Model(self.tokens_count, self.tokens_total, alpha)
-        self.node_model = Node_Model(amrs, alpha=alpha)
-        self.edge_model = Internal_Edge_Model(amrs, alpha=alpha)
+        self.node_model = Node_Model(None, alpha=alpha, vocab=self.vocab)
+        self.edge_model = Internal_Edge_Model(None, alpha=alpha, vocab=self.vocab)
+        self.concept_edge_model = Concept_Edge_Model(vocab=self.vocab)
+        self.read_corpus(amrs, [self.node_model, self.edge_model, self.concept_edge_model])
+        self.null_model = Null_Model(self.tokens_count, self.tokens_total, alpha, self.vocab)
 
         self.is_initialized = False
         self.num_null_aligned = 0
 
-        self.concept_edge_model = Concept_Edge_Model()
-        self.concept_edge_model.update_parameters(amrs)
+    def intern_labels(self, vocab):
+        super().intern_labels(vocab)
+        self.null_model.intern_labels(self.tokens_count, vocab)
+        self.node_model.intern_labels(vocab)
+        self.edge_model.intern_labels(vocab)
+        self.concept_edge_model.intern_labels(vocab)
 
     def trans_logp(self, amr, align):
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         subgraph_label = self.get_alignment_label(amr, align)
 
         token_logp = math.log(self.tokens_count[token_label]+self.alpha) - math.log(self.tokens_total)
@@ -57,11 +65,12 @@ class Subgraph_Model(Alignment_Model):
             # attested alignment
             trans_logp = math.log(self.translation_count[token_label][subgraph_label] + self.alpha) - math.log(self.translation_total)
             trans_logp -= token_logp
-        elif len(token_label.split())>1 and any(t in self.translation_count and subgraph_label in self.translation_count[t]
-                                                for t in token_label.split()):
+        elif len(self.vocab.label(token_label).split())>1 \
+                and any(t in self.translation_count and subgraph_label in self.translation_count[t]
+                        for t in self.token_parts(token_label)):
             # partial match by token
             max_logp = float('-inf')
-            for tok in token_label.split():
+            for tok in self.token_parts(token_label):
                 if tok not in self.translation_count: continue
                 if self.translation_count[tok][subgraph_label] == 0: continue
                 logp = math.log(self.translation_count[tok][subgraph_label] + self.alpha) - math.log(self.translation_total)
@@ -80,10 +89,18 @@ class Subgraph_Model(Alignment_Model):
 
         return trans_logp
 
+    def token_parts(self, token_label):
+        # label ids of the words of a token label (None for words never seen on their own)
+        return [self.vocab.get(tok) for tok in self.vocab.label(token_label).split()]
+
     def factorized_logp(self, amr, align):
-        parts = self.node_model.factorized_logp(amr, align)
-        parts.update(self.edge_model.factorized_logp(amr, align))
-        return sum(parts.values())
+        return self.batch_factorized_logp(amr, [align])[0]
+
+    def batch_factorized_logp(self, amr, aligns):
+        # factorized logp of each alignment: node parts then edge parts
+        node_logps = self.node_model.factorized_logps(amr, aligns)
+        edge_logps = self.edge_model.factorized_logps(amr, aligns)
+        return [sum(n + e) for n, e in zip(node_logps, edge_logps)]
 
     def inductive_bias(self, amr, align):
         subgraph_label = self.get_alignment_label(amr, align)
@@ -110,14 +127,19 @@ class Subgraph_Model(Alignment_Model):
         if not nodes:
             return None
         if len(nodes)==1:
-            return amr.nodes[nodes[0]].replace(' ','_')
-        edges = [(s, r, t) for s, r, t in amr.edges if s in nodes and t in nodes]
+            return self.node_model.concept_label(amr, nodes[0])
+        labels = self.vocab.amr_labels(amr)
+        key = ('subgraph', tuple(sorted(nodes)))
+        if key in labels:
+            return labels[key]
+        edges = amr_graph(amr).subgraph_edges(nodes)
         # nodes, edges = self._remove_ignored_parts(amr, nodes, edges)
         subgraph_label = [amr.nodes[n] for n in nodes] + [f'({amr.nodes[s]},{r},{amr.nodes[t]})' for s, r, t in edges]
         subgraph_label = [s for s in sorted(subgraph_label)]
         subgraph_label = [s.replace(' ','_') for s in subgraph_label]
         subgraph_label = ' '.join(subgraph_label)
-        return subgraph_label
+        labels[key] = self.vocab.id(subgraph_label)
+        return labels[key]
 
     def distance_logp(self, amr, alignments, align):
         if not align.nodes:
@@ -126,25 +148,24 @@ class Subgraph_Model(Alignment_Model):
         logp = 0
         parent_dists = []
         child_dists = []
-        nodes = align.nodes
-        tokens = align.tokens
-        nodes = set(nodes)
-        for s, r, t in amr.edges:
+        nodes = set(align.nodes)
+        graph = amr_graph(amr)
+        positions = self._node_positions(amr, alignments)
+        distance = self.distance_model.position_distance
+        pos = span_position(amr, align.tokens)
+        for s, r, t in graph.incident_edges(nodes):
             if t in nodes and s not in nodes:
-                salign = amr.get_alignment(alignments, node_id=s)
-                dist = self.distance_model.distance(amr, salign.tokens, tokens)
+                dist = distance(amr, self._node_position(amr, alignments, positions, s), pos)
                 parent_dists.append(dist)
             elif s in nodes and t not in nodes:
-                talign = amr.get_alignment(alignments, node_id=t)
-                dist = self.distance_model.distance(amr, tokens, talign.tokens)
-                t_parents = [s2 for s2,r2,t2 in amr.edges if t2==t]
+                t_pos = self._node_position(amr, alignments, positions, t)
+                dist = distance(amr, pos, t_pos)
                 # ignore reentrancies
-                if len(t_parents)>1:
+                if graph.num_parents(t)>1:
                     reentrancy = False
-                    for s2 in t_parents:
+                    for s2 in graph.parent_nodes(t):
                         if s==s2: continue
-                        s2_align = amr.get_alignment(alignments, node_id=s2)
-                        other_dist = self.distance_model.distance(amr, s2_align.tokens, talign.tokens)
+                        other_dist = distance(amr, self._node_position(amr, alignments, positions, s2), t_pos)
                         if other_dist<=dist:
                             reentrancy = True
                             break
@@ -164,11 +185,28 @@ class Subgraph_Model(Alignment_Model):
         return logp/n
 
 
-    def get_initial_alignments(self, amrs, preprocess=True):
-        print(f'Apply Rules = {preprocess}')
+    def _node_positions(self, amr, alignments):
+        # span position of the alignment of each node, kept until the AMR's alignments change
+        aligns = alignments.get(amr.id)
+        if isinstance(aligns, Alignment_List):
+            return aligns.cache.setdefault('node_positions', {})
+        return {}
+
+    def _node_position(self, amr, alignments, positions, n):
+        if n not in positions:
+            positions[n] = span_position(amr, get_alignment(amr, alignments, node_id=n).tokens)
+        return positions[n]
+
+    def initial_alignment_inputs(self, amr):
+        return ENGLISH
+
+    def get_initial_alignments(self, amrs, preprocess=True, verbose=True):
+        if verbose:
+            print(f'Apply Rules = {preprocess}')
         alignments = {}
         for j, amr in enumerate(amrs):
-            print(f'\rPreprocessing: {j} / {len(amrs)}', end='')
+            if verbose:
+                print(f'\rPreprocessing: {j} / {len(amrs)}', end='')
             alignments[amr.id] = []
             for span in amr.spans:
                 alignments[amr.id].append(AMR_Alignment(type='subgraph', tokens=span, amr=amr))
@@ -179,55 +217,64 @@ class Subgraph_Model(Alignment_Model):
                     test = clean_subgraph(amr, alignments, align)
                     if test is None:
                         align.nodes.clear()
-        print('\r', end='')
-        print('Preprocessing coverage:', coverage(amrs, alignments))
+        if verbose:
+            print('\r', end='')
+            print('Preprocessing coverage:', coverage(amrs, alignments))
         return alignments
 
-    def update_parameters(self, amrs, alignments, prune=True):
-        super().update_parameters(amrs, alignments)
-        self.node_model.update_parameters(amrs, alignments)
-        self.edge_model.update_parameters(amrs, alignments)
+    def update_parameters(self, amrs, alignments, prune=True, workers=1):
+        self.set_parameters(collect_counts(self, amrs, alignments, workers), prune)
 
-        # prune rare alignments
-        if prune:
+    def count_parameters(self, amrs, alignments):
+        counts = super().count_parameters(amrs, alignments)
+        counts['node_model'] = self.node_model.count_parameters(amrs, alignments)
+        counts['edge_model'] = self.edge_model.count_parameters(amrs, alignments)
+
+        distances = Distance_Stats()
+        num_null_aligned = 0
+        for amr in amrs:
+            if amr.id not in alignments:
+                continue
+            # distance stats
+            for s, r, t in amr.edges:
+                sa = get_alignment(amr, alignments, node_id=s)
+                ta = get_alignment(amr, alignments, node_id=t)
+                if sa and ta:
+                    dist = self.distance_model.distance(amr, sa.tokens, ta.tokens)
+                    distances.add(dist)
+            for align in alignments[amr.id]:
+                if not align.nodes:
+                    num_null_aligned += 1
+        counts['distances'] = distances
+        counts['num_null_aligned'] = num_null_aligned
+        return counts
+
+    def set_parameters(self, counts, prune=True):
+        super().set_parameters(counts)
+        self.node_model.set_parameters(counts['node_model'])
+        self.edge_model.set_parameters(counts['edge_model'])
+
+        # Prune rare alignments. The running tables of stepwise EM are not pruned, since the counts
+        # deleted from them would be lost for the rest of training.
+        if prune and not isinstance(self.translation_count, Stepwise_Table):
             for token_label in self.translation_count:
                 for subgraph_label in list(self.translation_count[token_label].keys()):
                     if self.tokens_count[token_label] == 0:
                         continue
                     if self.translation_count[token_label][subgraph_label]/self.tokens_count[token_label]<=0.01:
                         del self.translation_count[token_label][subgraph_label]
+            # tokens seen once in the corpus (self.tokens_count holds corpus counts)
             for token_label in list(self.translation_count.keys()):
                 if self.tokens_count[token_label] == 1:
                     del self.translation_count[token_label]
 
         self.translation_total += self.null_model.smoothing()
 
-        distances = []
-
-        for amr in amrs:
-            if amr.id not in alignments:
-                continue
-            # distance stats
-            for s, r, t in amr.edges:
-                sa = amr.get_alignment(alignments, node_id=s)
-                ta = amr.get_alignment(alignments, node_id=t)
-                if sa and ta:
-                    dist = self.distance_model.distance(amr, sa.tokens, ta.tokens)
-                    distances.append(dist)
-
-        distance_mean = mean(distances)
-        distance_stdev = stdev(distances)
-        self.distance_model.update_parameters(distance_mean, distance_stdev)
+        distances = counts['distances']
+        self.distance_model.update_parameters(distances.mean(), distances.stdev())
 
         self.is_initialized = True
-
-        self.num_null_aligned = 0
-        for amr in amrs:
-            if amr.id not in alignments:
-                continue
-            for align in alignments[amr.id]:
-                if not align.nodes:
-                    self.num_null_aligned += 1
+        self.num_null_aligned = counts['num_null_aligned']
 
     def align(self, amr, alignments, n, unaligned=None, return_all=False):
 
@@ -235,28 +282,27 @@ class Subgraph_Model(Alignment_Model):
         if unaligned is None:
             unaligned = self.get_unaligned(amr, alignments)
         candidate_spans = [align.tokens for align in alignments[amr.id] if not align.nodes]
+        graph = amr_graph(amr)
         tmp_align = AMR_Alignment(type='subgraph', tokens=[0], nodes=[n])
         postprocess_subgraph(amr, alignments, tmp_align, english=ENGLISH)
-        candidate_neighbors = [s for s, r, t in amr.edges if t in tmp_align.nodes and s not in unaligned] + \
-                              [t for s, r, t in amr.edges if s in tmp_align.nodes and t not in unaligned]
+        candidate_neighbors = [s for s, r, t in graph.in_edges(tmp_align.nodes) if s not in unaligned] + \
+                              [t for s, r, t in graph.out_edges(tmp_align.nodes) if t not in unaligned]
         for n2 in candidate_neighbors[:]:
-            nalign = amr.get_alignment(alignments, node_id=n2)
+            nalign = get_alignment(amr, alignments, node_id=n2)
             if not nalign or nalign.type == 'dupl-subgraph':
                 candidate_neighbors.remove(n2)
 
         # handle "never => ever, -" and other similar cases
         if ALIGN_SISTER_RELS:
-            edge_map = {n:[] for n in amr.nodes}
-            for s,r,t in amr.edges:
-                edge_map[s].append(t)
-            if not edge_map[n]:
+            if not graph.num_children(n):
+                n_parents = set(graph.parent_nodes(n))
                 for n2 in amr.nodes:
-                    if edge_map[n2]: continue
+                    if graph.num_children(n2): continue
                     if n2 in unaligned: continue
                     if amr.nodes[n] == amr.nodes[n2]: continue
-                    nalign = amr.get_alignment(alignments, node_id=n2)
+                    nalign = get_alignment(amr, alignments, node_id=n2)
                     if len(nalign.nodes)!=1: continue
-                    if any(n in edge_map[p] and n2 in edge_map[p] for p in amr.nodes):
+                    if not n_parents.isdisjoint(graph.parent_nodes(n2)):
                         candidate_neighbors.append(n2)
 
         # special rules for multi-sentence, and, or
@@ -273,13 +319,13 @@ class Subgraph_Model(Alignment_Model):
         for n2 in candidate_neighbors[:]:
             if amr.nodes[n2] in ['multi-sentence', 'and', 'or'] and candidate_spans:
                 candidate_neighbors.remove(n2)
-        if len([n2 for n2 in amr.nodes if amr.nodes[n]==amr.nodes[n2]])>1:
-            for s, r, t in amr.edges:
-                if t==n and amr.nodes[s] in ['include-91', 'same-01', 'instead-of-91', 'resemble-01', 'differ-02', 'and', 'or']:
+        if len(graph.same_concept(n))>1:
+            for s, r, t in graph.parents(n):
+                if amr.nodes[s] in ['include-91', 'same-01', 'instead-of-91', 'resemble-01', 'differ-02', 'and', 'or']:
                     if len([lemma for lemma in amr.lemmas if amr.nodes[n].split('-')[0]==lemma]) >= \
-                        len([n2 for n2 in amr.nodes if amr.nodes[n]==amr.nodes[n2]]):
+                        len(graph.same_concept(n)):
                         break
-                    for s2, r2, t2 in amr.edges:
+                    for s2, r2, t2 in graph.incident_edges([s]):
                         if s2 == s and t2 != t and amr.nodes[t2]==amr.nodes[n] and r2.endswith('1'):
                             candidate_spans = []
                             break
@@ -291,7 +337,7 @@ class Subgraph_Model(Alignment_Model):
         for n2 in amr.nodes:
             if amr.nodes[n].isdigit() or '"' in amr.nodes[n]: break
             if n2!=n and amr.nodes[n]==amr.nodes[n2]:
-                align = amr.get_alignment(alignments, node_id=n2)
+                align = get_alignment(amr, alignments, node_id=n2)
                 if align:
                     candidate_duplicates.append(align.tokens)
 
@@ -305,7 +351,7 @@ class Subgraph_Model(Alignment_Model):
         scores2 = {}
         aligns2 = {}
         for i, neighbor in enumerate(candidate_neighbors):
-            replaced_align = amr.get_alignment(alignments, node_id=neighbor)
+            replaced_align = get_alignment(amr, alignments, node_id=neighbor)
             if replaced_align.type.startswith('dupl'): continue
             new_align = AMR_Alignment(type=replaced_align.type, tokens=replaced_align.tokens, nodes=replaced_align.nodes+[n], amr=amr)
             scores2[i] = self.logp(amr, alignments, new_align) - self.logp(amr, alignments, replaced_align, postprocess=False)
@@ -315,7 +361,7 @@ class Subgraph_Model(Alignment_Model):
         if self.align_duplicates:
             for i, span in enumerate(candidate_duplicates):
                 new_align = AMR_Alignment(type='dupl-subgraph', tokens=span, nodes=[n], amr=amr)
-                replaced_align = amr.get_alignment(alignments, token_id=span[0])
+                replaced_align = get_alignment(amr, alignments, token_id=span[0])
                 scores3[i] = math.log(DUPLICATE_RATE) + self.logp(amr, alignments, new_align) - self.logp(amr, alignments, replaced_align, postprocess=False)
                 aligns3[i] = new_align
 
@@ -347,8 +393,23 @@ class Subgraph_Model(Alignment_Model):
         # readable = [r for r in sorted(readable, key=lambda x:x['score'], reverse=True)]
         return best_align, best_score
 
+    def get_dependencies(self, amr, alignments, n, aligns):
+        spans = {span for span in aligns}
+        nodes = {n}
+        for span, align in aligns.items():
+            nodes.update(align.nodes)
+            nodes.update(get_alignment(amr, alignments, token_id=span[0]).nodes)
+        # distance to parents and children, other parents of reentrant children, and sister relations
+        graph = amr_graph(amr)
+        for _ in range(2):
+            nodes.update([n2 for n1 in nodes for n2 in graph.child_nodes(n1) + graph.parent_nodes(n1)])
+        # duplicates
+        nodes.update(graph.same_concept(n))
+        return spans, nodes
+
     def postprocess_alignments(self, amr, alignments):
         clean_alignments(amr, alignments)
+        reindex_alignments(amr, alignments)
 
     def get_unaligned(self, amr, alignments):
         aligned = set()
@@ -359,7 +420,8 @@ class Subgraph_Model(Alignment_Model):
     def readable_logp(self, amr, alignments, align):
         readable = super().readable_logp(amr, alignments, align)
         subgraph_label = self.get_alignment_label(amr, align)
-        token_label = ' '.join(amr.lemmas[t] for t in align.tokens)
+        subgraph_label = self.vocab.label(subgraph_label) if subgraph_label is not None else None
+        token_label = self.vocab.tokens_id(amr, align.tokens)
         pos = amr.pos[align.tokens[0]]
 
         trans_logp = self.trans_logp(amr, align)
@@ -380,8 +442,8 @@ class Subgraph_Model(Alignment_Model):
         )
         return readable
 
-    def align_all(self, amrs, alignments=None, preprocess=True, debug=False):
-        alignments = super().align_all(amrs, alignments, preprocess, debug)
+    def align_all(self, amrs, alignments=None, preprocess=True, debug=False, workers=1, verbose=True):
+        alignments = super().align_all(amrs, alignments, preprocess, debug, workers, verbose)
 
         for amr in amrs:
             # hack to handle degenerate sentences
@@ -389,18 +451,19 @@ class Subgraph_Model(Alignment_Model):
                 new_align = AMR_Alignment(type='subgraph', tokens=amr.spans[0], nodes=[n for n in amr.nodes], edges=[e for e in amr.edges], amr=amr)
                 alignments[amr.id].append(new_align)
             for n in amr.nodes:
-                if not amr.get_alignment(alignments, node_id=n):
-                    parent = [e for e in amr.edges if e[-1]==n]
+                if not get_alignment(amr, alignments, node_id=n):
+                    parent = amr_graph(amr).parents(n)
                     if parent:
-                        align = amr.get_alignment(alignments, node_id=parent[0][0])
+                        align = get_alignment(amr, alignments, node_id=parent[0][0])
                         align.nodes.append(n)
+                        reindex_alignments(amr, alignments)
             # add subgraph edges
             for align in alignments[amr.id]:
                 if len(align.nodes) > 1:
-                    for e in amr.edges:
-                        s,r,t = e
-                        if s in align.nodes and t in align.nodes and e not in align.edges:
+                    for e in amr_graph(amr).subgraph_edges(align.nodes):
+                        if e not in align.edges:
                             align.edges.append(e)
+            reindex_alignments(amr, alignments)
 
         return alignments
 
@@ -0,0 +1,170 @@
+import weakref
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+
+import numpy as np
+
+from models.count_table import Count_Table
+
+
+class Vocab:
+    # Interned labels. Count tables are keyed by integer label ids instead of label strings.
+    # Labels of an AMR's spans, concepts and edges are memoized per AMR, so they are only built once.
+
+    def __init__(self):
+        self.ids = {}
+        self._labels = []
+        self._amr_labels = weakref.WeakKeyDictionary()
+        self._last_amr = None
+        self._last_labels = None
+
+    def __getstate__(self):
+        # the per-AMR memo is not pickled
+        return dict(vars(self), _amr_labels=None, _last_amr=None, _last_labels=None)
+
+    def id(self, label):
+        i = self.ids.get(label)
+        if i is None:
+            i = len(self.ids)
+            self.ids[label] = i
+            if self._labels is not None:
+                self._labels.append(label)
+        return i
+
+    def get(self, label):
+        # id of a label, or None if the label has not been seen (without adding it)
+        return self.ids.get(label)
+
+    def label(self, i):
+        if isinstance(self.ids, Label_Index):
+            return self.ids.label(i)
+        if self._labels is None:
+            self._labels = [None] * len(self.ids)
+            for label, j in self.ids.items():
+                self._labels[j] = label
+        return self._labels[i]
+
+    def amr_labels(self, amr):
+        # memo of label ids for one AMR
+        # (an AMR is usually looked up many times in a row, so the last one is kept at hand)
+        if amr is self._last_amr:
+            return self._last_labels
+        if self._amr_labels is None:
+            self._amr_labels = weakref.WeakKeyDictionary()
+        labels = self._amr_labels.get(amr)
+        if labels is None:
+            labels = {}
+            self._amr_labels[amr] = labels
+        self._last_amr = amr
+        self._last_labels = labels
+        return labels
+
+    def tokens_id(self, amr, span):
+        labels = self.amr_labels(amr)
+        key = tuple(span)
+        i = labels.get(key)
+        if i is None:
+            i = self.id(' '.join(amr.lemmas[t] for t in span))
+            labels[key] = i
+        return i
+
+
+class Label_Index(Mapping):
+    # Label -> id of a saved vocab, backed by (memory-mapped) arrays: the utf8 labels in id order,
+    # their offsets, and the ids sorted by label, so that a label is found by binary search without
+    # building a dict of all labels. Labels added after loading are kept in a dict.
+
+    def __init__(self, data, offsets, order):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+        self.size = len(order)
+        self.added = {}
+        self.added_labels = []
+
+    def _bytes(self, i):
+        return bytes(self.data[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def _find(self, label):
+        label = label.encode('utf8')
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = int(self.order[mid])
+            x = self._bytes(i)
+            if x < label:
+                lo = mid + 1
+            elif x > label:
+                hi = mid
+            else:
+                return i
+        return None
+
+    def get(self, label, default=None):
+        i = self.added.get(label)
+        if i is None and isinstance(label, str):
+            i = self._find(label)
+        return default if i is None else i
+
+    def __getitem__(self, label):
+        i = self.get(label)
+        if i is None:
+            raise KeyError(label)
+        return i
+
+    def __setitem__(self, label, i):
+        # only new labels are added, with the next id (see Vocab.id)
+        self.added[label] = i
+        self.added_labels.append(label)
+
+    def label(self, i):
+        if i < self.size:
+            return self._bytes(i).decode('utf8')
+        return self.added_labels[i - self.size]
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self.label(i)
+        yield from self.added_labels
+
+    def __len__(self):
+        return self.size + len(self.added)
+
+
+def label_index_arrays(labels):
+    # labels in id order -> (data, offsets, order) arrays of a Label_Index
+    encoded = [label.encode('utf8') for label in labels]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int32)
+    return data, offsets, order
+
+
+def intern_table(table, vocab):
+    # Count table keyed by label strings (from an older model) -> the same table keyed by label ids
+    items = {vocab.id(k): v for k, v in table.items()}
+    if isinstance(table, Counter):
+        return Counter(items)
+    if isinstance(table, defaultdict):
+        return defaultdict(table.default_factory, items)
+    if isinstance(table, Count_Table) and table.default is not None:
+        return Counter(items) if isinstance(table.default, int) else defaultdict(float, items)
+    return items
+
+
+def intern_nested_table(table, vocab):
+    return {vocab.id(k): intern_table(v, vocab) for k, v in table.items()}
+
+
+def remap_labels(counts, ids):
+    # Partial counts (tables keyed by label id, nested in dicts keyed by name) with label ids
+    # replaced according to ids, e.g. ids assigned by the vocab of a forked worker -> ids of this vocab
+    if not ids:
+        return counts
+    if isinstance(counts, dict):
+        table = type(counts)()
+        for k, v in counts.items():
+            table[ids.get(k, k)] = remap_labels(v, ids)
+        return table
+    return counts
@@ -0,0 +1,267 @@
+import json
+import os
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+
+from models.array_file import is_array_file, save_arrays, load_arrays
+
+# Binary NLP annotation store, written by nlp_data.py next to the AMR file. Annotations of all AMRs
+# are kept in flat, memory-mapped arrays and only decoded for the AMRs they are attached to.
+NLP_STORE_FORMAT = 'leamr-nlp'
+NLP_STORE_VERSION = 1
+# column name -> nesting depth of its values (e.g. coref: clusters of mentions of tokens)
+NLP_COLUMNS = {'lemmas': 1, 'spans': 2, 'coref': 3, 'pos': 1}
+STRING_COLUMNS = {'lemmas', 'pos'}
+
+
+def add_nlp_data(amrs, file):
+    attach_nlp_data(amrs, load_nlp_data(file))
+
+
+def nlp_store_file(file):
+    return file.replace('.txt', '') + '.nlp'
+
+
+def nlp_json_files(file):
+    return [file.replace('.txt', '') + f'.{name}.json' for name in NLP_COLUMNS]
+
+
+def load_nlp_data(file):
+    # Use the annotation store if there is one and no JSON file has been written since (e.g. by nlp_data_fast.py).
+    store_file = nlp_store_file(file)
+    if os.path.isfile(store_file) and is_array_file(store_file):
+        store_time = os.path.getmtime(store_file)
+        if all(not os.path.isfile(f) or os.path.getmtime(f) <= store_time for f in nlp_json_files(file)):
+            store = NLP_Store(store_file)
+            return store.lemmas, store.spans, store.coref, store.pos
+    lemmas_file = file.replace('.txt', '') + '.lemmas.json'
+    with open(lemmas_file, 'r') as f:
+        lemmas = json.load(f)
+    span_file1 = file.replace('.txt', '') + '.spans.json'
+    with open(span_file1, 'r') as f:
+        spans = json.load(f)
+    coref_file = file.replace('.txt', '') + '.coref.json'
+    with open(coref_file, 'r') as f:
+        corefs = json.load(f)
+    pos_file = file.replace('.txt', '') + '.pos.json'
+    with open(pos_file, 'r') as f:
+        pos = json.load(f)
+    return lemmas, spans, corefs, pos
+
+
+def stream_nlp_data(file):
+    # Like load_nlp_data, but without a corpus-wide dict of annotations: the store is read per AMR,
+    # and JSON files are read incrementally as annotations are looked up (in the order of the AMR file).
+    store_file = nlp_store_file(file)
+    if os.path.isfile(store_file) and is_array_file(store_file):
+        store_time = os.path.getmtime(store_file)
+        if all(not os.path.isfile(f) or os.path.getmtime(f) <= store_time for f in nlp_json_files(file)):
+            store = NLP_Store(store_file)
+            return store.lemmas, store.spans, store.coref, store.pos
+    return tuple(JSON_Stream(f) for f in nlp_json_files(file))
+
+
+def attach_nlp_data(amrs, nlp_data):
+    lemmas, spans, corefs, pos = nlp_data
+    for amr in amrs:
+        amr_id = amr.id
+        if amr_id.endswith('#2'):
+            amr_id = amr_id.split('#')[0]
+        amr.lemmas = lemmas[amr_id]
+        amr.spans = spans[amr_id]
+        amr.coref = corefs[amr_id]
+        amr.pos = pos[amr.id]
+
+
+def save_nlp_store(file, nlp_data):
+    # nlp_data: (lemmas, spans, corefs, pos) dicts from AMR id, as returned by load_nlp_data
+    # Each column has a row index per AMR id (-1 if missing), offsets for each nesting level and flat values.
+    # Lemmas and POS tags are interned in one vocabulary.
+    ids = list(dict.fromkeys(amr_id for table in nlp_data for amr_id in table))
+    id_index = {amr_id: i for i, amr_id in enumerate(ids)}
+    vocab = {}
+    arrays = {}
+    for name, table in zip(NLP_COLUMNS, nlp_data):
+        depth = NLP_COLUMNS[name]
+        rows = np.full(len(ids), -1, dtype=np.int32)
+        offsets = [[0] for _ in range(depth)]
+        values = []
+        for i, (amr_id, value) in enumerate(table.items()):
+            rows[id_index[amr_id]] = i
+            _flatten(value, 0, offsets, values)
+        if name in STRING_COLUMNS:
+            values = [vocab.setdefault(v, len(vocab)) for v in values]
+        arrays[name + '.rows'] = rows
+        for level in range(depth):
+            arrays[f'{name}.offsets{level}'] = np.array(offsets[level], dtype=np.int64)
+        arrays[name + '.values'] = np.array(values, dtype=np.int32)
+    arrays['ids'] = _join(ids)
+    arrays['vocab'] = _join(list(vocab))
+    header = {'format': NLP_STORE_FORMAT, 'version': NLP_STORE_VERSION, 'n_ids': len(ids), 'n_vocab': len(vocab)}
+    save_arrays(file + '.tmp', header, arrays)
+    os.replace(file + '.tmp', file)
+
+
+def _flatten(items, level, offsets, values):
+    offsets[level].append(offsets[level][-1] + len(items))
+    if level + 1 < len(offsets):
+        for x in items:
+            _flatten(x, level + 1, offsets, values)
+    else:
+        values.extend(items)
+
+
+def _join(strings):
+    return np.frombuffer('\0'.join(strings).encode('utf8'), dtype=np.uint8)
+
+
+def _split(data, n):
+    return bytes(data).decode('utf8').split('\0') if n else []
+
+
+class NLP_Store:
+    # Memory-mapped annotation store. Columns are read-only mappings from AMR id to annotations.
+
+    def __init__(self, file):
+        header, self.arrays = load_arrays(file)
+        if header.get('format') != NLP_STORE_FORMAT:
+            raise Exception('Unknown NLP annotation file format:', header.get('format'))
+        if header['version'] > NLP_STORE_VERSION:
+            raise Exception(f'NLP annotation file version {header["version"]} is newer than supported version {NLP_STORE_VERSION}')
+        self.header = header
+        self._ids = None
+        self._vocab = None
+        self.lemmas = NLP_Column(self, 'lemmas')
+        self.spans = NLP_Column(self, 'spans')
+        self.coref = NLP_Column(self, 'coref')
+        self.pos = NLP_Column(self, 'pos')
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            ids = _split(self.arrays['ids'], self.header['n_ids'])
+            self._ids = {amr_id: i for i, amr_id in enumerate(ids)}
+        return self._ids
+
+    @property
+    def vocab(self):
+        if self._vocab is None:
+            self._vocab = _split(self.arrays['vocab'], self.header['n_vocab'])
+        return self._vocab
+
+
+class NLP_Column(Mapping):
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.depth = NLP_COLUMNS[name]
+        self.rows = store.arrays[name + '.rows']
+        self.offsets = [store.arrays[f'{name}.offsets{level}'] for level in range(self.depth)]
+        self.values = store.arrays[name + '.values']
+
+    def __getitem__(self, amr_id):
+        row = int(self.rows[self.store.ids[amr_id]])
+        if row < 0:
+            raise KeyError(amr_id)
+        return self._decode(0, row)
+
+    def _decode(self, level, i):
+        start, end = int(self.offsets[level][i]), int(self.offsets[level][i + 1])
+        if level + 1 < self.depth:
+            return [self._decode(level + 1, j) for j in range(start, end)]
+        values = self.values[start:end].tolist()
+        if self.name in STRING_COLUMNS:
+            vocab = self.store.vocab
+            return [vocab[v] for v in values]
+        return values
+
+    def __contains__(self, amr_id):
+        return amr_id in self.store.ids and self.rows[self.store.ids[amr_id]] >= 0
+
+    def __iter__(self):
+        return (amr_id for amr_id, i in self.store.ids.items() if self.rows[i] >= 0)
+
+    def __len__(self):
+        return int((np.asarray(self.rows) >= 0).sum())
+
+
+def iter_json_items(file, chunk_size=1 << 20):
+    # Yield the (key, value) pairs of a JSON object file without loading the whole file.
+    decoder = json.JSONDecoder()
+    with open(file, 'r') as f:
+        buf = ''
+        pos = 0
+        eof = False
+
+        def next_char():
+            nonlocal buf, pos, eof
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return buf[pos] if pos < len(buf) else ''
+                buf, pos = buf[pos:] + f.read(chunk_size), 0
+                eof = pos == len(buf)
+
+        def next_value():
+            nonlocal buf, pos, eof
+            while True:
+                next_char()
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # a value at the very end of the buffer may have been cut off (e.g. a number)
+                    if end < len(buf) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                chunk = f.read(chunk_size)
+                buf, pos = buf[pos:] + chunk, 0
+                eof = not chunk
+
+        if next_char() != '{':
+            raise Exception('Expected a JSON object in:', file)
+        pos += 1
+        while True:
+            c = next_char()
+            if c == ',':
+                pos += 1
+                c = next_char()
+            if c == '}':
+                return
+            key = next_value()
+            if next_char() != ':':
+                raise Exception('Malformed JSON object in:', file)
+            pos += 1
+            yield key, next_value()
+
+
+class JSON_Stream:
+    # Lookups by AMR id into a JSON annotation file, reading it only as far as needed. Entries that are
+    # read ahead are kept until they are looked up, so memory stays small when the AMRs are looked up
+    # in file order, and the last few entries are kept for repeated ids.
+
+    def __init__(self, file, keep=1000):
+        self.items = iter_json_items(file)
+        self.pending = {}
+        self.recent = OrderedDict()
+        self.keep = keep
+
+    def __getitem__(self, amr_id):
+        if amr_id in self.recent:
+            return self.recent[amr_id]
+        while amr_id not in self.pending:
+            try:
+                key, value = next(self.items)
+            except StopIteration:
+                raise KeyError(amr_id)
+            self.pending[key] = value
+        value = self.pending.pop(amr_id)
+        self.recent[amr_id] = value
+        if len(self.recent) > self.keep:
+            self.recent.popitem(last=False)
+        return value
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import sqlite3
+from urllib.request import pathname2url
+
+
+class NLP_Cache:
+    # Persistent SQLite cache of the annotations of a sentence that only depend on its tokens:
+    # stanza lemmas, POS tags and named entity spans, and coreference clusters for each coref backend
+# (named with its version, so clusters found by another spaCy or neuralcoref version are not reused).
+    # Sentences are keyed by a hash of their tokens and of the annotation pipeline (e.g. its version),
+    # so the same sentence in another AMR file is only annotated once.
+    # A cache opened with writable=False (e.g. in worker processes, so that one process writes to the file)
+    # does not write what is added to it, but keeps it for take_unwritten(), to be passed to add_unwritten()
+    # of a writable cache. It reads a cache file that already exists.
+
+    def __init__(self, file, pipeline='', writable=True):
+        self.pipeline = pipeline
+        self.writable = writable
+        self.unwritten = {'annotations': {}, 'corefs': {}}
+        if not writable:
+            self.db = sqlite3.connect(f'file:{pathname2url(os.path.abspath(file))}?mode=ro', uri=True, timeout=600)
+            return
+        if os.path.dirname(file):
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.db = sqlite3.connect(file, timeout=600)
+        self.db.execute('CREATE TABLE IF NOT EXISTS annotations '
+                        '(key TEXT PRIMARY KEY, lemmas TEXT, pos TEXT, entities TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS corefs '
+                        '(key TEXT, backend TEXT, clusters TEXT, PRIMARY KEY (key, backend))')
+        self.db.commit()
+
+    def key(self, tokens):
+        return hashlib.sha1(json.dumps([self.pipeline, tokens]).encode('utf8')).hexdigest()
+
+    def _select(self, query, keys, *args):
+        rows = []
+        keys = list(set(keys))
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            rows.extend(self.db.execute(query.format(marks), list(args) + chunk))
+        return rows
+
+    def get_annotations(self, keys):
+        # returns {key: (lemmas, pos, entities)} for the keys that are cached
+        rows = self._select('SELECT key, lemmas, pos, entities FROM annotations WHERE key IN ({})', keys)
+        return {key: (json.loads(lemmas), json.loads(pos), [tuple(span) for span in json.loads(entities)])
+                for key, lemmas, pos, entities in rows}
+
+    def add_annotations(self, annotations):
+        if not self.writable:
+            self.unwritten['annotations'].update(annotations)
+            return
+        self.db.executemany('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)',
+                            [(key, json.dumps(lemmas), json.dumps(pos), json.dumps(entities))
+                             for key, (lemmas, pos, entities) in annotations.items()])
+        self.db.commit()
+
+    def get_corefs(self, keys, backend):
+        # returns {key: clusters} for the keys that are cached
+        rows = self._select('SELECT key, clusters FROM corefs WHERE backend = ? AND key IN ({})', keys, backend)
+        return {key: json.loads(clusters) for key, clusters in rows}
+
+    def add_corefs(self, corefs, backend):
+        if not self.writable:
+            self.unwritten['corefs'].setdefault(backend, {}).update(corefs)
+            return
+        self.db.executemany('INSERT OR REPLACE INTO corefs VALUES (?, ?, ?)',
+                            [(key, backend, json.dumps(clusters)) for key, clusters in corefs.items()])
+        self.db.commit()
+
+    def take_unwritten(self):
+        unwritten = self.unwritten
+        self.unwritten = {'annotations': {}, 'corefs': {}}
+        return unwritten
+
+    def add_unwritten(self, unwritten):
+        if unwritten['annotations']:
+            self.add_annotations(unwritten['annotations'])
+        for backend, corefs in unwritten['corefs'].items():
+            self.add_corefs(corefs, backend)
+
+    def close(self):
+        self.db.close()
@@ -1,55 +1,126 @@
+import argparse
+import hashlib
+import importlib
+import importlib.metadata
 import json
+from bisect import bisect_left, bisect_right
+import multiprocessing
+import os
 import sys
 
-import spacy
-from amr_utils.amr_readers import AMR_Reader
-
-import stanza
-import neuralcoref
-from spacy.tokens.doc import Doc
 from tqdm import tqdm
 
-from rule_based import mwes
+# spacy, stanza, neuralcoref and the MWE lists are slow to import, so they are only imported
+# when preprocessing runs. Aligners should import add_nlp_data from nlp_annotations.
+from amr_cache import load_amrs
+from nlp_annotations import add_nlp_data, attach_nlp_data, load_nlp_data, nlp_store_file, save_nlp_store
+from nlp_cache import NLP_Cache
 
 SEE_GOLD_AMR = True
 
+parser = argparse.ArgumentParser()
+parser.add_argument('amr_file', type=str,
+                    help='AMR file to preprocess')
+parser.add_argument('--batch-size', type=int, default=32,
+                    help='number of AMRs to send to stanza at a time')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes, each with its own stanza pipeline')
+parser.add_argument('--shard-size', type=int, default=1000,
+                    help='number of AMRs per checkpointed shard (0 to process the file in one pass without checkpoints)')
+parser.add_argument('--shard-dir', type=str, default=None,
+                    help='directory for shard checkpoints (default: <amr file>.nlp_shards)')
+parser.add_argument('--coref', type=str, default='neuralcoref',
+                    help='coreference backend: neuralcoref, none (no coreference) or the path of a Coref_Backend class')
+parser.add_argument('--coref-batch-size', type=int, default=32,
+                    help='batch size for spaCy nlp.pipe in the neuralcoref backend')
+parser.add_argument('--coref-processes', type=int, default=1,
+                    help='number of processes for spaCy nlp.pipe in the neuralcoref backend')
+parser.add_argument('--cache', type=str, default=os.path.join(os.path.expanduser('~'), '.cache', 'leamr', 'nlp_cache.sqlite'),
+                    help='SQLite cache of stanza and coreference annotations, so sentences seen before are not parsed again')
+parser.add_argument('--no-cache', action='store_true',
+                    help='do not read or write the annotation cache')
+parser.add_argument('--json', action='store_true',
+                    help='also write the annotations as JSON files (.lemmas.json, .pos.json, .spans.json, .coref.json)')
+
+
+MWES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rule_based', 'mwes.py')
+
+
+def package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return ''
 
-def add_nlp_data(amrs, file):
-    lemmas_file = file.replace('.txt', '') + '.lemmas.json'
-    with open(lemmas_file, 'r') as f:
-        lemmas = json.load(f)
-    span_file1 = file.replace('.txt', '') + '.spans.json'
-    with open(span_file1, 'r') as f:
-        spans = json.load(f)
-    coref_file = file.replace('.txt', '') + '.coref.json'
-    with open(coref_file, 'r') as f:
-        corefs = json.load(f)
-    pos_file = file.replace('.txt', '') + '.pos.json'
-    with open(pos_file, 'r') as f:
-        pos = json.load(f)
-    for amr in amrs:
-        amr_id = amr.id
-        if amr_id.endswith('#2'):
-            amr_id = amr_id.split('#')[0]
-        amr.lemmas = lemmas[amr_id]
-        amr.spans = spans[amr_id]
-        amr.coref = corefs[amr_id]
-        amr.pos = pos[amr.id]
 
+def mwes_hash():
+    with open(MWES_FILE, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
 
-def get_mwe_types_by_first_token():
-    hyphenated = [' - '.join(mwe.split()) for mwe in mwes.OTHER_MWES]
-    all_mwe_types = set(mwes.PMWES + mwes.VMWES + mwes.OTHER_MWES + mwes.HAND_ADDED_MWES + hyphenated)
-    all_mwe_types = [tuple(mwe.split()) for mwe in all_mwe_types]
-    all_mwe_types = [mwe for mwe in sorted(all_mwe_types, key=lambda x: len(x), reverse=True)]
-    all_mwe_types_dict = {}
-    for mwe in all_mwe_types:
-        first = mwe[0]
-        if first not in all_mwe_types_dict:
-            all_mwe_types_dict[first] = []
-        all_mwe_types_dict[first].append(mwe)
 
-    return all_mwe_types_dict
+def get_mwe_trie():
+    # Trie of the MWEs in rule_based/mwes.py (with hyphenated variants), as nested [is_mwe, {word: node}] lists.
+    # It is cached in rule_based/__pycache__ and rebuilt whenever mwes.py changes.
+    cache_file = os.path.join(os.path.dirname(MWES_FILE), '__pycache__', f'mwe_trie.{mwes_hash()}.json')
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'r', encoding='utf8') as f:
+            return json.load(f)
+
+    from rule_based import mwes
+
+    hyphenated = [' - '.join(mwe.split()) for mwe in mwes.OTHER_MWES]
+    trie = build_mwe_trie(set(mwes.PMWES + mwes.VMWES + mwes.OTHER_MWES + mwes.HAND_ADDED_MWES + hyphenated))
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        for old_file in os.listdir(cache_dir):
+            if old_file.startswith('mwe_trie.'):
+                os.remove(os.path.join(cache_dir, old_file))
+        with open(cache_file + '.tmp', 'w', encoding='utf8') as f:
+            json.dump(trie, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError:
+        pass
+    return trie
+
+
+def build_mwe_trie(mwe_types):
+    trie = [False, {}]
+    for mwe in mwe_types:
+        node = trie
+        for word in mwe.split():
+            node = node[1].setdefault(word, [False, {}])
+        node[0] = True
+    return trie
+
+
+def longest_mwe(mwe_trie, words, i):
+    # length of the longest MWE starting at words[i], or 0
+    if '@' in words[i]:
+        return 0
+    node = mwe_trie
+    size = 0
+    for j in range(i, len(words)):
+        node = node[1].get(words[j].lower().replace('@', ''))
+        if node is None:
+            break
+        if node[0]:
+            size = j - i + 1
+    return size
+
+
+def find_mwe_spans(tokens, lemmas, mwe_trie):
+    # Greedy, left to right: take the longest MWE matching the tokens, or else the lemmas, at each position.
+    spans = []
+    i = 0
+    while i < len(tokens):
+        size = longest_mwe(mwe_trie, tokens, i) or longest_mwe(mwe_trie, lemmas, i)
+        if size:
+            spans.append((i, i + size))
+            i += size
+        else:
+            i += 1
+    return spans
 
 
 class NoTokenizer(object):
@@ -57,6 +128,8 @@ class NoTokenizer(object):
         self.vocab = vocab
 
     def __call__(self, tokens):
+        from spacy.tokens.doc import Doc
+
         spaces = [True] * len(tokens)
         return Doc(self.vocab, words=tokens, spaces=spaces)
 
@@ -73,6 +146,9 @@ def get_root(amr, token_ids):
 
 
 def get_coref_parser():
+    import spacy
+    import neuralcoref
+
     nlp = spacy.load('en_core_web_sm')
     neuralcoref.add_to_pipe(nlp)
     nlp.tokenizer = NoTokenizer(nlp.vocab)
@@ -80,9 +156,12 @@ def get_coref_parser():
 
 
 def get_corefs(amr, parser):
-    nlp = parser(amr.tokens)
+    return coref_clusters(amr, parser(amr.tokens))
+
+
+def coref_clusters(amr, doc):
     coref_list = []
-    for ent in nlp._.coref_clusters:
+    for ent in doc._.coref_clusters:
         spans = []
         for s in ent.mentions:
             mention_span = [i for i in range(s.start, s.end)]
@@ -96,270 +175,545 @@ def get_corefs(amr, parser):
     return coref_list
 
 
-def main():
-    amr_file = sys.argv[1]
-    # output_file = sys.argv[2]
+class Coref_Backend:
+    # Finds coreference clusters (lists of token spans) for a batch of AMRs.
+    # version() names whatever else changes the clusters (e.g. library versions), so that cached
+    # coreferences and shard checkpoints made by another version are not reused.
 
-    # stanza.download('en')
-    nlp = stanza.Pipeline('en', processors='tokenize,pos,lemma,ner')
+    @staticmethod
+    def version():
+        return ''
+
+    def get_corefs(self, amrs):
+        raise NotImplementedError()
+
+
+class Neuralcoref_Backend(Coref_Backend):
+    # spaCy + neuralcoref on the AMR tokens, streamed through nlp.pipe
+
+    def __init__(self, batch_size=32, n_process=1):
+        self.parser = get_coref_parser()
+        self.batch_size = batch_size
+        self.n_process = n_process
+
+    @staticmethod
+    def version():
+        return f'spacy {package_version("spacy")} en_core_web_sm {package_version("en_core_web_sm")} ' \
+               f'neuralcoref {package_version("neuralcoref")}'
+
+    def get_corefs(self, amrs):
+        docs = self.parser.pipe((amr.tokens for amr in amrs), batch_size=self.batch_size, n_process=self.n_process)
+        return [coref_clusters(amr, doc) for amr, doc in zip(amrs, docs)]
+
+
+class No_Coref_Backend(Coref_Backend):
+    # no coreference, e.g. to preprocess offline without neuralcoref
+
+    def get_corefs(self, amrs):
+        return [[] for _ in amrs]
+
+
+COREF_BACKENDS = {'neuralcoref': Neuralcoref_Backend, 'none': No_Coref_Backend}
+
+
+def coref_backend_class(name):
+    # name is one of COREF_BACKENDS or the path of another Coref_Backend class, e.g. my_module.My_Backend
+    if name in COREF_BACKENDS:
+        return COREF_BACKENDS[name]
+    module, cls = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), cls)
+
+
+def coref_identity(name):
+    return f'{name} {coref_backend_class(name).version()}'.strip()
+
+
+def get_coref_backend(name, batch_size=32, n_process=1):
+    backend = coref_backend_class(name)
+    if backend is Neuralcoref_Backend:
+        backend = backend(batch_size=batch_size, n_process=n_process)
+    else:
+        backend = backend()
+    # cached coreferences are kept per backend and version, e.g. 'neuralcoref spacy 2.3.5 ...'
+    backend.name = coref_identity(name)
+    return backend
+
+
+def stanza_tokens(amr):
+    tokens = amr.tokens.copy()
+    for i, tok in enumerate(tokens):
+        if tok.startswith('@') and tok.endswith('@') and len(tok) == 3:
+            tokens[i] = tok[1]
+    return tokens
+
+
+def token_offsets(tokens):
+    # character offsets of each token in ' '.join(tokens)
+    start_idx = []
+    end_idx = []
+    i = 0
+    for tok in tokens:
+        start_idx.append(i)
+        end_idx.append(i + len(tok))
+        i += len(tok) + 1
+    return start_idx, end_idx
+
+
+def find_token(start_idx, end_idx, start, end):
+    # The first token that contains the characters start:end, or else the first token that starts inside them.
+    # Offsets are sorted, so both cases are a binary search instead of a scan over the sentence.
+    last = bisect_right(start_idx, start) - 1
+    k = bisect_left(end_idx, end)
+    if k <= last:
+        return k
+    k = bisect_left(start_idx, start)
+    if k < len(start_idx) and start_idx[k] <= end:
+        return k
+    raise IndexError(f'No token at characters {start}:{end}')
+
+
+STANZA_PROCESSORS = 'tokenize,pos,lemma,ner'
 
-    reader = AMR_Reader()
-    amrs = reader.load(amr_file, remove_wiki=True)
 
+def get_stanza_pipeline():
+    import stanza
+
+    # stanza.download('en')
+    return stanza.Pipeline('en', processors=STANZA_PROCESSORS)
+
+
+def stanza_identity():
+    return f'stanza {package_version("stanza")} {STANZA_PROCESSORS}'
+
+
+def open_nlp_cache(file, writable=True):
+    # annotations made by another stanza version are not reused
+    if file is None:
+        return None
+    return NLP_Cache(file, pipeline=stanza_identity(), writable=writable)
+
+
+def stanza_parse(nlp, amrs):
+    # Parse many AMRs in one pipeline call, as one stanza Document with the text of each AMR in its
+    # own paragraph, so stanza batches the sentences of all AMRs together. Sentences never cross a
+    # paragraph break, so each AMR's text is split into the same sentences as when it is parsed on its own.
+    # Returns the sentences of each AMR and the character offset of its text in the document.
+    texts = [' '.join(stanza_tokens(amr)) for amr in amrs]
+    offsets = []
+    i = 0
+    for text in texts:
+        offsets.append(i)
+        i += len(text) + 2
+    doc = nlp('\n\n'.join(texts))
+    sentences = [[] for _ in amrs]
+    for s in doc.sentences:
+        sentences[bisect_right(offsets, s.tokens[0].start_char) - 1].append(s)
+    return list(zip(sentences, offsets))
+
+
+def stanza_annotations(amr, sentences, offset=0):
+    # lemmas, POS tags and named entity spans of the AMR tokens from the stanza sentences of its text,
+    # which starts at character offset in the parsed document
+    tokens = stanza_tokens(amr)
+    start_idx, end_idx = token_offsets(tokens)
+
+    convert_ids = {}
+    stanza_lemmas = {}
+    stanza_entity_type = []
+    stanza_entity_spans = []
+    stanza_pos = {}
+    for s in sentences:
+        for token in s.tokens:
+            start = token.start_char - offset
+            end = token.end_char - offset
+            idx = find_token(start_idx, end_idx, start, end)
+            convert_ids[start] = idx
+            for word in token.words:
+                if start not in stanza_lemmas:
+                    stanza_lemmas[start] = ''
+                lemma = word.lemma
+                stanza_lemmas[start] += lemma
+                stanza_pos[start] = word.xpos
+        for e in s.entities:
+            stanza_entity_type.append(e.type)
+            ent_type = e.type
+            span = []
+            for t in e.tokens:
+                start = t.start_char - offset
+                span.append(start)
+            # name = ' '.join(amr.tokens[convert_ids[t]] for t in span)
+            # type = e.type
+            pos = [stanza_pos[t] for t in span]
+            if pos[0] in ['DT', 'PDT', 'PRP$', 'RB', 'RP', 'JJ', 'JJR', 'JJS', 'IN']:
+                while pos and pos[0] in ['DT', 'PDT', 'PRP$', 'RB', 'RP', 'JJ', 'JJR', 'JJS', 'IN']:
+                    pos = pos[1:]
+                    span = span[1:]
+                if len(span) == 0:
+                    stanza_entity_type.pop()
+                    continue
+            if pos and pos[-1] in ['POS', 'RB', 'RBR', 'RBS']:
+                span = span[:-1]
+                if len(span) == 0:
+                    stanza_entity_type.pop()
+                    continue
+            # next_tok = convert_ids[span[-1]]
+            # next_tok = [s for s,t in convert_ids.items() if t==next_tok+1]
+            # prev_tok = convert_ids[span[0]]
+            # prev_tok = [s for s, t in convert_ids.items() if t == prev_tok - 1]
+            # if next_tok:
+            #     next_tok = next_tok[0]
+            #     next_pos = stanza_pos[next_tok]
+            #     if next_pos == 'NNP':
+            #         span.append(next_tok)
+            # if prev_tok:
+            #     prev_tok = prev_tok[0]
+            #     prev_pos = stanza_pos[prev_tok]
+            #     if prev_pos == 'NNP':
+            #         span.insert(0,prev_tok)
+            # if amr.id=='bolt12_10494_3592.5':
+            #     print()
+            if len(span) == 1:
+                stanza_entity_type.pop()
+                continue
+            stanza_entity_spans.append(span)
+            # if ent_type in ['DATE','TIME','MONEY','QUANTITY']:
+            #     print()
+            #     print(ent_type, ' '.join(amr.tokens[convert_ids[i]] for i in span))
+            #     print()
+
+    lemmas = ['' for _ in amr.tokens]
+    pos = ['' for _ in amr.tokens]
+    for i in stanza_lemmas:
+        lemmas[convert_ids[i]] += stanza_lemmas[i]
+        pos[convert_ids[i]] = stanza_pos[i]
+    for i, l in enumerate(lemmas):
+        if not l and i > 0:
+            lemmas[i] = lemmas[i - 1]
+            pos[i] = pos[i - 1]
+    entities = []
+    for span in stanza_entity_spans:
+        span = [convert_ids[i] for i in span]
+        start = min(span)
+        end = max(span) + 1
+        entities.append((start, end))
+    return lemmas, pos, entities
+
+
+def get_multi_word_spans(amr, lemmas, ner_spans, mwe_spans):
+    # Token spans of names, times, named entities and MWEs. Names (if SEE_GOLD_AMR) and times depend on the AMR.
+    ner_spans = list(ner_spans)
+    # look for names matching gold amr
+    name_spans = []
+    if SEE_GOLD_AMR:
+        for n in amr.nodes:
+            if amr.nodes[n] == 'name':
+                parts = [(int(r[3:]), t) for s, r, t in amr.edges if s == n and r.startswith(':op')]
+                parts = [t for r, t in sorted(parts, key=lambda x: x[0])]
+                label = ' '.join(amr.nodes[t].replace('"', '') for t in parts)
+                name_type = [s for s, r, t in amr.edges if t == n and r == ':name']
+                name_type = amr.nodes[name_type[0]] if name_type else None
+                if parts:
+                    for start in range(len(amr.tokens)):
+                        span = [t for t in range(start, start + len(parts))]
+                        if span[-1] >= len(amr.tokens): break
+                        tokens = [amr.tokens[t] for t in span]
+                        token_label = ' '.join([tok for tok in tokens if tok != '"'])
+                        if token_label.lower() == label.lower():
+                            next_tok = span[-1] + 1
+                            if next_tok < len(amr.tokens) and amr.tokens[next_tok] == name_type:
+                                span += [next_tok]
+                            if len(parts) > 1:
+                                name_spans.append((span[0], span[-1] + 1))
+                            start = span[0]
+                            end = span[-1] + 1
+                            for span in ner_spans[:]:
+                                if span[0] <= start < span[1] and span[0] < end <= span[1] and (start, end) != span:
+                                    ner_spans.remove(span)
+                                    break
+                            break
+        for t in range(len(amr.tokens)):
+            if t + 2 < len(amr.tokens) and amr.tokens[t + 1] == '@-@':
+                label1 = f'{lemmas[t]}{lemmas[t + 2]}'.lower()[:len(lemmas[t]) + 4]
+                label2 = f'{lemmas[t]}-{lemmas[t + 2]}'.lower()[:len(lemmas[t]) + 5]
+                if any(amr.nodes[n].startswith(label1) or amr.nodes[n].startswith(label2) for n in amr.nodes):
+                    name_spans.append((t, t + 3))
+    # times
+    taken = set()
+    for t in range(len(amr.tokens)):
+        if t in taken: continue
+        start = t
+        if amr.tokens[t].isdigit() and len(amr.tokens[t]) <= 2 and t + 2 < len(amr.tokens):
+            if amr.tokens[t + 1] in ['@:@', ':'] and amr.tokens[t + 2].isdigit() and len(amr.tokens[t + 2]) == 2:
+                end = t + 2
+                while end + 1 < len(amr.tokens) \
+                        and (amr.tokens[end + 1] in ['am', 'pm', 'a.m.', 'p.m.', '@:@', ':', 'UTC', 'GMT', 'EST',
+                                                     'Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                                                     'Friday', 'Saturday', ]
+                             or (amr.tokens[end] in ['@:@', ':'] and amr.tokens[end + 1].isdigit() and len(
+                            amr.tokens[end + 1]) == 2)):
+                    end += 1
+                end += 1
+                time = ' '.join(amr.tokens[t] for t in range(start, end))
+                name_spans.append((start, end))
+                for span in ner_spans:
+                    if start < span[1] < end and span[0] < start:
+                        name_spans[-1] = (span[0], end)
+                        break
+                    elif start < span[0] < end and span[1] > end:
+                        name_spans[-1] = (start, span[1])
+                        break
+                    elif span[0] <= start < span[1] and span[0] < end <= span[1]:
+                        name_spans[-1] = span
+                        break
+                start, end = name_spans[-1]
+                for i in range(start, end):
+                    taken.add(i)
+    multi_word_spans = []
+    taken = set()
+    for i, tok in enumerate(amr.tokens):
+        if i in taken: continue
+        if any(i == span[0] for span in name_spans):
+            span = [s for s in name_spans if s[0] <= i < s[1]][0]
+            span = [i for i in range(span[0], span[1])]
+            multi_word_spans.append(span)
+            taken.update(span)
+        elif any(i == span[0] for span in ner_spans):
+            span = [s for s in ner_spans if s[0] <= i < s[1]][0]
+            span = [i for i in range(span[0], span[1])]
+            multi_word_spans.append(span)
+            taken.update(span)
+        elif any(i == span[0] for span in mwe_spans):
+            span = [s for s in mwe_spans if s[0] <= i < s[1]][0]
+            span = [i for i in range(span[0], span[1])]
+            multi_word_spans.append(span)
+            taken.update(span)
+        else:
+            multi_word_spans.append([i])
+            taken.add(i)
+    return multi_word_spans
+
+
+def annotate_amrs(amrs, nlp, coref_backend=None, batch_size=32, verbose=True, cache=None):
+    # Only stanza and coreference annotations are cached. MWE, name and time spans are cheap and
+    # depend on the MWE list and on the AMR, so they are always recomputed.
     lemmas_json = {}
     pos_json = {}
-    ner_spans = {}
-    mwe_spans = {}
     multi_word_spans = {}
     coreferences = {}
 
-    mwe_types = get_mwe_types_by_first_token()
-    coref_parser = None
+    mwe_trie = get_mwe_trie()
+
+    with tqdm(total=len(amrs), disable=not verbose) as progress:
+        for batch_start in range(0, len(amrs), batch_size):
+            batch = amrs[batch_start:batch_start + batch_size]
+            keys = [cache.key(amr.tokens) if cache is not None else i for i, amr in enumerate(batch)]
+            annotations = cache.get_annotations(keys) if cache is not None else {}
+            parse = [i for i, key in enumerate(keys) if key not in annotations]
+            if parse:
+                parses = stanza_parse(nlp, [batch[i] for i in parse])
+                parsed = {keys[i]: stanza_annotations(batch[i], sentences, offset)
+                          for i, (sentences, offset) in zip(parse, parses)}
+                if cache is not None:
+                    cache.add_annotations(parsed)
+                annotations.update(parsed)
+            for amr, key in zip(batch, keys):
+                lemmas, pos, entities = annotations[key]
+                lemmas_json[amr.id] = lemmas
+                pos_json[amr.id] = pos
+                mwe_spans = find_mwe_spans(amr.tokens, lemmas, mwe_trie)
+                multi_word_spans[amr.id] = get_multi_word_spans(amr, lemmas, entities, mwe_spans)
+            if coref_backend is not None:
+                corefs = cache.get_corefs(keys, coref_backend.name) if cache is not None else {}
+                parse = [i for i, key in enumerate(keys) if key not in corefs]
+                if parse:
+                    parsed = dict(zip([keys[i] for i in parse], coref_backend.get_corefs([batch[i] for i in parse])))
+                    if cache is not None:
+                        cache.add_corefs(parsed, coref_backend.name)
+                    corefs.update(parsed)
+                for amr, key in zip(batch, keys):
+                    coreferences[amr.id] = corefs[key]
+            progress.update(len(batch))
+
+    return lemmas_json, pos_json, multi_word_spans, coreferences
+
+
+def load_coref_backend(name='neuralcoref', batch_size=32, n_process=1):
+    # Without neuralcoref, preprocessing goes on without coreference. Errors of other backends are raised.
     try:
-        coref_parser = get_coref_parser()
-    except Exception as e:
+        return get_coref_backend(name, batch_size, n_process)
+    except ImportError:
+        if COREF_BACKENDS.get(name) is not Neuralcoref_Backend:
+            raise
         print('Warning: Failed to parse coreference. '
               'Please install neuralcoref from source: https://github.com/huggingface/neuralcoref#install-neuralcoref-from-source',
               file=sys.stderr)
+        return None
 
-    enum_amrs = [_ for _ in enumerate(amrs)]
-    for amr_idx, amr in tqdm(enum_amrs):
-        tokens = amr.tokens.copy()
-        for i, tok in enumerate(tokens):
-            if tok.startswith('@') and tok.endswith('@') and len(tok) == 3:
-                tokens[i] = tok[1]
-        doc = nlp(' '.join(tokens))
-        start_idx = {}
-        end_idx = {}
-        i = 0
-        for j, tok in enumerate(tokens):
-            start_idx[j] = i
-            end_idx[j] = i + len(tok)
-            i += len(tok) + 1
-
-        convert_ids = {}
-        stanza_lemmas = {}
-        stanza_entity_type = []
-        stanza_entity_spans = []
-        stanza_pos = {}
-        for s in doc.sentences:
-            for token in s.tokens:
-                start = token.start_char
-                end = token.end_char
-                idx = [k for k in start_idx if start >= start_idx[k] and end <= end_idx[k]]
-                if len(idx) == 0:
-                    idx = [k for k in start_idx if start <= start_idx[k] <= end]
-                idx = idx[0]
-                convert_ids[start] = idx
-                for word in token.words:
-                    if start not in stanza_lemmas:
-                        stanza_lemmas[start] = ''
-                    lemma = word.lemma
-                    stanza_lemmas[start] += lemma
-                    stanza_pos[start] = word.xpos
-            for e in s.entities:
-                stanza_entity_type.append(e.type)
-                ent_type = e.type
-                span = []
-                for t in e.tokens:
-                    start = t.start_char
-                    span.append(start)
-                # name = ' '.join(amr.tokens[convert_ids[t]] for t in span)
-                # type = e.type
-                pos = [stanza_pos[t] for t in span]
-                if pos[0] in ['DT', 'PDT', 'PRP$', 'RB', 'RP', 'JJ', 'JJR', 'JJS', 'IN']:
-                    while pos and pos[0] in ['DT', 'PDT', 'PRP$', 'RB', 'RP', 'JJ', 'JJR', 'JJS', 'IN']:
-                        pos = pos[1:]
-                        span = span[1:]
-                    if len(span) == 0:
-                        stanza_entity_type.pop()
-                        continue
-                if pos and pos[-1] in ['POS', 'RB', 'RBR', 'RBS']:
-                    span = span[:-1]
-                    if len(span) == 0:
-                        stanza_entity_type.pop()
-                        continue
-                # next_tok = convert_ids[span[-1]]
-                # next_tok = [s for s,t in convert_ids.items() if t==next_tok+1]
-                # prev_tok = convert_ids[span[0]]
-                # prev_tok = [s for s, t in convert_ids.items() if t == prev_tok - 1]
-                # if next_tok:
-                #     next_tok = next_tok[0]
-                #     next_pos = stanza_pos[next_tok]
-                #     if next_pos == 'NNP':
-                #         span.append(next_tok)
-                # if prev_tok:
-                #     prev_tok = prev_tok[0]
-                #     prev_pos = stanza_pos[prev_tok]
-                #     if prev_pos == 'NNP':
-                #         span.insert(0,prev_tok)
-                # if amr.id=='bolt12_10494_3592.5':
-                #     print()
-                if len(span) == 1:
-                    stanza_entity_type.pop()
-                    continue
-                stanza_entity_spans.append(span)
-                # if ent_type in ['DATE','TIME','MONEY','QUANTITY']:
-                #     print()
-                #     print(ent_type, ' '.join(amr.tokens[convert_ids[i]] for i in span))
-                #     print()
-
-        lemmas = ['' for _ in amr.tokens]
-        pos = ['' for _ in amr.tokens]
-        for i in stanza_lemmas:
-            lemmas[convert_ids[i]] += stanza_lemmas[i]
-            pos[convert_ids[i]] = stanza_pos[i]
-        for i, l in enumerate(lemmas):
-            if not l and i > 0:
-                lemmas[i] = lemmas[i - 1]
-                pos[i] = pos[i - 1]
-        entities = []
-        for span in stanza_entity_spans:
-            span = [convert_ids[i] for i in span]
-            start = min(span)
-            end = max(span) + 1
-            entities.append((start, end))
-        lemmas_json[amr.id] = lemmas
-        pos_json[amr.id] = pos
-        ner_spans[amr.id] = entities
-
-        # get MWE spans
-        mwe_spans[amr.id] = []
-        taken = []
-        for i, token in enumerate(amr.tokens):
-            if i in taken: continue
-            found = False
-            token = token.lower()
-            lemma = lemmas[i].lower()
-            if token in mwe_types:
-                for mwe in mwe_types[token]:
-                    size = len(mwe)
-                    if i + size - 1 >= len(amr.tokens): continue
-                    if all(amr.tokens[i + idx].lower().replace('@', '') == mwe[idx] for idx in range(size)):
-                        span = (i, i + size)
-                        mwe_spans[amr.id].append(span)
-                        for t in range(span[0], span[-1]):
-                            taken.append(t)
-                        found = True
-                        break
-            if found: continue
-            if lemma in mwe_types:
-                for mwe in mwe_types[lemma]:
-                    size = len(mwe)
-                    if i + size - 1 >= len(amr.tokens): continue
-                    if all(lemmas[i + idx].lower().replace('@', '') == mwe[idx] for idx in range(size)):
-                        span = (i, i + size)
-                        mwe_spans[amr.id].append(span)
-                        for t in range(span[0], span[-1]):
-                            taken.append(t)
-                        break
-            taken.append(i)
-
-        # look for names matching gold amr
-        name_spans = []
-        if SEE_GOLD_AMR:
-            for n in amr.nodes:
-                if amr.nodes[n] == 'name':
-                    parts = [(int(r[3:]), t) for s, r, t in amr.edges if s == n and r.startswith(':op')]
-                    parts = [t for r, t in sorted(parts, key=lambda x: x[0])]
-                    label = ' '.join(amr.nodes[t].replace('"', '') for t in parts)
-                    name_type = [s for s, r, t in amr.edges if t == n and r == ':name']
-                    name_type = amr.nodes[name_type[0]] if name_type else None
-                    if parts:
-                        for start in range(len(amr.tokens)):
-                            span = [t for t in range(start, start + len(parts))]
-                            if span[-1] >= len(amr.tokens): break
-                            tokens = [amr.tokens[t] for t in span]
-                            token_label = ' '.join([tok for tok in tokens if tok != '"'])
-                            if token_label.lower() == label.lower():
-                                next_tok = span[-1] + 1
-                                if next_tok < len(amr.tokens) and amr.tokens[next_tok] == name_type:
-                                    span += [next_tok]
-                                if len(parts) > 1:
-                                    name_spans.append((span[0], span[-1] + 1))
-                                start = span[0]
-                                end = span[-1] + 1
-                                for span in ner_spans[amr.id][:]:
-                                    if span[0] <= start < span[1] and span[0] < end <= span[1] and (start, end) != span:
-                                        ner_spans[amr.id].remove(span)
-                                        break
-                                break
-            for t in range(len(amr.tokens)):
-                if t + 2 < len(amr.tokens) and amr.tokens[t + 1] == '@-@':
-                    label1 = f'{lemmas[t]}{lemmas[t + 2]}'.lower()[:len(lemmas[t]) + 4]
-                    label2 = f'{lemmas[t]}-{lemmas[t + 2]}'.lower()[:len(lemmas[t]) + 5]
-                    if any(amr.nodes[n].startswith(label1) or amr.nodes[n].startswith(label2) for n in amr.nodes):
-                        name_spans.append((t, t + 3))
-        # times
-        taken = set()
-        for t in range(len(amr.tokens)):
-            if t in taken: continue
-            start = t
-            if amr.tokens[t].isdigit() and len(amr.tokens[t]) <= 2 and t + 2 < len(amr.tokens):
-                if amr.tokens[t + 1] in ['@:@', ':'] and amr.tokens[t + 2].isdigit() and len(amr.tokens[t + 2]) == 2:
-                    end = t + 2
-                    while end + 1 < len(amr.tokens) \
-                            and (amr.tokens[end + 1] in ['am', 'pm', 'a.m.', 'p.m.', '@:@', ':', 'UTC', 'GMT', 'EST',
-                                                         'Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
-                                                         'Friday', 'Saturday', ]
-                                 or (amr.tokens[end] in ['@:@', ':'] and amr.tokens[end + 1].isdigit() and len(
-                                amr.tokens[end + 1]) == 2)):
-                        end += 1
-                    end += 1
-                    time = ' '.join(amr.tokens[t] for t in range(start, end))
-                    name_spans.append((start, end))
-                    for span in ner_spans[amr.id]:
-                        if start < span[1] < end and span[0] < start:
-                            name_spans[-1] = (span[0], end)
-                            break
-                        elif start < span[0] < end and span[1] > end:
-                            name_spans[-1] = (start, span[1])
-                            break
-                        elif span[0] <= start < span[1] and span[0] < end <= span[1]:
-                            name_spans[-1] = span
-                            break
-                    start, end = name_spans[-1]
-                    for i in range(start, end):
-                        taken.add(i)
-        multi_word_spans[amr.id] = []
-        taken = set()
-        for i, tok in enumerate(amr.tokens):
-            if i in taken: continue
-            if any(i == span[0] for span in name_spans):
-                span = [s for s in name_spans if s[0] <= i < s[1]][0]
-                span = [i for i in range(span[0], span[1])]
-                multi_word_spans[amr.id].append(span)
-                taken.update(span)
-            elif any(i == span[0] for span in ner_spans[amr.id]):
-                span = [s for s in ner_spans[amr.id] if s[0] <= i < s[1]][0]
-                span = [i for i in range(span[0], span[1])]
-                multi_word_spans[amr.id].append(span)
-                taken.update(span)
-            elif any(i == span[0] for span in mwe_spans[amr.id]):
-                span = [s for s in mwe_spans[amr.id] if s[0] <= i < s[1]][0]
-                span = [i for i in range(span[0], span[1])]
-                multi_word_spans[amr.id].append(span)
-                taken.update(span)
-            else:
-                multi_word_spans[amr.id].append([i])
-                taken.add(i)
-        if coref_parser is not None:
-            corefs = get_corefs(amr, coref_parser)
-            coreferences[amr.id] = corefs
+
+# stanza and coref pipelines of a shard worker process
+_worker_pipelines = None
+
+
+def _init_shard_worker(coref, coref_batch_size, coref_processes, cache_file=None):
+    # workers only read the cache, and return the annotations they add for the main process to write
+    global _worker_pipelines
+    _worker_pipelines = get_stanza_pipeline(), load_coref_backend(coref, coref_batch_size, coref_processes), \
+        open_nlp_cache(cache_file, writable=False)
+
+
+def annotation_config(coref):
+    # everything besides the AMRs that changes the annotations of a shard
+    return {'stanza': stanza_identity(), 'coref': coref_identity(coref), 'mwes': mwes_hash(),
+            'see_gold_amr': SEE_GOLD_AMR}
+
+
+def shard_hash(amrs, config):
+    # Hash of the AMR tokens (and graphs, which name spans are read from) and of the annotation config,
+    # so that a shard checkpoint is only reused for the same sentences annotated the same way.
+    h = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf8'))
+    for amr in amrs:
+        graph = [amr.nodes, amr.edges] if SEE_GOLD_AMR else None
+        h.update(json.dumps([amr.id, amr.tokens, graph]).encode('utf8'))
+    return h.hexdigest()
+
+
+def annotate_shard(shard_file, amrs, batch_size, config):
+    # Annotate one shard and checkpoint it to shard_file. The file is written under a temporary
+    # name and then renamed, so a shard file on disk is always complete.
+    nlp, coref_backend, cache = _worker_pipelines
+    lemmas_json, pos_json, multi_word_spans, coreferences = \
+        annotate_amrs(amrs, nlp, coref_backend, batch_size, verbose=False, cache=cache)
+    shard = {'ids': [amr.id for amr in amrs],
+             'hash': shard_hash(amrs, config),
+             'lemmas': lemmas_json,
+             'pos': pos_json,
+             'spans': multi_word_spans,
+             'coref': coreferences if coref_backend is not None else None}
+    with open(shard_file + '.tmp', 'w+', encoding='utf8') as f:
+        json.dump(shard, f)
+    os.replace(shard_file + '.tmp', shard_file)
+    return cache.take_unwritten() if cache is not None else None
+
+
+def load_shard(shard_file, amrs, config):
+    # returns None if the shard has not been completed, or was made from different AMRs or another config
+    if not os.path.isfile(shard_file):
+        return None
+    with open(shard_file, 'r', encoding='utf8') as f:
+        shard = json.load(f)
+    if shard.get('hash') != shard_hash(amrs, config):
+        return None
+    return shard
+
+
+def annotate_amrs_sharded(amrs, shard_dir, shard_size, workers, batch_size, coref_args=('neuralcoref', 32, 1),
+                          cache_file=None):
+    # Split AMRs into shards of shard_size, annotate the shards in worker processes (each with its own
+    # stanza pipeline) and merge them. Completed shards are kept in shard_dir, so an interrupted run
+    # only redoes the shards that were not finished.
+    os.makedirs(shard_dir, exist_ok=True)
+    config = annotation_config(coref_args[0])
+    shards = [amrs[i:i + shard_size] for i in range(0, len(amrs), shard_size)]
+    shard_files = [os.path.join(shard_dir, f'shard{i}.json') for i in range(len(shards))]
+    todo = [i for i in range(len(shards)) if load_shard(shard_files[i], shards[i], config) is None]
+    if len(todo) < len(shards):
+        print(f'Resuming: {len(shards) - len(todo)} / {len(shards)} shards already done')
+
+    # only this process writes to the cache file
+    cache = open_nlp_cache(cache_file)
+    if todo:
+        tasks = [(shard_files[i], shards[i], batch_size, config) for i in todo]
+        if workers > 1:
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(min(workers, len(todo)), initializer=_init_shard_worker,
+                          initargs=(*coref_args, cache_file)) as pool:
+                for unwritten in tqdm(pool.imap_unordered(_annotate_shard_task, tasks), total=len(tasks)):
+                    if cache is not None:
+                        cache.add_unwritten(unwritten)
+        else:
+            _init_shard_worker(*coref_args, cache_file)
+            for task in tqdm(tasks):
+                unwritten = _annotate_shard_task(task)
+                if cache is not None:
+                    cache.add_unwritten(unwritten)
+
+    # A shard without coreference (its worker could not load the coref backend) is annotated again,
+    # unless no shard has coreference, as when the coref backend fails without shards.
+    no_coref = [i for i in range(len(shards)) if load_shard(shard_files[i], shards[i], config)['coref'] is None]
+    if no_coref and len(no_coref) < len(shards):
+        print(f'Annotating {len(no_coref)} shards without coreference again')
+        _init_shard_worker(*coref_args, cache_file)
+        for i in no_coref:
+            unwritten = _annotate_shard_task((shard_files[i], shards[i], batch_size, config))
+            if cache is not None:
+                cache.add_unwritten(unwritten)
+            if load_shard(shard_files[i], shards[i], config)['coref'] is None:
+                raise Exception(f'Failed to find coreference for shard {shard_files[i]}, although other shards have it')
+        no_coref = []
+    if cache is not None:
+        cache.close()
+
+    lemmas_json = {}
+    pos_json = {}
+    multi_word_spans = {}
+    coreferences = {}
+    for shard_file, shard_amrs in zip(shard_files, shards):
+        shard = load_shard(shard_file, shard_amrs, config)
+        lemmas_json.update(shard['lemmas'])
+        pos_json.update(shard['pos'])
+        multi_word_spans.update(shard['spans'])
+        if not no_coref:
+            coreferences.update(shard['coref'])
+    return lemmas_json, pos_json, multi_word_spans, coreferences, shard_files
+
+
+def _annotate_shard_task(task):
+    return annotate_shard(*task)
+
+
+def main():
+    amr_file = args.amr_file
+
+    amrs = load_amrs(amr_file, remove_wiki=True)
+
+    coref_args = (args.coref, args.coref_batch_size, args.coref_processes)
+    cache_file = None if args.no_cache else args.cache
+    shard_files = None
+    if args.shard_size > 0:
+        shard_dir = args.shard_dir if args.shard_dir else amr_file.replace('.txt', '') + '.nlp_shards'
+        lemmas_json, pos_json, multi_word_spans, coreferences, shard_files = \
+            annotate_amrs_sharded(amrs, shard_dir, args.shard_size, args.workers, args.batch_size, coref_args,
+                                  cache_file)
+    else:
+        nlp = get_stanza_pipeline()
+        coref_backend = load_coref_backend(*coref_args)
+        cache = open_nlp_cache(cache_file)
+        lemmas_json, pos_json, multi_word_spans, coreferences = \
+            annotate_amrs(amrs, nlp, coref_backend, args.batch_size, cache=cache)
+        if cache is not None:
+            cache.close()
 
     # ner_spans = {k: v for k, v in ner_spans.items() if v}
     # mwe_spans = {k: v for k, v in mwe_spans.items() if v}
 
     filename = amr_file.replace('.txt', '')
-    with open(filename + '.lemmas.json', 'w+', encoding='utf8') as f:
-        json.dump(lemmas_json, f)
-    with open(filename + '.pos.json', 'w+', encoding='utf8') as f:
-        json.dump(pos_json, f)
-    with open(filename + '.spans.json', 'w+', encoding='utf8') as f:
-        json.dump(multi_word_spans, f)
-    if coreferences:
-        with open(filename + '.coref.json', 'w+', encoding='utf8') as f:
-            json.dump(coreferences, f)
+    if args.json:
+        with open(filename + '.lemmas.json', 'w+', encoding='utf8') as f:
+            json.dump(lemmas_json, f)
+        with open(filename + '.pos.json', 'w+', encoding='utf8') as f:
+            json.dump(pos_json, f)
+        with open(filename + '.spans.json', 'w+', encoding='utf8') as f:
+            json.dump(multi_word_spans, f)
+        if coreferences:
+            with open(filename + '.coref.json', 'w+', encoding='utf8') as f:
+                json.dump(coreferences, f)
+    save_nlp_store(nlp_store_file(amr_file), (lemmas_json, multi_word_spans, coreferences, pos_json))
+
+    if shard_files:
+        for shard_file in shard_files:
+            os.remove(shard_file)
+        if not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
 
     # for amr in amrs:
     #     print(' '.join('_'.join(amr.tokens[t] for t in span) for span in multi_word_spans[amr.id]))
@@ -367,4 +721,5 @@ def main():
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     main()
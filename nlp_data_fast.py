@@ -7,6 +7,8 @@ import stanza
 from spacy.tokens.doc import Doc
 from tqdm import tqdm
 
+from nlp_data import token_offsets, find_token
+
 
 
 class NoTokenizer(object):
@@ -37,13 +39,7 @@ def main():
             if tok.startswith('@') and tok.endswith('@') and len(tok) == 3:
                 tokens[i] = tok[1]
         doc = nlp(' '.join(tokens))
-        start_idx = {}
-        end_idx = {}
-        i = 0
-        for j, tok in enumerate(tokens):
-            start_idx[j] = i
-            end_idx[j] = i + len(tok)
-            i += len(tok) + 1
+        start_idx, end_idx = token_offsets(tokens)
 
         convert_ids = {}
         stanza_lemmas = {}
@@ -52,10 +48,7 @@ def main():
             for token in s.tokens:
                 start = token.start_char
                 end = token.end_char
-                idx = [k for k in start_idx if start >= start_idx[k] and end <= end_idx[k]]
-                if len(idx) == 0:
-                    idx = [k for k in start_idx if start <= start_idx[k] <= end]
-                idx = idx[0]
+                idx = find_token(start_idx, end_idx, start, end)
                 convert_ids[start] = idx
                 for word in token.words:
                     if start not in stanza_lemmas:
@@ -1,5 +1,7 @@
 from amr_utils.alignments import AMR_Alignment
 
+from models.alignment_index import get_alignment, reindex_alignments
+
 
 def add_relation_alignment(amr, relation_alignments, edge, span):
     if not span:
@@ -8,6 +10,7 @@ def add_relation_alignment(amr, relation_alignments, edge, span):
         if align.tokens == span:
             new_align = align
             new_align.edges.append(edge)
+            reindex_alignments(amr, relation_alignments)
             return
     new_align = AMR_Alignment(type='relation', tokens=span, edges=[edge])
     relation_alignments[amr.id].append(new_align)
@@ -18,14 +21,14 @@ def rule_based_align_relations(amr, subgraph_alignments, relation_alignments):
     if amr.id not in relation_alignments:
         relation_alignments[amr.id] = []
     for s, r, t in amr.edges:
-        salign = amr.get_alignment(subgraph_alignments, node_id=s)
+        salign = get_alignment(amr, subgraph_alignments, node_id=s)
         if not salign.tokens:
             continue
         elif s in salign.nodes and t in salign.nodes:
             add_relation_alignment(amr, relation_alignments, (s, r, t), salign.tokens)
         elif any(r.startswith(prefix) for prefix in [':ARG', ':op', ':snt']):
             if r.endswith('-of'):
-                talign = amr.get_alignment(subgraph_alignments, node_id=t)
+                talign = get_alignment(amr, subgraph_alignments, node_id=t)
                 if not talign: continue
                 add_relation_alignment(amr, relation_alignments, (s, r, t), talign.tokens)
             else:
@@ -33,7 +36,7 @@ def rule_based_align_relations(amr, subgraph_alignments, relation_alignments):
         elif r == ':domain':
             add_relation_alignment(amr, relation_alignments, (s, r, t), salign.tokens)
         elif r in [':mod',':name',':polarity',':li']:
-            talign = amr.get_alignment(subgraph_alignments, node_id=t)
+            talign = get_alignment(amr, subgraph_alignments, node_id=t)
             if not talign: continue
             add_relation_alignment(amr, relation_alignments, (s, r, t), talign.tokens)
 
@@ -46,7 +49,7 @@ def exact_match_relations(amr, subgraph_alignments, relation_alignments):
             candidate_spans = [span for span in amr.spans if
                                ' '.join(amr.lemmas[t].lower() for t in span) == token_label]
             candidate_spans = [span for span in candidate_spans if
-                               not amr.get_alignment(subgraph_alignments, token_id=span[0])]
+                               not get_alignment(amr, subgraph_alignments, token_id=span[0])]
             if len(candidate_spans) == 1:
                 add_relation_alignment(amr, relation_alignments, (s, r, t), candidate_spans[0])
         elif r.startswith(':conj-'):
@@ -55,7 +58,7 @@ def exact_match_relations(amr, subgraph_alignments, relation_alignments):
             candidate_spans = [span for span in amr.spans if
                                ' '.join(amr.lemmas[t].lower() for t in span) == token_label]
             candidate_spans = [span for span in candidate_spans if
-                               not amr.get_alignment(subgraph_alignments, token_id=span[0])]
+                               not get_alignment(amr, subgraph_alignments, token_id=span[0])]
             if len(candidate_spans) == 1:
                 add_relation_alignment(amr, relation_alignments, (s, r, t), candidate_spans[0])
         elif r in [':poss', ':part']:
@@ -63,7 +66,7 @@ def exact_match_relations(amr, subgraph_alignments, relation_alignments):
             candidate_spans = [span for span in amr.spans if
                                ' '.join(amr.lemmas[t].lower() for t in span) in token_labels]
             candidate_spans = [span for span in candidate_spans if
-                               not amr.get_alignment(subgraph_alignments, token_id=span[0])]
+                               not get_alignment(amr, subgraph_alignments, token_id=span[0])]
             if len(candidate_spans) == 1:
                 add_relation_alignment(amr, relation_alignments, (s, r, t), candidate_spans[0])
 
@@ -97,9 +100,10 @@ def normalize_relation(edge):
 def rule_based_align_all_relations(amr, subgraph_alignments):
     for s, r, t in amr.edges:
         anchor = rule_based_anchor_relation((s,r,t))[0]
-        align = amr.get_alignment(subgraph_alignments, node_id=anchor)
+        align = get_alignment(amr, subgraph_alignments, node_id=anchor)
         if align:
             align.edges.append((s,r,t))
+            reindex_alignments(amr, subgraph_alignments)
 
 
 def english_ignore_tokens(amr, span):
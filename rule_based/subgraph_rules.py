@@ -4,6 +4,9 @@ from collections import Counter
 from amr_utils.alignments import AMR_Alignment
 from amr_utils.graph_utils import is_rooted_dag, get_connected_components
 
+from models.alignment_index import get_alignment, reindex_alignments
+from models.amr_graph import amr_graph
+
 
 ALIGN_SISTER_RELS = True
 
@@ -14,53 +17,55 @@ def postprocess_subgraph(amr, alignments, align, english=False):
     if not align.nodes:
         return
 
+    graph = amr_graph(amr)
     # First pass
-    for s, r, t in amr.edges:
+    for s, r, t in graph.scan_incident_edges(align.nodes):
         if t in align.nodes and s not in align.nodes:
-            if amr.nodes[s] == 'name' and r.startswith(':op') and not amr.get_alignment(alignments, node_id=s):
+            if amr.nodes[s] == 'name' and r.startswith(':op') and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
-            elif amr.nodes[s] == 'date-entity' and r != ':mod' and not r.endswith('-of') and not amr.get_alignment(
+            elif amr.nodes[s] == 'date-entity' and r != ':mod' and not r.endswith('-of') and not get_alignment(amr,
                     alignments, node_id=s):
                 align.nodes.append(s)
-            elif amr.nodes[s].endswith('-quantity') and r in [':quant', ':unit'] and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s].endswith('-quantity') and r in [':quant', ':unit'] and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
-            elif amr.nodes[s].endswith('-entity') and r == ':value' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s].endswith('-entity') and r == ':value' and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
-            elif amr.nodes[s] in ['have-degree-91', 'have-quant-91'] and r == ':ARG3' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] in ['have-degree-91', 'have-quant-91'] and r == ':ARG3' and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
-            elif amr.nodes[s] in ['have-rel-role-91', 'have-org-role-91'] and r in [':ARG2',':ARG3'] and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] in ['have-rel-role-91', 'have-org-role-91'] and r in [':ARG2',':ARG3'] and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
-            elif amr.nodes[s] == 'relative-position' and r == ':direction' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] == 'relative-position' and r == ':direction' and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
         elif s in align.nodes and t not in align.nodes:
-            if r == ':name' and not amr.get_alignment(alignments, node_id=t):
+            if r == ':name' and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
-            elif amr.nodes[t] in ['have-degree-91', 'have-quant-91'] and r == ':ARG3-of' and not amr.get_alignment(alignments, node_id=t):
+            elif amr.nodes[t] in ['have-degree-91', 'have-quant-91'] and r == ':ARG3-of' and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
-            elif amr.nodes[t] in ['have-rel-role-91', 'have-org-role-91'] and r in [':ARG2-of',':ARG3-of'] and not amr.get_alignment(alignments, node_id=t):
+            elif amr.nodes[t] in ['have-rel-role-91', 'have-org-role-91'] and r in [':ARG2-of',':ARG3-of'] and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
     # Second pass
-    for s, r, t in amr.edges:
+    for s, r, t in graph.scan_incident_edges(align.nodes):
         if t in align.nodes and s not in align.nodes:
-            if r == ':name' and not amr.get_alignment(alignments, node_id=s):
+            if r == ':name' and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
-            if amr.nodes[s] == 'publication-91' and r == ':ARG1' and not amr.get_alignment(alignments, node_id=s):
+            if amr.nodes[s] == 'publication-91' and r == ':ARG1' and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
         if s in align.nodes and t not in align.nodes:
             if amr.nodes[s] == 'name' and r.startswith(':op'):
-                talign = amr.get_alignment(alignments, node_id=t)
+                talign = get_alignment(amr, alignments, node_id=t)
                 if talign:
                     talign.nodes.remove(t)
+                    reindex_alignments(amr, alignments)
                 align.nodes.append(t)
-            elif amr.nodes[s] == 'date-entity' and r != ':mod' and not r.endswith('-of') and not amr.get_alignment(alignments, node_id=t):
+            elif amr.nodes[s] == 'date-entity' and r != ':mod' and not r.endswith('-of') and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
-            elif amr.nodes[s].endswith('-quantity') and r == ':unit' and not amr.get_alignment(alignments, node_id=t):
+            elif amr.nodes[s].endswith('-quantity') and r == ':unit' and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
     # Third pass
-    for s, r, t in amr.edges:
+    for s, r, t in graph.scan_incident_edges(align.nodes):
         if t in align.nodes and s not in align.nodes:
             if amr.nodes[s] == 'publication-91' and r == ':ARG1' and amr.nodes[t] in ['publication', 'book',
-                                                                                      'newspaper'] and not amr.get_alignment(
+                                                                                      'newspaper'] and not get_alignment(amr,
                     alignments, node_id=s):
                 align.nodes.append(s)
     if english:
@@ -72,67 +77,68 @@ def _postprocess_subgraph_english(amr, alignments, align):
     if not align.nodes:
         return
 
-    for s, r, t in amr.edges:
+    graph = amr_graph(amr)
+    for s, r, t in graph.scan_incident_edges(align.nodes):
         if t in align.nodes and s not in align.nodes:
-            if amr.nodes[s] == 'person' and r == ':ARG0-of' and not amr.get_alignment(alignments, node_id=s):
+            if amr.nodes[s] == 'person' and r == ':ARG0-of' and not get_alignment(amr, alignments, node_id=s):
                 if amr.nodes[t] in ['have-org-role-91', 'have-rel-role-91']:
                     align.nodes.append(s)
                 elif any(amr.lemmas[align.tokens[-1]].endswith(s) for s in ['er', 'or', 'ist']):
                     align.nodes.append(s)
-            elif amr.nodes[s] == 'thing' and r in [':ARG0-of', ':ARG1-of', ':ARG2-of'] and not amr.get_alignment(
+            elif amr.nodes[s] == 'thing' and r in [':ARG0-of', ':ARG1-of', ':ARG2-of'] and not get_alignment(amr,
                     alignments, node_id=s):
                 if any(amr.lemmas[align.tokens[-1]].endswith(s) for s in ['ment', 'tion', 'sion']):
                     align.nodes.append(s)
                 elif r == ':ARG1-of':
                     align.nodes.append(s)
             # E.g., "flammable"
-            elif amr.nodes[s] == 'possible-01' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] == 'possible-01' and not get_alignment(amr, alignments, node_id=s):
                 if any(amr.lemmas[tok].lower().endswith('able') or amr.lemmas[tok].lower().endswith('ible') for tok in
                        align.tokens):
                     align.nodes.append(s)
             # E.g., "highest"
-            elif amr.nodes[s] == 'have-degree-91' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] == 'have-degree-91' and not get_alignment(amr, alignments, node_id=s):
                 tok = amr.tokens[align.tokens[-1]]
                 if r == ':ARG2' and (tok.endswith('est') or tok.endswith('er')):
                     align.nodes.append(s)
             # E.g., "Many have criticized the article."
-            elif amr.nodes[s] == 'person' and r == ':quant' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] == 'person' and r == ':quant' and not get_alignment(amr, alignments, node_id=s):
                 next_tok = align.tokens[-1] + 1
                 if next_tok < len(amr.lemmas) and amr.lemmas[next_tok].lower() in ['have', 'be']:
                     align.nodes.append(s)
             # E.g., "Many were stolen by burglers."
-            elif amr.nodes[s] == 'thing' and r == ':quant' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] == 'thing' and r == ':quant' and not get_alignment(amr, alignments, node_id=s):
                 next_tok = align.tokens[-1] + 1
                 if next_tok < len(amr.lemmas) and amr.lemmas[next_tok].lower() in ['have', 'be']:
                     align.nodes.append(s)
-            elif amr.nodes[s] in ['after','before'] and r == ':op1'  and amr.nodes[t]=='now' and not amr.get_alignment(alignments, node_id=s):
+            elif amr.nodes[s] in ['after','before'] and r == ':op1'  and amr.nodes[t]=='now' and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
         elif s in align.nodes and t not in align.nodes:
             # imperative
-            if amr.nodes[t] == 'imperative' and r == ':mode' and not amr.get_alignment(alignments, node_id=t):
+            if amr.nodes[t] == 'imperative' and r == ':mode' and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
             elif amr.nodes[t] == 'you' and r == ':ARG0' \
                     and not any(
                 len(span) == 1 and amr.lemmas[span[0]] in ['you', 'your', 'yours', "y'all"] for span in amr.spans) \
-                    and not amr.get_alignment(alignments, node_id=t):
+                    and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
             # E.g., "flammable"
-            elif amr.nodes[t] == 'possible-01' and r == ':ARG1-of' and not amr.get_alignment(alignments, node_id=t):
+            elif amr.nodes[t] == 'possible-01' and r == ':ARG1-of' and not get_alignment(amr, alignments, node_id=t):
                 if any(amr.lemmas[tok].lower().endswith('able') or amr.lemmas[tok].lower().endswith('ible') for tok in
                        align.tokens):
                     align.nodes.append(t)
-            elif amr.nodes[s] in ['after','before'] and r == ':op1'  and amr.nodes[t]=='now' and not amr.get_alignment(alignments, node_id=t):
+            elif amr.nodes[s] in ['after','before'] and r == ':op1'  and amr.nodes[t]=='now' and not get_alignment(amr, alignments, node_id=t):
                 align.nodes.append(t)
     # second pass
-    for s, r, t in amr.edges:
+    for s, r, t in graph.scan_incident_edges(align.nodes):
         if t in align.nodes and s not in align.nodes:
             # E.g., "The city of Paris."
             if 'of' in [amr.tokens[t].lower() for t in align.tokens] and \
-                    amr.nodes[s] == 'mean-01' and not amr.get_alignment(alignments, node_id=s):
+                    amr.nodes[s] == 'mean-01' and not get_alignment(amr, alignments, node_id=s):
                 align.nodes.append(s)
         elif s in align.nodes and t not in align.nodes:
             # E.g., "highest"
-            if amr.nodes[s] == 'have-degree-91' and not amr.get_alignment(alignments, node_id=t):
+            if amr.nodes[s] == 'have-degree-91' and not get_alignment(amr, alignments, node_id=t):
                 tok = amr.tokens[align.tokens[-1]]
                 if r == ':ARG3' and amr.nodes[t] in ['more', 'most'] and (tok.endswith('est') or tok.endswith('er')):
                     align.nodes.append(t)
@@ -183,11 +189,11 @@ def fuzzy_align_subgraphs(amr, alignments, english=False):
             parts = [(int(r[3:]), t) for s, r, t in amr.edges if s == n and r.startswith(':op')]
             parts = [t for r, t in sorted(parts, key=lambda x: x[0])]
             label = ' '.join(amr.nodes[t].replace('"', '') for t in parts)
-            candidate_spans = [span for span in amr.spans if not amr.get_alignment(alignments, token_id=span[0])]
+            candidate_spans = [span for span in amr.spans if not get_alignment(amr, alignments, token_id=span[0])]
             candidate_spans = [span for span in candidate_spans if normalize_token_label(amr, span).lower() == label.lower()]
             if candidate_spans:
                 span = candidate_spans[0]
-                align = amr.get_alignment(alignments, token_id=span[0])
+                align = get_alignment(amr, alignments, token_id=span[0])
                 align.nodes.append(n)
                 aligned_nodes.add(n)
                 for t in parts:
@@ -202,12 +208,12 @@ def fuzzy_align_subgraphs(amr, alignments, english=False):
                         acronym += letter
                 if len(acronym) >= 2:
                     candidate_spans = [span for span in amr.spans if
-                                       not amr.get_alignment(alignments, token_id=span[0])]
+                                       not get_alignment(amr, alignments, token_id=span[0])]
                     candidate_spans = [span for span in candidate_spans if
                                        len(span) == 1 and normalize_token_label(amr, span) == acronym]
                     if candidate_spans:
                         span = candidate_spans[0]
-                        align = amr.get_alignment(alignments, token_id=span[0])
+                        align = get_alignment(amr, alignments, token_id=span[0])
                         for t in parts:
                             align.nodes.append(t)
                             aligned_nodes.add(t)
@@ -216,13 +222,13 @@ def fuzzy_align_subgraphs(amr, alignments, english=False):
                 for start in range(len(amr.tokens)):
                     span = [t for t in range(start, start + len(parts))]
                     if span[-1] >= len(amr.tokens): continue
-                    if amr.get_alignment(alignments, token_id=span[0]): continue
+                    if get_alignment(amr, alignments, token_id=span[0]): continue
                     if normalize_token_label(amr, span) == label:
                         tok = span[0]
                         if any(len(amr.tokens[t]) >= 4 for t in span):
                             while len(amr.tokens[tok]) <= 3:
                                 tok += 1
-                        align = amr.get_alignment(alignments, token_id=tok)
+                        align = get_alignment(amr, alignments, token_id=tok)
                         if align: continue
                         for t in parts:
                             align.nodes.append(t)
@@ -245,7 +251,7 @@ def fuzzy_align_subgraphs(amr, alignments, english=False):
                     candidate_spans.append(span)
             if len(candidate_spans) == 1:
                 span = candidate_spans[0]
-                align = amr.get_alignment(alignments, token_id=span[0])
+                align = get_alignment(amr, alignments, token_id=span[0])
                 if any(amr.nodes[n2] == amr.nodes[n] for n2 in align.nodes):
                     continue
                 align.nodes.append(n)
@@ -274,11 +280,11 @@ def fuzzy_align_subgraphs(amr, alignments, english=False):
                     candidate_spans += [span for span in amr.spans
                                     if normalize_lemma_label(amr, span)[:prefix_size].lower() == label.split('-')[0][:prefix_size].lower()
                                     and span not in candidate_spans]
-                candidate_spans = [span for span in candidate_spans if not amr.get_alignment(alignments, token_id=span[0])]
+                candidate_spans = [span for span in candidate_spans if not get_alignment(amr, alignments, token_id=span[0])]
                 if len(candidate_spans) != 1:
                     continue
                 candidate_nodes = [n2 for n2 in amr.nodes if
-                                   amr.nodes[n2].replace('"', '')[0].isalpha() and not amr.get_alignment(alignments, node_id=n2) and
+                                   amr.nodes[n2].replace('"', '')[0].isalpha() and not get_alignment(amr, alignments, node_id=n2) and
                                    not amr.nodes[n2].endswith('-91')]
                 candidate_nodes = [n2 for n2 in candidate_nodes if
                                    node_label(amr, n2)[:prefix_size] == label[:prefix_size]
@@ -294,7 +300,7 @@ def fuzzy_align_subgraphs(amr, alignments, english=False):
                 if len(candidate_nodes) != 1:
                     continue
                 span = candidate_spans[0]
-                align = amr.get_alignment(alignments, token_id=span[0])
+                align = get_alignment(amr, alignments, token_id=span[0])
                 align.nodes.append(n)
                 aligned_nodes.add(n)
                 break
@@ -312,11 +318,11 @@ def fuzzy_align_subgraphs(amr, alignments, english=False):
                     continue
             candidate_spans = [span for span in amr.spans if any(amr.lemmas[t].lower() == node_label(amr, n).lower() for t in span)]
             candidate_spans = [span for span in candidate_spans if not any(node_label(amr, n2) == node_label(amr, n)
-                                                                            for n2 in amr.get_alignment(alignments, token_id=span[0]).nodes)]
-            candidate_nodes = [n2 for n2 in amr.nodes if node_label(amr, n) == node_label(amr, n2) and not amr.get_alignment(alignments, node_id=n2)]
+                                                                            for n2 in get_alignment(amr, alignments, token_id=span[0]).nodes)]
+            candidate_nodes = [n2 for n2 in amr.nodes if node_label(amr, n) == node_label(amr, n2) and not get_alignment(amr, alignments, node_id=n2)]
             if len(candidate_spans) == 1 and len(candidate_nodes) == 1:
                 span = candidate_spans[0]
-                align = amr.get_alignment(alignments, token_id=span[0])
+                align = get_alignment(amr, alignments, token_id=span[0])
                 align.nodes.append(n)
     if english:
         _exact_align_subgraphs_english(amr, alignments)
@@ -339,7 +345,7 @@ def _exact_align_subgraphs_english(amr, alignments):
     # Months, dates, numbers, times
     for n in amr.nodes:
         if amr.nodes[n][0].isdigit():
-            align = amr.get_alignment(alignments, node_id=n)
+            align = get_alignment(amr, alignments, node_id=n)
             candidate_spans = []
             if not align:
                 label = amr.nodes[n]
@@ -424,7 +430,7 @@ def _exact_align_subgraphs_english(amr, alignments):
                                 candidate_spans.append(span)
             if len(candidate_spans) == 1:
                 span = candidate_spans[0]
-                align = amr.get_alignment(alignments, token_id=span[0])
+                align = get_alignment(amr, alignments, token_id=span[0])
                 if any(amr.nodes[n2] == amr.nodes[n] for n2 in align.nodes):
                     continue
                 align.nodes.append(n)
@@ -449,19 +455,19 @@ def _exact_align_subgraphs_english(amr, alignments):
                                len(span) == 1 and amr.lemmas[span[0]].lower() in candidate_strings[amr.nodes[n]]]
             if candidate_spans:
                 for span in candidate_spans:
-                    span_align = amr.get_alignment(alignments, token_id=span[0])
+                    span_align = get_alignment(amr, alignments, token_id=span[0])
                     if span_align:
                         span_align.nodes = []
-                span_align = amr.get_alignment(alignments, token_id=candidate_spans[0][0])
+                span_align = get_alignment(amr, alignments, token_id=candidate_spans[0][0])
                 span_align.nodes.append(n)
             continue
-        align = amr.get_alignment(alignments, node_id=n)
+        align = get_alignment(amr, alignments, node_id=n)
         if not align:
             candidate_spans = []
             # exact match for 'and' and 'multi-sentence'
             if amr.nodes[n] in ['and', 'multi-sentence']:
                 label = amr.nodes[n]
-                candidate_spans = [span for span in amr.spans if not amr.get_alignment(alignments, token_id=span[0])]
+                candidate_spans = [span for span in amr.spans if not get_alignment(amr, alignments, token_id=span[0])]
                 if label == 'and':
                     candidate_spans = [span for span in candidate_spans if
                                         ' '.join(amr.lemmas[t] for t in span).lower() in ['and', '&', 'additionally',
@@ -481,70 +487,70 @@ def _exact_align_subgraphs_english(amr, alignments):
             elif amr.nodes[n] == 'have-03':
                 candidate_spans = [span for span in amr.spans if
                                     len(span) == 1 and amr.lemmas[span[0]].lower() in ['have', 'with', "'s"]]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for 'person'
             elif amr.nodes[n] == 'person':
                 candidate_spans = [span for span in amr.spans if
                                     len(span) == 1 and amr.lemmas[span[0]].lower() in ['person', 'people']]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for 'include-91'
             elif amr.nodes[n] == 'include-91':
                 candidate_spans = [span for span in amr.spans if
                                     ' '.join(amr.lemmas[t] for t in span).lower() in ['include', 'out of']]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for 'instead-of-91'
             elif amr.nodes[n] == 'instead-of-91':
                 candidate_spans = [span for span in amr.spans if
                                    ' '.join(amr.lemmas[t] for t in span).lower() in ['instead', 'instead of']]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for 'cause-01'
             elif amr.nodes[n] == 'cause-01':
                 candidate_spans = [span for span in amr.spans if
                                     ' '.join(amr.lemmas[t] for t in span).lower() in
                                     ['thus', 'since', 'because', 'cause', 'such', 'such that', 'so', 'therefore',
                                      'out of', 'due to', 'thanks to', 'reason', 'why', 'how', 'consequently', ',']]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for polarity -
             elif amr.nodes[n] == '-':
                 candidate_spans = [span for span in amr.spans if
                                     ' '.join(amr.lemmas[t] for t in span).lower() in
                                     ['not', "n't", 'non', 'without', 'no', 'none', 'never', 'neither', 'no one']]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for amr-unknown
             elif amr.nodes[n] == 'amr-unknown':
                 if any(r == ':polarity' and t == n for s, r, t in amr.edges):
                     candidate_spans = [span for span in amr.spans if
                                         ' '.join(amr.lemmas[t] for t in span).lower() in ['?']]
-                    candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                    candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
 
                 else:
                     candidate_spans = [span for span in amr.spans if ' '.join(amr.lemmas[t] for t in span).lower() in
                                         ['why', 'how', 'when', 'where', 'who', 'which', 'what', 'how many', 'how long',
                                          'how much']]
-                    candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                    candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for rate-entity-91
             elif amr.nodes[n] == 'rate-entity-91':
                 candidate_spans = [span for span in amr.spans if
                                     ' '.join(amr.lemmas[t] for t in span).lower() in
                                     ['per', 'every', 'monthly', 'weekly', 'weekly', 'annually', 'annual', 'daily',
                                      'hourly']]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # exact match for mean-01
             elif amr.nodes[n] == 'mean-01':
                 candidate_spans = [span for span in amr.spans if
                                     len(span) == 1 and amr.lemmas[span[0]].lower() in [':', ',', ]]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
             # United States
             elif amr.nodes[n] == 'name' and {amr.nodes[t].replace('"', '') for s, r, t in amr.edges if
                                              s == n and r.startswith(':op')} in [
                 {'United', 'States'}, {'America'}, {'United', 'States', 'of', 'America'}]:
                 candidate_spans = [span for span in amr.spans
                                     if not any(amr.nodes[n2].replace('"', '') in ['United', 'States', 'America']
-                                               for n2 in amr.get_alignment(alignments, token_id=span[0]).nodes)]
+                                               for n2 in get_alignment(amr, alignments, token_id=span[0]).nodes)]
                 candidate_spans = [span for span in candidate_spans if any(amr.lemmas[t].replace('.', '') in
                                                                              ['American', 'US', 'USA'] for t in span)]
             candidate_nodes = [n2 for n2 in amr.nodes if
-                               amr.nodes[n] == amr.nodes[n2] and not amr.get_alignment(alignments, node_id=n2)]
+                               amr.nodes[n] == amr.nodes[n2] and not get_alignment(amr, alignments, node_id=n2)]
             if amr.nodes[n] == 'name':
                 name = {amr.nodes[t].replace('"', '') for s, r, t in amr.edges if s == n and r.startswith(':op')}
                 candidate_nodes = [n2 for n2 in candidate_nodes if
@@ -552,10 +558,10 @@ def _exact_align_subgraphs_english(amr, alignments):
                                     s == n2 and r.startswith(':op')} == name]
             if len(candidate_spans) == 1 and len(candidate_nodes) == 1:
                 span = candidate_spans[0]
-                align = amr.get_alignment(alignments, token_id=span[0])
+                align = get_alignment(amr, alignments, token_id=span[0])
                 align.nodes.append(n)
     for span in amr.spans:
-        align = amr.get_alignment(alignments, token_id=span[0])
+        align = get_alignment(amr, alignments, token_id=span[0])
         if not align:
             candidate_spans = []
             candidate_nodes = []
@@ -563,35 +569,35 @@ def _exact_align_subgraphs_english(amr, alignments):
             # exact match for 'how'
             if label == 'how':
                 candidate_spans = [s for s in amr.spans if len(s) == 1 and amr.lemmas[s[0]] == label]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
                 candidate_nodes = []
                 for n in amr.nodes:
-                    if amr.nodes[n] == 'thing' and not amr.get_alignment(alignments, node_id=n):
+                    if amr.nodes[n] == 'thing' and not get_alignment(amr, alignments, node_id=n):
                         if any((s == n and r == ':manner-of') or (t == 'n' and r == ':manner') for s, r, t in
                                amr.edges):
                             candidate_nodes.append(n)
-                    elif amr.nodes[n] == 'so' and not amr.get_alignment(alignments, node_id=n):
+                    elif amr.nodes[n] == 'so' and not get_alignment(amr, alignments, node_id=n):
                         so_tokens = [s for s in amr.spans if len(s) == 1 and amr.lemmas[s[0]] == 'so']
-                        so_tokens = [s for s in so_tokens if not amr.get_alignment(alignments, token_id=s[0])]
+                        so_tokens = [s for s in so_tokens if not get_alignment(amr, alignments, token_id=s[0])]
                         if not so_tokens:
                             candidate_nodes.append(n)
-                    elif amr.nodes[n] == 'have-manner-91' and not amr.get_alignment(alignments, node_id=n):
+                    elif amr.nodes[n] == 'have-manner-91' and not get_alignment(amr, alignments, node_id=n):
                         candidate_nodes.append(n)
                 if len(candidate_spans) == 1 and len(candidate_nodes) == 1:
-                    align = amr.get_alignment(alignments, token_id=span[0])
+                    align = get_alignment(amr, alignments, token_id=span[0])
                     align.nodes.append(candidate_nodes[0])
             # as ... as construction
             elif label == 'as':
                 candidate_spans = [s for s in amr.spans if len(s) == 1 and amr.lemmas[s[0]] == label]
-                candidate_spans = [s for s in candidate_spans if not amr.get_alignment(alignments, token_id=s[0])]
-                candidate_nodes = [n for n in amr.nodes if not amr.get_alignment(alignments, node_id=n)]
+                candidate_spans = [s for s in candidate_spans if not get_alignment(amr, alignments, token_id=s[0])]
+                candidate_nodes = [n for n in amr.nodes if not get_alignment(amr, alignments, node_id=n)]
                 candidate_nodes = [n for n in candidate_nodes if amr.nodes[n] in ['equal']]
                 if len(candidate_spans) <= 2 and len(candidate_nodes) == 1 and span == candidate_spans[0]:
-                    align = amr.get_alignment(alignments, token_id=span[0])
+                    align = get_alignment(amr, alignments, token_id=span[0])
                     align.nodes.append(candidate_nodes[0])
                     continue
                 if len(candidate_spans) == 1 and len(candidate_nodes) == 1:
-                    align = amr.get_alignment(alignments, token_id=span[0])
+                    align = get_alignment(amr, alignments, token_id=span[0])
                     align.nodes.append(candidate_nodes[0])
             # try un- non-
             elif len(span) == 1 and any(label.startswith(neg) for neg in ['un', 'non', 'in', 'im','il']):
@@ -599,19 +605,19 @@ def _exact_align_subgraphs_english(amr, alignments):
                 candidate_spans = [span for span in amr.spans if
                                     len(span) == 1 and amr.lemmas[span[0]][:6] == label[:6]]
                 candidate_spans = [span for span in candidate_spans if
-                                    not amr.get_alignment(alignments, token_id=span[0])]
+                                    not get_alignment(amr, alignments, token_id=span[0])]
                 candidate_nodes = []
                 minus = None
                 label = label[len(prefix):]
                 for n in amr.nodes:
                     if amr.nodes[n].split('-')[0][:4] == label[:4]:
-                        if amr.get_alignment(alignments, node_id=n): continue
+                        if get_alignment(amr, alignments, node_id=n): continue
                         m = [t for s, r, t in amr.edges if s == n and r == ':polarity' and amr.nodes[t] == '-']
-                        if m and not amr.get_alignment(alignments, node_id=m[0]):
+                        if m and not get_alignment(amr, alignments, node_id=m[0]):
                             candidate_nodes.append(n)
                             minus = m[0]
                 if len(candidate_spans) == 1 and len(candidate_nodes) == 1:
-                    align = amr.get_alignment(alignments, token_id=span[0])
+                    align = get_alignment(amr, alignments, token_id=span[0])
                     align.nodes.append(candidate_nodes[0])
                     align.nodes.append(minus)
             # WSJ Date format
@@ -630,7 +636,7 @@ def _exact_align_subgraphs_english(amr, alignments):
                     day = int(label[4:])
                 for n in amr.nodes:
                     if amr.nodes[n] == 'date-entity':
-                        if amr.get_alignment(alignments, node_id=n):
+                        if get_alignment(amr, alignments, node_id=n):
                             continue
                         year_node = [t for s, r, t in amr.edges if s == n and r == ':year']
                         month_node = [t for s, r, t in amr.edges if s == n and r == ':month']
@@ -701,10 +707,11 @@ def clean_subgraph(amr, alignments, align):
         components = separate_components(amr, align)
         found = False
         for n in amr.nodes:
-            if amr.get_alignment(alignments, node_id=n):
+            if get_alignment(amr, alignments, node_id=n):
                 continue
             if all(any(s == n and t in sub.nodes for s, r, t in amr.edges) for sub in components):
                 align.nodes.append(n)
+                reindex_alignments(amr, alignments)
                 found = True
                 break
         if not found:
@@ -0,0 +1,28 @@
+import argparse
+
+from models.base_model import Serializable
+
+parser = argparse.ArgumentParser()
+parser.add_argument('model_file', type=str,
+                    help='pickled model, e.g. ldc+little_prince.subgraph_params.pkl')
+parser.add_argument('output_file', type=str, nargs='?', default=None,
+                    help='model file to write (default: the model file with .pkl replaced by .params)')
+
+
+def converted_file(model_file):
+    return (model_file[:-len('.pkl')] if model_file.endswith('.pkl') else model_file) + '.params'
+
+
+def main():
+    # convert a pickled model to the compact model file format
+    args = parser.parse_args()
+    output_file = args.output_file if args.output_file else converted_file(args.model_file)
+
+    print('Loading model from:', args.model_file)
+    model = Serializable.load_model(args.model_file)
+    print('Saving model to:', output_file)
+    model.save_model(output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import sys
+
+from nlp_annotations import load_nlp_data, nlp_store_file, save_nlp_store
+
+
+def main():
+    # convert the JSON annotation files of an AMR file (.lemmas.json, .spans.json, .coref.json, .pos.json)
+    # to the memory-mapped annotation store read by add_nlp_data
+    amr_file = sys.argv[1]
+
+    print('Loading NLP annotations for:', amr_file)
+    nlp_data = load_nlp_data(amr_file)
+    print('Saving NLP annotations to:', nlp_store_file(amr_file))
+    save_nlp_store(nlp_store_file(amr_file), nlp_data)
+
+
+if __name__ == '__main__':
+    main()
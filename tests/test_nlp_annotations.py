@@ -0,0 +1,75 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from models.array_file import is_array_file, load_arrays, save_arrays
+from nlp_annotations import JSON_Stream, NLP_Store, iter_json_items, load_nlp_data, nlp_store_file, save_nlp_store
+
+
+def test_array_file_round_trip(tmp_path):
+    file = str(tmp_path / 'arrays')
+    arrays = {'ints': np.arange(10, dtype=np.int32),
+              'floats': np.linspace(0, 1, 7),
+              'bytes': np.frombuffer('café\0x'.encode('utf8'), dtype=np.uint8),
+              'matrix': np.arange(12, dtype=np.int64).reshape(3, 4),
+              'empty': np.zeros(0, dtype=np.int32)}
+    save_arrays(file, {'format': 'test', 'n': 3}, arrays)
+    assert is_array_file(file)
+    for mmap in [True, False]:
+        header, loaded = load_arrays(file, mmap=mmap)
+        assert header == {'format': 'test', 'n': 3}
+        assert set(loaded) == set(arrays)
+        for name, a in arrays.items():
+            assert loaded[name].dtype == a.dtype
+            assert np.array_equal(loaded[name], a)
+
+
+NLP_DATA = (
+    {'a': ['the', 'boy', 'want'], 'b': ['café'], 'c': []},
+    {'a': [[0], [1], [2, 3]], 'b': [[0]], 'c': []},
+    {'a': [[[0], [2]]], 'b': [], 'c': [[[0, 1], [3]], []]},
+    {'a': ['DT', 'NN', 'VBZ'], 'b': ['NN'], 'c': [], 'd': ['NN']},
+)
+
+
+def test_nlp_store_round_trip(tmp_path):
+    file = str(tmp_path / 'corpus.nlp')
+    save_nlp_store(file, NLP_DATA)
+    store = NLP_Store(file)
+    for table, column in zip(NLP_DATA, [store.lemmas, store.spans, store.coref, store.pos]):
+        assert dict(column) == table
+        assert len(column) == len(table)
+    assert 'd' in store.pos and 'd' not in store.lemmas
+
+
+def test_load_nlp_data_prefers_newer_store(tmp_path):
+    amr_file = str(tmp_path / 'corpus.txt')
+    for name, table in zip(['lemmas', 'spans', 'coref', 'pos'], NLP_DATA):
+        with open(str(tmp_path / f'corpus.{name}.json'), 'w') as f:
+            json.dump(table, f)
+    assert [dict(t) for t in load_nlp_data(amr_file)] == list(NLP_DATA)
+    save_nlp_store(nlp_store_file(amr_file), NLP_DATA)
+    lemmas, spans, corefs, pos = load_nlp_data(amr_file)
+    assert isinstance(lemmas, type(NLP_Store(nlp_store_file(amr_file)).lemmas))
+    assert [dict(t) for t in (lemmas, spans, corefs, pos)] == list(NLP_DATA)
+    # a JSON file written after the store is read instead of it
+    os.utime(nlp_store_file(amr_file), (0, 0))
+    assert isinstance(load_nlp_data(amr_file)[0], dict)
+
+
+def test_json_stream(tmp_path):
+    file = str(tmp_path / 'lemmas.json')
+    table = {f'id{i}': [f'lemma "{i}"', i, [i / 2]] for i in range(200)}
+    with open(file, 'w') as f:
+        json.dump(table, f, indent=1)
+    for chunk_size in [1, 7, 1 << 20]:
+        assert dict(iter_json_items(file, chunk_size)) == table
+    stream = JSON_Stream(file)
+    assert stream['id3'] == table['id3']
+    assert stream['id0'] == table['id0']
+    assert stream['id3'] == table['id3']
+    assert stream['id199'] == table['id199']
+    with pytest.raises(KeyError):
+        stream['missing']
@@ -0,0 +1,136 @@
+import random
+
+import pytest
+
+from nlp_data import build_mwe_trie, find_mwe_spans, find_token, get_mwe_trie, stanza_tokens, token_offsets
+
+
+def scan_find_token(tokens, start, end):
+    # the scan over all tokens that find_token replaced
+    start_idx = {}
+    end_idx = {}
+    i = 0
+    for j, tok in enumerate(tokens):
+        start_idx[j] = i
+        end_idx[j] = i + len(tok)
+        i += len(tok) + 1
+    idx = [k for k in start_idx if start >= start_idx[k] and end <= end_idx[k]]
+    if len(idx) == 0:
+        idx = [k for k in start_idx if start <= start_idx[k] <= end]
+    return idx[0]
+
+
+SENTENCES = [
+    ['The', 'boy', 'wants', 'to', 'go', '.'],
+    ['a', 'well', '-', 'known', 'fact'],
+    ['state', '-', 'of', '-', 'the', '-', 'art', 'U.S.', 'policy'],
+    ['$', '100', 'million', '(', 'approx', '.', ')'],
+    ['x'],
+]
+
+
+@pytest.mark.parametrize('tokens', SENTENCES)
+def test_find_token_matches_scan(tokens):
+    start_idx, end_idx = token_offsets(tokens)
+    text = ' '.join(tokens)
+    for start in range(len(text)):
+        for end in range(start, len(text) + 1):
+            try:
+                expected = scan_find_token(tokens, start, end)
+            except IndexError:
+                with pytest.raises(IndexError):
+                    find_token(start_idx, end_idx, start, end)
+                continue
+            assert find_token(start_idx, end_idx, start, end) == expected, (start, end)
+
+
+def test_find_token_stanza_tokens():
+    # stanza splits 'well-known' differently from the AMR tokens 'well @-@ known' (sent as 'well - known')
+    tokens = ['a', 'well', '-', 'known', 'fact']
+    start_idx, end_idx = token_offsets(tokens)
+    text = ' '.join(tokens)
+    for word in ['a', 'well', '-', 'known', 'fact']:
+        start = text.index(word)
+        assert find_token(start_idx, end_idx, start, start + len(word)) == tokens.index(word)
+    # a stanza token spanning several AMR tokens maps to the first one
+    assert find_token(start_idx, end_idx, text.index('well'), text.index('fact')) == 1
+
+
+def test_stanza_tokens_offsets():
+    class AMR:
+        tokens = ['well', '@-@', 'known', '@:@', '@x']
+
+    tokens = stanza_tokens(AMR())
+    assert tokens == ['well', '-', 'known', ':', '@x']
+    start_idx, end_idx = token_offsets(tokens)
+    assert ' '.join(tokens)[start_idx[2]:end_idx[2]] == 'known'
+
+
+def greedy_mwe_spans(tokens, lemmas, mwe_types):
+    # the loop over MWEs by first token that the trie replaced
+    mwe_types = sorted((tuple(mwe.split()) for mwe in mwe_types), key=len, reverse=True)
+    mwes_by_first_token = {}
+    for mwe in mwe_types:
+        mwes_by_first_token.setdefault(mwe[0], []).append(mwe)
+    spans = []
+    taken = []
+    for i, token in enumerate(tokens):
+        if i in taken:
+            continue
+        found = False
+        for words in [tokens, lemmas]:
+            first = words[i].lower()
+            for mwe in mwes_by_first_token.get(first, []):
+                size = len(mwe)
+                if i + size - 1 >= len(tokens):
+                    continue
+                if all(words[i + k].lower().replace('@', '') == mwe[k] for k in range(size)):
+                    spans.append((i, i + size))
+                    taken.extend(range(i, i + size))
+                    found = True
+                    break
+            if found:
+                break
+        taken.append(i)
+    return spans
+
+
+MWES = ['as well', 'as well as', 'well - known', 'in front of', 'front of', 'of course', 'take care of',
+        'care of', 'take care']
+
+
+def test_mwe_overlapping():
+    trie = build_mwe_trie(MWES)
+    tokens = 'he took care of it as well as in front of the house of course'.split()
+    lemmas = 'he take care of it as well as in front of the house of course'.split()
+    assert find_mwe_spans(tokens, lemmas, trie) == greedy_mwe_spans(tokens, lemmas, MWES)
+    # the longest MWE wins, and matches do not overlap
+    assert find_mwe_spans(tokens, lemmas, trie) == [(1, 4), (5, 8), (8, 11), (13, 15)]
+
+
+def test_mwe_hyphens():
+    trie = build_mwe_trie(MWES)
+    tokens = ['a', 'well', '@-@', 'known', 'fact', '@as', 'well']
+    assert find_mwe_spans(tokens, tokens, trie) == greedy_mwe_spans(tokens, tokens, MWES) == [(1, 4)]
+
+
+def test_mwe_random_sentences():
+    trie = build_mwe_trie(MWES)
+    words = sorted({w for mwe in MWES for w in mwe.split()}) + ['@-@', 'As', 'the', 'x@']
+    rng = random.Random(0)
+    for _ in range(2000):
+        tokens = [rng.choice(words) for _ in range(rng.randint(1, 12))]
+        lemmas = [rng.choice(words) if rng.random() < 0.3 else tok for tok in tokens]
+        assert find_mwe_spans(tokens, lemmas, trie) == greedy_mwe_spans(tokens, lemmas, MWES), (tokens, lemmas)
+
+
+def test_mwe_trie_of_mwe_lists():
+    from rule_based import mwes
+
+    hyphenated = [' - '.join(mwe.split()) for mwe in mwes.OTHER_MWES]
+    mwe_types = set(mwes.PMWES + mwes.VMWES + mwes.OTHER_MWES + mwes.HAND_ADDED_MWES + hyphenated)
+    trie = get_mwe_trie()
+    assert trie == build_mwe_trie(mwe_types)
+    for mwe in sorted(mwe_types)[::10]:
+        tokens = ['the'] + mwe.split() + ['of']
+        assert find_mwe_spans(tokens, tokens, trie) == greedy_mwe_spans(tokens, tokens, mwe_types)
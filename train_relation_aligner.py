@@ -1,9 +1,12 @@
 import sys
+from functools import partial
 
 from amr_utils.amr_readers import AMR_Reader
-from evaluate.utils import perplexity, evaluate_relations
+from evaluate.utils import perplexity, perplexity_sum, print_perplexity, evaluate_relations
 from models.relation_model import Relation_Model
-from nlp_data import add_nlp_data
+from models.count_table import Stepwise_Counts
+from amr_cache import load_amrs
+from amr_shards import AMR_Shards
 
 
 USE_GOLD_SUBGRAPHS = False
@@ -22,6 +25,16 @@ parser.add_argument('--save-model', type=str,
                     help='params file to store the trained model')
 parser.add_argument('--load-model', type=str,
                     help='params file to load model')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes to align AMRs and count parameters in parallel')
+parser.add_argument('--batch-size', type=int,
+                    help='train with stepwise EM, updating parameters after each mini-batch of this many AMRs '
+                         '(by default parameters are updated once per epoch)')
+parser.add_argument('--stepwise-decay', type=float, default=0.7,
+                    help='stepwise EM: mini-batch k is interpolated with weight (k+1)^-decay, 0.5 < decay <= 1')
+parser.add_argument('--sharded', action='store_true',
+                    help='the train path is a directory of AMR files (shards), each with its own nlp data, '
+                         'which are loaded one at a time; alignments are written next to each shard')
 args = parser.parse_args()
 
 def report_progress(amr_file, alignments, reader, epoch=None):
@@ -35,21 +48,26 @@ def main():
     amr_file = args.train
 
     reader = AMR_Reader()
-    amrs = reader.load(amr_file, remove_wiki=True)
-    add_nlp_data(amrs, amr_file)
-
-    align_file = amr_file.replace('.txt', '') + '.subgraph_alignments.json'
-    subgraph_alignments = reader.load_alignments_from_json(align_file, amrs)
+    if args.sharded:
+        # holds the subgraph alignments of the shard being aligned
+        amrs = AMR_Shards(amr_file, remove_wiki=True, nlp_data=True, alignments=['subgraph'])
+        subgraph_alignments = amrs.alignments['subgraph']
+    else:
+        amrs = load_amrs(amr_file, remove_wiki=True, nlp_data=True)
+        align_file = amr_file.replace('.txt', '') + '.subgraph_alignments.json'
+        subgraph_alignments = reader.load_alignments_from_json(align_file, amrs)
     # amrs = amrs[:1000]
 
     eval_amr_file, eval_amrs, gold_eval_alignments = None, None, None
     if args.test:
         eval_amr_file, eval_align_file = args.test
-        eval_amrs = reader.load(eval_amr_file, remove_wiki=True)
-        add_nlp_data(eval_amrs, eval_amr_file)
+        eval_amrs = load_amrs(eval_amr_file, remove_wiki=True, nlp_data=True)
         gold_eval_alignments = reader.load_alignments_from_json(eval_align_file, eval_amrs)
         eval_amr_ids = {amr.id for amr in eval_amrs}
-        amrs = [amr for amr in amrs if amr.id not in eval_amr_ids]
+        if args.sharded:
+            amrs.exclude_ids = eval_amr_ids
+        else:
+            amrs = [amr for amr in amrs if amr.id not in eval_amr_ids]
 
         align_file = eval_amr_file.replace('.txt', '') + '.subgraph_alignments.gold.json'
         gold_subgraph_alignments = reader.load_alignments_from_json(align_file, eval_amrs)
@@ -67,30 +85,52 @@ def main():
     if args.load_model:
         print('Loading model from:', args.load_model)
         align_model = Relation_Model.load_model(args.load_model)
+        align_model.subgraph_alignments = subgraph_alignments
     else:
         align_model = Relation_Model(amrs, subgraph_alignments)
 
     iters = args.iter
 
+    stepwise = Stepwise_Counts(args.stepwise_decay) if args.batch_size else None
+
+    def save_shard_alignments(shard_file, shard_amrs, shard_alignments, epoch, perplexities):
+        # training perplexity of the shard, with the parameters its alignments were found with
+        perplexities.append(perplexity_sum(align_model, shard_amrs, shard_alignments))
+        report_progress(shard_file, shard_alignments, reader, epoch=epoch)
+        if epoch == iters-1:
+            report_progress(shard_file, shard_alignments, reader)
+
     alignments = None
     for i in range(iters):
         print(f'Epoch {i}: Training data')
-        alignments = align_model.align_all(amrs)
-        align_model.update_parameters(amrs, alignments)
-        report_progress(amr_file, alignments, reader, epoch=i)
-        perplexity(align_model, amrs, alignments)
+        if args.sharded:
+            perplexities = []
+            align_model.align_shards(amrs, partial(save_shard_alignments, epoch=i, perplexities=perplexities),
+                                     stepwise, args.batch_size, workers=args.workers)
+            print_perplexity(perplexities)
+        else:
+            if stepwise is not None:
+                alignments = align_model.align_all_stepwise(amrs, stepwise, args.batch_size, workers=args.workers)
+            else:
+                alignments = align_model.align_all(amrs, workers=args.workers)
+                align_model.update_parameters(amrs, alignments, workers=args.workers)
+            report_progress(amr_file, alignments, reader, epoch=i)
+            perplexity(align_model, amrs, alignments)
         print()
 
         if eval_amrs:
             print(f'Epoch {i}: Evaluation data')
-            eval_alignments = align_model.align_all(eval_amrs)
+            if args.sharded:
+                subgraph_alignments.update(pred_subgraph_alignments)
+            eval_alignments = align_model.align_all(eval_amrs, workers=args.workers)
             perplexity(align_model, eval_amrs, eval_alignments)
             evaluate_relations(eval_amrs, eval_alignments, gold_eval_alignments, pred_subgraph_alignments, gold_subgraph_alignments)
             report_progress(eval_amr_file, eval_alignments, reader, epoch=i)
             print()
 
 
-    report_progress(amr_file, alignments, reader)
+    if not args.sharded:
+        report_progress(amr_file, alignments, reader)
 
     if args.save_model:
         align_model.save_model(args.save_model)
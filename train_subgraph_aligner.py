@@ -1,11 +1,14 @@
 import sys
+from functools import partial
 
 from amr_utils.alignments import load_from_json
 from amr_utils.amr_readers import AMR_Reader
 
-from evaluate.utils import evaluate, perplexity, evaluate_duplicates
+from evaluate.utils import evaluate, perplexity, perplexity_sum, print_perplexity, evaluate_duplicates
 from models.subgraph_model import Subgraph_Model
-from nlp_data import add_nlp_data
+from models.count_table import Stepwise_Counts
+from amr_cache import load_amrs
+from amr_shards import AMR_Shards
 
 import argparse
 
@@ -20,6 +23,16 @@ parser.add_argument('--save-model', type=str,
                     help='params file to store the trained model')
 parser.add_argument('--load-model', type=str,
                     help='params file to load model')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes to align AMRs and count parameters in parallel')
+parser.add_argument('--batch-size', type=int,
+                    help='train with stepwise EM, updating parameters after each mini-batch of this many AMRs '
+                         '(by default parameters are updated once per epoch)')
+parser.add_argument('--stepwise-decay', type=float, default=0.7,
+                    help='stepwise EM: mini-batch k is interpolated with weight (k+1)^-decay, 0.5 < decay <= 1')
+parser.add_argument('--sharded', action='store_true',
+                    help='the train path is a directory of AMR files (shards), each with its own nlp data, '
+                         'which are loaded one at a time; alignments are written next to each shard')
 args = parser.parse_args()
 
 def report_progress(amr_file, alignments, reader, epoch=None):
@@ -33,17 +46,21 @@ def main():
     amr_file = args.train
 
     reader = AMR_Reader()
-    amrs = reader.load(amr_file, remove_wiki=True)
-    add_nlp_data(amrs, amr_file)
+    if args.sharded:
+        amrs = AMR_Shards(amr_file, remove_wiki=True, nlp_data=True)
+    else:
+        amrs = load_amrs(amr_file, remove_wiki=True, nlp_data=True)
 
     eval_amr_file, eval_amrs, gold_eval_alignments = None, None, None
     if args.test:
         eval_amr_file, eval_align_file = args.test
-        eval_amrs = reader.load(eval_amr_file, remove_wiki=True)
-        add_nlp_data(eval_amrs, eval_amr_file)
+        eval_amrs = load_amrs(eval_amr_file, remove_wiki=True, nlp_data=True)
         gold_eval_alignments = load_from_json(eval_align_file, eval_amrs, unanonymize=True)
         eval_amr_ids = {amr.id for amr in eval_amrs}
-        amrs = [amr for amr in amrs if amr.id not in eval_amr_ids]
+        if args.sharded:
+            amrs.exclude_ids = eval_amr_ids
+        else:
+            amrs = [amr for amr in amrs if amr.id not in eval_amr_ids]
     # amrs = amrs[:1000]
 
 
@@ -55,25 +72,44 @@ def main():
 
     iters = args.iter
 
+    stepwise = Stepwise_Counts(args.stepwise_decay) if args.batch_size else None
+
+    def save_shard_alignments(shard_file, shard_amrs, shard_alignments, epoch, perplexities):
+        # training perplexity of the shard, with the parameters its alignments were found with
+        perplexities.append(perplexity_sum(align_model, shard_amrs, shard_alignments))
+        report_progress(shard_file, shard_alignments, reader, epoch=epoch)
+        if epoch == iters-1:
+            report_progress(shard_file, shard_alignments, reader)
+
     alignments = None
     for i in range(iters):
         print(f'Epoch {i}: Training data')
-        alignments = align_model.align_all(amrs)
-        align_model.update_parameters(amrs, alignments)
-        perplexity(align_model, amrs, alignments)
-        report_progress(amr_file, alignments, reader, epoch=i)
+        if args.sharded:
+            perplexities = []
+            align_model.align_shards(amrs, partial(save_shard_alignments, epoch=i, perplexities=perplexities),
+                                     stepwise, args.batch_size, workers=args.workers)
+            print_perplexity(perplexities)
+        else:
+            if stepwise is not None:
+                alignments = align_model.align_all_stepwise(amrs, stepwise, args.batch_size, workers=args.workers)
+            else:
+                alignments = align_model.align_all(amrs, workers=args.workers)
+                align_model.update_parameters(amrs, alignments, workers=args.workers)
+            perplexity(align_model, amrs, alignments)
+            report_progress(amr_file, alignments, reader, epoch=i)
         print()
 
         if eval_amrs:
             print(f'Epoch {i}: Evaluation data')
-            eval_alignments = align_model.align_all(eval_amrs)
+            eval_alignments = align_model.align_all(eval_amrs, workers=args.workers)
             perplexity(align_model, eval_amrs, eval_alignments)
             evaluate(eval_amrs, eval_alignments, gold_eval_alignments)
             evaluate_duplicates(eval_amrs, eval_alignments, gold_eval_alignments)
             report_progress(eval_amr_file, eval_alignments, reader, epoch=i)
             print()
 
-    report_progress(amr_file, alignments, reader)
+    if not args.sharded:
+        report_progress(amr_file, alignments, reader)
 
     if args.save_model:
         align_model.save_model(args.save_model)
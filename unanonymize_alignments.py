@@ -1,16 +1,16 @@
 import os
 
 from amr_utils.alignments import load_from_json, write_to_json
-from amr_utils.amr_readers import AMR_Reader
+
+from amr_cache import load_amrs
 
 
 def main():
     dir = 'data-release/alignments'
 
-    reader = AMR_Reader()
-    dev_amrs = reader.load('data-release/amrs/leamr_dev.txt')
-    test_amrs = reader.load('data-release/amrs/leamr_test.txt')
-    all_amrs = reader.load('data-release/amrs/ldc+little_prince.txt')
+    dev_amrs = load_amrs('data-release/amrs/leamr_dev.txt')
+    test_amrs = load_amrs('data-release/amrs/leamr_test.txt')
+    all_amrs = load_amrs('data-release/amrs/ldc+little_prince.txt')
 
     amr_map = {'leamr_dev':dev_amrs, 'leamr_test':test_amrs, 'ldc+little_prince':all_amrs}
     for filename in os.listdir(dir):